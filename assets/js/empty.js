@@ -3,6 +3,7 @@ if (window.location.host == 'tools.formulae.uni-hamburg.de') {
     subdomain = '/dev'
 }
 var textSearchTimeout = null;
+var runningSearchId = null;
 var searchLemmas = document.getElementById('lemma_search');
 
 
@@ -75,28 +76,55 @@ function makeLemmaSearch() {
 }
 
 function pdfDownloadWorker() {
-    $.get(subdomain + '/search/pdf_progress/' + downloadId, function(data) {
-        if (data != '99%') {
-            $('#searchDownloadProgress').html(data);
+    $.getJSON(subdomain + '/search/pdf_progress/' + downloadId, function(job) {
+        $('#searchDownloadProgress').html(job.progress);
+        if (job.state == 'done' && job.result) {
+            // The PDF was rendered in the background and can now be downloaded
+            $('#searchDownloadProgress').css("visibility", "hidden").html('...');
+            window.location = subdomain + "/search/download/" + downloadId;
+        } else if (job.state == 'failed') {
+            $('#searchDownloadProgress').css("visibility", "hidden").html('...');
+            alert( downloadError );
+        } else if (job.state != 'done' && job.state != 'cancelled') {
             setTimeout(pdfDownloadWorker, 1000)
-        } else {
-            $('#searchDownloadProgress').html(data);
         }
     })
 }
 
 function searchProgressBar(searchId) {
-    $.get(subdomain + '/search/pdf_progress/' + searchId, function(data) {
+    $.getJSON(subdomain + '/search/pdf_progress/' + searchId, function(job) {
         var bar = $('#searchProgressBar');
-        bar.html(data);
-        bar.css('width', data);
-        bar.attr("aria-valuenow", data.replace('%', ''));
-        if (data != '100%') {
+        bar.html(job.progress);
+        bar.css('width', job.progress);
+        bar.attr("aria-valuenow", job.percent);
+        if (job.state != 'done' && job.state != 'failed' && job.state != 'cancelled') {
             setTimeout(searchProgressBar, 1000, searchId);
         };
     })
 }
 
+function asyncSearchWorker(searchId) {
+    // The results page of a search that runs in the background is reloaded when the results are ready
+    $.getJSON(subdomain + '/search/pdf_progress/' + searchId, function(job) {
+        var bar = $('#asyncSearchProgressBar');
+        bar.html(job.progress);
+        bar.css('width', job.progress);
+        bar.attr("aria-valuenow", job.percent);
+        if (job.state == 'done' || job.state == 'unknown') {
+            setTimeout(function() { location.reload(); }, 500);
+        } else if (job.state == 'failed' || job.state == 'cancelled') {
+            $('#asyncSearchError').removeClass('d-none');
+        } else {
+            setTimeout(asyncSearchWorker, 1000, searchId);
+        }
+    })
+}
+
+function cancelSearch(searchId) {
+    // sendBeacon also reaches the server while the page is being closed
+    navigator.sendBeacon(subdomain + '/search/cancel/' + searchId);
+}
+
 function sendAutocompleteRequest(sourceElement) {
     // using the timeout so that it waits until the user stops typing for .5 seconds before making the request to the server
     // idea from https://schier.co/blog/2014/12/08/wait-for-user-to-stop-typing-using-javascript.html
@@ -390,6 +418,10 @@ $(document).ready(function () {
     $('#searchDownload').on('click', function() {
         var jqxhr = $.ajax( subdomain + "/search/download/" + downloadId )
             .done(function (response, status, xhr) {
+                if (xhr.status == 202) {
+                    // The PDF is rendered in the background. pdfDownloadWorker downloads it when it is finished.
+                    return;
+                }
                 var filename = "";
                 var disposition = xhr.getResponseHeader('Content-Disposition');
                 if (disposition && disposition.indexOf('attachment') !== -1) {
@@ -426,8 +458,10 @@ $(document).ready(function () {
             .fail(function() {
                 alert( downloadError );
             })
-            .always(function() {
-                $('#searchDownloadProgress').css("visibility", "hidden").html('...');
+            .always(function(response, status, xhr) {
+                if (xhr.status != 202) {
+                    $('#searchDownloadProgress').css("visibility", "hidden").html('...');
+                }
             });
         // Replace this with a function that repeatedly calls to the backend to find out the status
         // E.g. from https://stackoverflow.com/questions/24251898/flask-app-update-progress-bar-while-function-runs
@@ -577,25 +611,48 @@ $(document).ready(function () {
     })
     
     $('#advancedSearchSubmit').click(function() {
+        runningSearchId = 'search_progress_' + $('#search_id').attr('value');
         setTimeout(function() {
             $('#searchProgressModal').modal('show');
-            searchProgressBar('search_progress_' + $('#search_id').attr('value'));
+            searchProgressBar(runningSearchId);
         }, 2000)
     })
     
     $('#simple-search-q').keyup(function(e) {
         if ((e.key === 'Enter' || e.key === 13) && $(this).val() != '') {
+            runningSearchId = 'search_progress_' + $('#simple_search_id').attr('value');
             setTimeout(function() {
                 $('#searchProgressModal').modal('show');
-                searchProgressBar('search_progress_' + $('#simple_search_id').attr('value'));
+                searchProgressBar(runningSearchId);
             }, 2000)
         }
     })
     
+    if (typeof asyncSearchId !== 'undefined') {
+        asyncSearchWorker(asyncSearchId);
+    }
+    
+    // Other tabs may wait for the same background search, so it is only cancelled with the button
+    $('#cancelAsyncSearchButton').click(function() {
+        cancelSearch(asyncSearchId);
+        history.back();
+    })
+    
     $('#cancelSearchButton').click(function() {
+        if (runningSearchId) {
+            cancelSearch(runningSearchId);
+        }
         location.reload();
     })
     
+    // A search whose tab is closed before its results arrive is cancelled so that it stops using the server.
+    // When the results arrive, the search is already finished and the cancellation is ignored.
+    window.addEventListener('pagehide', function() {
+        if (runningSearchId) {
+            cancelSearch(runningSearchId);
+        }
+    })
+    
     $('.simpleTextCorpus').click(function() {
         $('.simpleLexiconCorpus').prop('checked', false);
         $('#simple-lemma-checkbox').prop('disabled', false);
@@ -24,6 +24,18 @@ class Config(object):
     COLLECTED_COLLS = os.environ.get('COLLECTED_COLLS').split(';') if os.environ.get('COLLECTED_COLLS') else []
     # TERM_VECTORS = os.environ.get('TERM_VECTORS')
     CACHE_DIRECTORY = os.environ.get('NEMO_CACHE_DIR') or './cache/'
+    # Folder for the precomputed corpus snapshot that workers load instead of rebuilding all_texts. Empty -> no snapshot
+    CORPUS_SNAPSHOT_FOLDER = os.environ.get('CORPUS_SNAPSHOT_FOLDER', '')
+    # Number of processes used to parse the textgroups of the CORPUS_FOLDERS in parallel when the app starts (0 -> parse them one after the other)
+    CORPUS_INGESTION_PROCESSES = int(os.environ.get('CORPUS_INGESTION_PROCESSES', 0))
+    # When to build the sorted text lists of all collections: 'eager' (at startup), 'background' (in a thread after startup)
+    # or 'lazy' (the first time each collection is requested)
+    CORPUS_WARM_UP = os.environ.get('CORPUS_WARM_UP', 'eager')
+    # Number of rendered corpus pages kept in memory by each worker (0 -> no caching) and seconds they are kept in Redis
+    CORPUS_CACHE_SIZE = int(os.environ.get('CORPUS_CACHE_SIZE', 128))
+    CORPUS_CACHE_TIMEOUT = int(os.environ.get('CORPUS_CACHE_TIMEOUT', 86400))
+    # Folder for the pre-rendered passage HTML written by `flask build-passage-store` ('' -> always render on the fly)
+    PASSAGE_STORE_FOLDER = os.environ.get('PASSAGE_STORE_FOLDER', '')
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -33,10 +45,47 @@ class Config(object):
     SESSION_TYPE = 'filesystem'
     IIIF_SERVER = os.environ.get('IIIF_SERVER')
     IIIF_MAPPING = os.environ.get('IIIF_MAPPING') or ';'.join(['{}/iiif'.format(f) for f in CORPUS_FOLDERS])
+    # Folder for the token tables of the search indices written by `flask build-token-store` ('' -> always request term vectors)
+    TOKEN_STORE_FOLDER = os.environ.get('TOKEN_STORE_FOLDER', '')
+    # Seconds each worker keeps the fingerprint of the search indices before it checks again whether they have been reindexed
+    INDEX_CHECK_INTERVAL = int(os.environ.get('INDEX_CHECK_INTERVAL', 60))
+    # Folder for the table of document attributes written by `flask build-doc-attributes` ('' -> count all facets in Elasticsearch)
+    DOC_ATTRIBUTE_FOLDER = os.environ.get('DOC_ATTRIBUTE_FOLDER', '')
+    # Number of search results that are fetched and highlighted per page (0 -> all results on a single page)
+    SEARCH_RESULTS_PER_PAGE = int(os.environ.get('SEARCH_RESULTS_PER_PAGE', 0))
+    # Number of threads per worker that send independent Elasticsearch requests of a search concurrently (0 or 1 -> one after the other)
+    SEARCH_THREADS = int(os.environ.get('SEARCH_THREADS', 0))
+    # Combine the queries of an advanced search into a single Elasticsearch bool query instead of combining their results in Python
+    SEARCH_COMBINED_QUERY = os.environ.get('SEARCH_COMBINED_QUERY') is not None
+    # Number of fuzzy term expansions kept in the memory of each worker (0 -> always ask the Elasticsearch term suggester)
+    FUZZY_CACHE_SIZE = int(os.environ.get('FUZZY_CACHE_SIZE', 4096))
+    # Seconds that fuzzy term expansions are kept in Redis
+    FUZZY_CACHE_TIMEOUT = int(os.environ.get('FUZZY_CACHE_TIMEOUT', 86400))
+    # Seconds that the document counts of all corpora ('all_docs') are kept in Redis (0 -> request them with every search)
+    ALL_DOCS_CACHE_TIMEOUT = int(os.environ.get('ALL_DOCS_CACHE_TIMEOUT', 3600))
+    # Number of search result sets kept in the memory of each worker to re-sort or restrict them without a new search (0 -> always search)
+    RESULT_SET_CACHE_SIZE = int(os.environ.get('RESULT_SET_CACHE_SIZE', 16))
+    # Seconds that search result sets are kept in Redis
+    RESULT_SET_TIMEOUT = int(os.environ.get('RESULT_SET_TIMEOUT', 3600))
+    # Seconds that the results of the last search of a user are kept in Redis (0 -> keep them in the session)
+    PREVIOUS_SEARCH_TIMEOUT = int(os.environ.get('PREVIOUS_SEARCH_TIMEOUT', 86400))
+    # Seconds the state and progress of a search or PDF export job are kept in Redis after its last change
+    JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 3600))
+    # Folder for the PDFs of search results that are rendered in background processes ('' -> render them in the request),
+    # the number of these processes per worker and seconds the finished PDFs are kept
+    SEARCH_EXPORT_FOLDER = os.environ.get('SEARCH_EXPORT_FOLDER', '')
+    SEARCH_EXPORT_WORKERS = int(os.environ.get('SEARCH_EXPORT_WORKERS', 1))
+    SEARCH_EXPORT_TIMEOUT = int(os.environ.get('SEARCH_EXPORT_TIMEOUT', 3600))
+    # Number of threads per worker that run searches in the background while the results page polls for them (0 -> search in the request)
+    # and seconds the results of these searches are kept in Redis
+    ASYNC_SEARCH_WORKERS = int(os.environ.get('ASYNC_SEARCH_WORKERS', 0))
+    ASYNC_SEARCH_TIMEOUT = int(os.environ.get('ASYNC_SEARCH_TIMEOUT', 600))
     # This should only be changed to True when collecting search queries and responses for mocking ES
     SAVE_REQUESTS = False
     CACHE_MAX_AGE = os.environ.get('VARNISH_MAX_AGE') or 0  # Only need cache on the server, where this should be set in env
     PDF_ENCRYPTION_PW = os.environ.get('PDF_ENCRYPTION_PW', 'hard_pw')
+    # Megabytes of generated text PDFs kept in the pdf_folder of the app (0 -> render every PDF on request)
+    PDF_CACHE_SIZE = int(os.environ.get('PDF_CACHE_SIZE', 512))
     SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', True)
     REMEMBER_COOKIE_SECURE = os.environ.get('REMEMBER_COOKIE_SECURE', True)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
@@ -91,6 +91,9 @@ def create_app(config_class=Config):
         viewer_bp.static_folder = app.config['IIIF_MAPPING']
         app.register_blueprint(viewer_bp, url_prefix="/viewer")
 
+    from .commands import register_commands
+    register_commands(app)
+
     return app
 
 
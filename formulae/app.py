@@ -1,28 +1,44 @@
-from MyCapytain.resolvers.capitains.local import XmlCapitainsLocalResolver
+from flask import Flask
+from config import Config
 from . import create_app
 from .nemo import NemoFormulae
+from .services.resolver_service import make_resolver
 
-flask_app = create_app()
-resolver = XmlCapitainsLocalResolver(flask_app.config['CORPUS_FOLDERS'])
 
-nemo = NemoFormulae(
-    name="InstanceNemo",
-    app=flask_app,
-    resolver=resolver,
-    base_url="",
-    css=["assets/css/theme.css"],
-    js=["assets/js/empty.js"],
-    static_folder="./assets/",
-    transform={"default": "components/epidoc.xsl",
-               "notes": "components/extract_notes.xsl",
-               "elex_notes": "components/extract_elex_notes.xsl",
-               "pdf": "components/xml_to_pdf.xsl"},
-    templates={"main": "templates/main",
-               "errors": "templates/errors",
-               "auth": "templates/auth",
-               "search": "templates/search",
-               "viewer": "templates/viewer"},
-    pdf_folder="pdf_folder/"
-)
+def create_nemo_app(config_class=Config) -> Flask:
+    """ Builds the Flask application together with the resolver and the NemoFormulae instance.
+    This is the entry point used by gunicorn when the application is preloaded in the master process (see gunicorn.conf.py).
 
-flask_app.config['nemo_app'] = nemo
+    :param config_class: the configuration class for the application
+    :return: the Flask application with the NemoFormulae instance in its config under 'nemo_app'
+    """
+    app = create_app(config_class)
+    corpus_resolver = make_resolver(app.config['CORPUS_FOLDERS'], processes=app.config['CORPUS_INGESTION_PROCESSES'])
+
+    nemo_app = NemoFormulae(
+        name="InstanceNemo",
+        app=app,
+        resolver=corpus_resolver,
+        base_url="",
+        css=["assets/css/theme.css"],
+        js=["assets/js/empty.js"],
+        static_folder="./assets/",
+        transform={"default": "components/epidoc.xsl",
+                   "notes": "components/extract_notes.xsl",
+                   "elex_notes": "components/extract_elex_notes.xsl",
+                   "pdf": "components/xml_to_pdf.xsl"},
+        templates={"main": "templates/main",
+                   "errors": "templates/errors",
+                   "auth": "templates/auth",
+                   "search": "templates/search",
+                   "viewer": "templates/viewer"},
+        pdf_folder="pdf_folder/"
+    )
+
+    app.config['nemo_app'] = nemo_app
+    return app
+
+
+flask_app = create_nemo_app()
+nemo = flask_app.config['nemo_app']
+resolver = nemo.resolver
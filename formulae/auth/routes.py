@@ -5,6 +5,7 @@ from werkzeug.urls import url_parse
 from .forms import LoginForm, PasswordChangeForm, LanguageChangeForm, ResetPasswordRequestForm, ResetPasswordForm, \
     RegistrationForm, EmailChangeForm, AddSavedPageForm
 from formulae.models import User, SavedPage
+from formulae.search.result_store import load_previous_search, save_previous_search
 from .email import send_password_reset_email, send_email_reset_email
 from formulae.auth import bp
 from formulae import db
@@ -184,7 +185,7 @@ def r_save_page():
             return redirect(url_for('InstanceNemo.r_index'))
         search_results = None
         if form.save_search_results.data is True:
-            search_results = session.get('previous_search', None)
+            search_results = load_previous_search()
         page = SavedPage(name=form.name.data or url.path,
                          url='?'.join([url.path, url.query]),
                          user_id=user_id,
@@ -232,5 +233,5 @@ def r_open_page(page_id):
     page = SavedPage.query.get(int(page_id))
     page_url = page.url
     if page.search_results:
-        session['previous_search'] = page.search_results
+        save_previous_search(page.search_results)
     return redirect(page_url)
@@ -0,0 +1,156 @@
+import os
+import tempfile
+import zipfile
+from time import perf_counter
+from typing import Tuple
+
+import click
+from flask import current_app, Flask
+from flask.cli import with_appcontext
+
+
+@click.command('build-corpus-snapshot')
+@with_appcontext
+def build_corpus_snapshot():
+    """ Rebuilds the corpus data from the resolver and writes it to CORPUS_SNAPSHOT_FOLDER.
+    Run this after the corpus has been updated, e.g., `flask --app app build-corpus-snapshot`
+    """
+    if not current_app.config.get('CORPUS_SNAPSHOT_FOLDER'):
+        raise click.ClickException('CORPUS_SNAPSHOT_FOLDER is not set.')
+    nemo = current_app.config['nemo_app']
+    nemo.build_corpus_data()
+    path = nemo.save_corpus_snapshot(force=True)
+    if path is None:
+        raise click.ClickException('The corpus snapshot could not be written.')
+    nemo.corpus_cache.clear()
+    click.echo('Corpus snapshot {} written to {}'.format(nemo.corpus_key, path))
+
+
+@click.command('corpus-cache-stats')
+@click.option('--clear', is_flag=True, help='Remove all cached corpus pages after printing the statistics.')
+@with_appcontext
+def corpus_cache_stats(clear: bool):
+    """ Prints the hit and miss counters of the r_corpus cache of all workers"""
+    nemo = current_app.config['nemo_app']
+    for field, value in sorted(nemo.corpus_cache.stats()['shared'].items()):
+        click.echo('{}: {}'.format(field, value))
+    if clear:
+        nemo.corpus_cache.clear()
+        click.echo('Corpus cache cleared.')
+
+
+@click.command('build-passage-store')
+@with_appcontext
+def build_passage_store():
+    """ Renders the HTML and the notes of every readable passage and writes them to PASSAGE_STORE_FOLDER.
+    Run this after the corpus or the XSLT stylesheets have been updated, e.g., `flask --app app build-passage-store`
+    """
+    if not current_app.config.get('PASSAGE_STORE_FOLDER'):
+        raise click.ClickException('PASSAGE_STORE_FOLDER is not set.')
+    nemo = current_app.config['nemo_app']
+    with current_app.test_request_context():
+        path, rendered = nemo.build_passage_store()
+    click.echo('{} passages rendered for corpus {} and written to {}'.format(rendered, nemo.corpus_key, path))
+
+
+@click.command('build-token-store')
+@with_appcontext
+def build_token_store():
+    """ Fetches the term vectors of all documents in Elasticsearch and writes their token tables to TOKEN_STORE_FOLDER.
+    Run this after the search indices have been rebuilt, e.g., `flask --app app build-token-store`
+    """
+    if not current_app.config.get('TOKEN_STORE_FOLDER'):
+        raise click.ClickException('TOKEN_STORE_FOLDER is not set.')
+    if not current_app.elasticsearch:
+        raise click.ClickException('ELASTICSEARCH_URL is not set.')
+    from formulae.search.token_store import build_token_store as build_store
+    path, written = build_store()
+    click.echo('Token tables of {} documents written to {}'.format(written, path))
+
+
+@click.command('build-doc-attributes')
+@with_appcontext
+def build_doc_attributes():
+    """ Reads the dates, collections and other attributes of all documents in Elasticsearch and writes them to
+    DOC_ATTRIBUTE_FOLDER. Run this after the search indices have been rebuilt, e.g., `flask --app app build-doc-attributes`
+    """
+    if not current_app.config.get('DOC_ATTRIBUTE_FOLDER'):
+        raise click.ClickException('DOC_ATTRIBUTE_FOLDER is not set.')
+    if not current_app.elasticsearch:
+        raise click.ClickException('ELASTICSEARCH_URL is not set.')
+    from formulae.search.doc_attributes import build_doc_attributes as build_table
+    path, written = build_table()
+    click.echo('Attributes of {} documents written to {}'.format(written, path))
+
+
+@click.command('build-pdf-cache')
+@with_appcontext
+def build_pdf_cache():
+    """ Renders the PDFs of all open texts into the PDF cache in the pdf_folder of the app.
+    The PDFs carry the date on which they were rendered, so run this once a day, e.g., `flask --app app build-pdf-cache`
+    """
+    if current_app.config.get('PDF_CACHE_SIZE', 0) <= 0:
+        raise click.ClickException('PDF_CACHE_SIZE is 0.')
+    nemo = current_app.config['nemo_app']
+    if not nemo.pdf_cache.enabled:
+        raise click.ClickException('The app has no pdf_folder.')
+    with current_app.test_request_context():
+        cached = nemo.build_pdf_cache()
+    click.echo('{} PDFs cached in {}'.format(cached, nemo.pdf_cache.folder))
+
+
+@click.command('build-pdfs')
+@click.argument('urns', nargs=-1)
+@click.option('--collection', 'collections', multiple=True, help='Render all texts of this collection, e.g., urn:cts:formulae:marculf.')
+@click.option('--output', required=True, help='The folder for the PDFs or the name of a .zip file.')
+@click.option('--processes', default=os.cpu_count() or 1, show_default=True, help='The number of worker processes.')
+@click.option('--encrypt', is_flag=True, help='Encrypt the texts of the formulae collection like the public downloads.')
+@with_appcontext
+def build_pdfs(urns: Tuple[str], collections: Tuple[str], output: str, processes: int, encrypt: bool):
+    """ Renders the PDFs of many texts in parallel, e.g.,
+    `flask --app app build-pdfs --collection urn:cts:formulae:marculf --output marculf.zip`
+    """
+    from formulae.services.pdf_batch import collection_texts, render_pdfs
+    nemo = current_app.config['nemo_app']
+    try:
+        object_ids = collection_texts(nemo, collections)
+    except KeyError as E:
+        raise click.ClickException('Unknown collection {}.'.format(E))
+    object_ids += [u for u in urns if u not in object_ids]
+    if not object_ids:
+        raise click.ClickException('No texts given.')
+    to_zip = output.endswith('.zip')
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        folder = tmp_folder if to_zip else output
+        archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) if to_zip else None
+        start = perf_counter()
+        rendered = 0
+        total_bytes = 0
+        try:
+            for objectId, file_name, seconds, size in render_pdfs(nemo, object_ids, folder, processes, encrypt=encrypt):
+                click.echo('{}: {:.2f}s, {} KB'.format(objectId, seconds, size // 1024))
+                if archive is not None:
+                    archive.write(os.path.join(folder, file_name), file_name)
+                    os.remove(os.path.join(folder, file_name))
+                rendered += 1
+                total_bytes += size
+        finally:
+            if archive is not None:
+                archive.close()
+        elapsed = perf_counter() - start
+    click.echo('{} of {} PDFs ({} MB) written to {} in {:.1f}s ({:.2f} PDFs/s)'.format(
+        rendered, len(object_ids), total_bytes // (1024 * 1024), output, elapsed, rendered / elapsed if elapsed else 0))
+
+
+def register_commands(app: Flask):
+    """ Registers the command line commands of the application
+
+    :param app: the Flask application
+    """
+    app.cli.add_command(build_corpus_snapshot)
+    app.cli.add_command(corpus_cache_stats)
+    app.cli.add_command(build_passage_store)
+    app.cli.add_command(build_token_store)
+    app.cli.add_command(build_doc_attributes)
+    app.cli.add_command(build_pdf_cache)
+    app.cli.add_command(build_pdfs)
@@ -1,5 +1,6 @@
 from flask import current_app
 from . import db, login
+from .search.result_store import decode_results, encode_results
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from time import time
@@ -55,13 +56,30 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
 
+class EncodedSearchResults(db.TypeDecorator):
+    """ Stores search results in the versioned, compressed format of encode_results"""
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_results(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_results(value)
+
+
 class SavedPage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(256))
     url = db.Column(db.String(2048))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    search_results = db.Column(db.PickleType())
+    # Only loaded when the saved page is opened
+    search_results = db.deferred(db.Column(EncodedSearchResults()))
 
     def __repr__(self):
         return '<Name {}, URL {}>'.format(self.name, self.url)
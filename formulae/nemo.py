@@ -2,7 +2,7 @@ import os.path
 
 from flask import url_for, Markup, g, session, flash, request, Response, Blueprint, send_from_directory, abort
 from flask_login import current_user, login_required
-from flask_babel import _, refresh, get_locale
+from flask_babel import _, refresh, get_locale, force_locale
 from flask_babel import lazy_gettext as _l
 from babel.core import UnknownLocaleError
 from werkzeug.utils import redirect
@@ -13,7 +13,15 @@ from MyCapytain.resources.collections.capitains import XmlCapitainsReadableMetad
 from MyCapytain.errors import UnknownCollection
 from formulae.search.forms import SearchForm
 from formulae.search.Search import lem_highlight_to_text, POST_TAGS, PRE_TAGS
+from formulae.search.result_store import clear_previous_search, load_previous_search, previous_search_incomplete, \
+    save_previous_search
 from formulae.auth.forms import AddSavedPageForm
+from formulae.services import corpus_service
+from formulae.services.corpus_service import corpus_hash, load_corpus_snapshot, save_corpus_snapshot, snapshot_path, \
+    TextRecord, LazyTextIndex
+from formulae.services.cache_service import TwoTierCache
+from formulae.services.passage_store import PassageStore, PassageStoreWriter
+from formulae.services.pdf_cache import PdfCache
 from lxml import etree
 from .errors.handlers import e_internal_error, e_not_found_error, e_unknown_collection_error, e_not_authorized_error
 import re
@@ -34,6 +42,8 @@ from random import randint
 import roman
 import requests
 from itertools import zip_longest
+from functools import partial
+from threading import Thread, local
 from operator import itemgetter
 
 
@@ -311,15 +321,29 @@ class NemoFormulae(Nemo):
             self.pdf_folder = kwargs["pdf_folder"]
             del kwargs["pdf_folder"]
         super(NemoFormulae, self).__init__(*args, **kwargs)
-        self.collected_colls = self.make_collected_colls()
-        self.sub_colls = self.get_all_corpora()
-        self.all_texts, self.open_texts, self.half_open_texts = self.get_open_texts()
+        self._xslt_cache = local()
+        self._corpus_key = None
+        self._passage_store = None
+        self.corpus_cache = TwoTierCache(self.app.redis, 'formulae:r_corpus', max_items=self.app.config['CORPUS_CACHE_SIZE'],
+                                         timeout=self.app.config['CORPUS_CACHE_TIMEOUT'])
+        self.pdf_cache = PdfCache(getattr(self, 'pdf_folder', ''), self.app.config['PDF_CACHE_SIZE'] * 1024 * 1024)
+        if not self.load_corpus_snapshot():
+            self.build_corpus_data()
+            self.save_corpus_snapshot()
+        self.warm_up_thread = None
+        if self.app.config['CORPUS_WARM_UP'] == 'eager':
+            self.finish_corpus_warm_up()
+        elif self.app.config['CORPUS_WARM_UP'] == 'background' and isinstance(self.all_texts, LazyTextIndex):
+            self.warm_up_thread = Thread(target=self.all_texts.warm_up, name='corpus-warm-up', daemon=True)
+            self.warm_up_thread.start()
         self.app.jinja_env.filters["remove_from_list"] = self.f_remove_from_list
         self.app.jinja_env.filters["join_list_values"] = self.f_join_list_values
         self.app.jinja_env.filters["replace_indexed_item"] = self.f_replace_indexed_item
         self.app.jinja_env.filters["insert_in_list"] = self.f_insert_in_list
         self.app.jinja_env.filters["random_int"] = self.f_random_int
         self.app.jinja_env.globals['get_locale'] = get_locale
+        self.app.jinja_env.globals['previous_search'] = load_previous_search
+        self.app.jinja_env.globals['previous_search_incomplete'] = previous_search_incomplete
         self.app.register_error_handler(404, e_not_found_error)
         self.app.register_error_handler(500, e_internal_error)
         self.app.register_error_handler(401, e_not_authorized_error)
@@ -377,9 +401,171 @@ class NemoFormulae(Nemo):
                         for r_desc in self.resolver.getMetadata(coll_urn).readableDescendants.values():
                             manuscript_parts = re.search(r'(\D+)(\d+)', r_desc.id.split('.')[-1])
                             metadata = [r_desc.id, self.LANGUAGE_MAPPING[r_desc.lang], manuscript_parts.groups()]
-                            collected_colls[k].append((parent_number, metadata, r_desc))
+                            collected_colls[k].append(self.make_text_record(parent_number, metadata, r_desc))
         return dict(collected_colls)
 
+    @property
+    def corpus_key(self) -> str:
+        """ The fingerprint of the corpus folders and the settings that determine how the corpus is built.
+        It is computed once per process and used to invalidate persistent corpus data, e.g., the corpus snapshot.
+        The code that builds the corpus data and the fields of TextRecord are part of the fingerprint, so that a
+        snapshot written by an older version of the code is not loaded.
+
+        :return: the hex digest of the corpus fingerprint
+        """
+        if self._corpus_key is None:
+            self._corpus_key = corpus_hash(self.app.config['CORPUS_FOLDERS'],
+                                           extra_files=list(self.app.config['COLLECTED_COLLS']) + [__file__, corpus_service.__file__],
+                                           extra_values=[repr(self.OPEN_COLLECTIONS), repr(self.HALF_OPEN_COLLECTIONS),
+                                                         repr(TextRecord.__slots__)])
+        return self._corpus_key
+
+    @property
+    def passage_store_key(self) -> str:
+        """ The fingerprint of the corpus and of the XSLT stylesheets that are used to render the passages
+
+        :return: the hex digest of the fingerprint
+        """
+        return corpus_hash([], extra_files=sorted(v for v in self._transform.values() if isinstance(v, str)),
+                           extra_values=[self.corpus_key])
+
+    @property
+    def passage_store(self) -> PassageStore:
+        """ The store of pre-rendered passages in PASSAGE_STORE_FOLDER. It is opened on first access and is empty if
+        the folder is not set or if the store was built for a different corpus.
+
+        :return: the passage store
+        """
+        if self._passage_store is None:
+            store_folder = self.app.config.get('PASSAGE_STORE_FOLDER')
+            self._passage_store = PassageStore(store_folder, self.passage_store_key if store_folder else '')
+        return self._passage_store
+
+    def build_passage_store(self) -> Tuple[str, int]:
+        """ Renders the passage and the notes of every chunk of every readable text and writes them to a new passage store.
+        This must be called within a request context since the notes contain links built with url_for.
+
+        :return: the path of the new store and the number of rendered passages
+        """
+        writer = PassageStoreWriter(self.app.config['PASSAGE_STORE_FOLDER'], self.passage_store_key)
+        rendered = 0
+        try:
+            for objectId in sorted(self.resolver.getMetadata().readableDescendants.keys()):
+                notes_names = [n for n in ('notes', 'elex_notes') if n in self._transform and (n == 'notes' or 'elexicon' in objectId)]
+                try:
+                    reffs = self.get_reffs(objectId)
+                except Exception as E:
+                    self.app.logger.warning('No references for {}: {}'.format(objectId, E))
+                    continue
+                for subreference, _label in reffs:
+                    text = self.get_passage(objectId=objectId, subreference=subreference)
+                    passage_tree = self.transform_tree(text, text.export(Mimetypes.PYTHON.ETREE), objectId)
+                    writer.add((objectId, subreference, 'passage'), self.serialize_html(passage_tree))
+                    for notes_name in notes_names:
+                        writer.add((objectId, subreference, notes_name), self.extract_notes(passage_tree, notes_name))
+                    rendered += 1
+        except BaseException:
+            writer.abort()
+            raise
+        path = writer.commit()
+        self._passage_store = None
+        return path, rendered
+
+    def build_pdf_cache(self) -> int:
+        """ Renders the PDFs of all open texts into the PDF cache, the encrypted variant for the public and, for the
+        texts in the formulae collection, the unencrypted variant for the project team. PDFs that are already in the
+        cache are kept. This must be called within a request context since the citation contains a link built with url_for.
+
+        :return: the number of PDFs in the cache for the open texts
+        """
+        from formulae.services.pdf_service import cached_pdf
+        cached = 0
+        for objectId in sorted(set(self.open_texts)):
+            is_formula = 'formulae_collection' in self.resolver.getMetadata(objectId=objectId).ancestors
+            for encrypted in ([True, False] if is_formula else [False]):
+                try:
+                    cached_pdf(objectId, self.resolver, self.static_folder, encrypted, self.transform, self.get_passage,
+                               self.get_reffs, self.app.config['PDF_ENCRYPTION_PW'], self.pdf_cache, self.corpus_key)
+                except Exception as E:
+                    self.app.logger.warning('No PDF for {}: {}'.format(objectId, E))
+                    continue
+                cached += 1
+        return cached
+
+    def render_passage(self, text, objectId: str, subreference: str) -> Tuple[str, str]:
+        """ Returns the HTML of a passage and of its notes, from the passage store if possible and otherwise by running the XSLTs
+
+        :param text: the passage as returned by get_passage
+        :param objectId: the object identifier
+        :param subreference: the subreference of the passage
+        :return: the passage HTML and the notes HTML
+        """
+        notes_name = self.notes_xslt_name()
+        passage = self.passage_store.get((objectId, subreference, 'passage'))
+        notes = self.passage_store.get((objectId, subreference, notes_name)) if notes_name else ''
+        if passage is not None and notes is not None:
+            return passage, notes
+        passage_tree = self.transform_tree(text, text.export(Mimetypes.PYTHON.ETREE), objectId)
+        passage = self.serialize_html(passage_tree)
+        notes = self.extract_notes(passage_tree, notes_name) if notes_name else ''
+        return passage, notes
+
+    def build_corpus_data(self):
+        """ Builds the collected collections, the sub-corpora, all texts and the open and half-open text lists from the resolver"""
+        self.collected_colls = self.make_collected_colls()
+        self.sub_colls = self.get_all_corpora()
+        self.all_texts, self.open_texts, self.half_open_texts = self.get_open_texts()
+
+    def finish_corpus_warm_up(self):
+        """ Builds the TextRecords of all collections that have not been accessed yet and waits for the background warm-up.
+        This is called before the gunicorn workers are forked so that they share the finished corpus data.
+        """
+        if isinstance(self.all_texts, LazyTextIndex):
+            self.all_texts.warm_up()
+        if self.warm_up_thread is not None:
+            self.warm_up_thread.join()
+            self.warm_up_thread = None
+
+    def load_corpus_snapshot(self) -> bool:
+        """ Loads the corpus data from the snapshot in CORPUS_SNAPSHOT_FOLDER if its fingerprint matches the current corpus.
+
+        :return: whether the snapshot was loaded
+        """
+        snapshot_folder = self.app.config.get('CORPUS_SNAPSHOT_FOLDER')
+        if not snapshot_folder:
+            return False
+        snapshot = load_corpus_snapshot(snapshot_folder, self.corpus_key)
+        if snapshot is None:
+            return False
+        self.collected_colls = snapshot['collected_colls']
+        self.all_texts = snapshot['all_texts']
+        self.sub_colls = snapshot['sub_colls']
+        self.open_texts = snapshot['open_texts']
+        self.half_open_texts = snapshot['half_open_texts']
+        return True
+
+    def save_corpus_snapshot(self, force: bool = False) -> Union[str, None]:
+        """ Saves the current corpus data to CORPUS_SNAPSHOT_FOLDER so that the next worker can load it instead of rebuilding it
+
+        :param force: whether to write the snapshot even if one already exists for the current fingerprint
+        :return: the path to the snapshot or None if CORPUS_SNAPSHOT_FOLDER is not set
+        """
+        snapshot_folder = self.app.config.get('CORPUS_SNAPSHOT_FOLDER')
+        if not snapshot_folder:
+            return None
+        if not force and os.path.isfile(snapshot_path(snapshot_folder, self.corpus_key)):
+            return snapshot_path(snapshot_folder, self.corpus_key)
+        data = {'collected_colls': self.collected_colls,
+                'all_texts': dict(self.all_texts),
+                'sub_colls': self.sub_colls,
+                'open_texts': self.open_texts,
+                'half_open_texts': self.half_open_texts}
+        try:
+            return save_corpus_snapshot(snapshot_folder, self.corpus_key, data)
+        except OSError as E:
+            self.app.logger.warning('Unable to save the corpus snapshot to {}: {}'.format(snapshot_folder, E))
+            return None
+
     def make_manuscript_notes(self) -> dict:
         """ Ingests an existing JSON file that contains notes about specific manuscript transcriptions"""
         manuscript_notes = dict()
@@ -685,52 +871,97 @@ class NemoFormulae(Nemo):
             metadata = [m.id, self.LANGUAGE_MAPPING[m.lang], manuscript_parts.groups()]
         return par, metadata, m
 
-    def get_open_texts(self) -> Tuple[Dict[str, Tuple[Union[str, Tuple[str, Tuple[str, str]]],
-                                                      Union[List[Sequence[str]], list],
-                                                      XmlCapitainsReadableMetadata]],
-                                      List[str],
-                                      List[str]]:
+    def make_text_record(self, par: Union[str, Tuple[str, Tuple[str, str]]], metadata: List[Any],
+                         m: XmlCapitainsReadableMetadata) -> TextRecord:
+        """ Extracts the data that the corpus routes need from the metadata of a readable text
+
+        :param par: the sort key of the text as returned by ordered_corpora
+        :param metadata: the list of [id, language, manuscript parts] as returned by ordered_corpora
+        :param m: the metadata for the text
+        :return: the TextRecord for the text
+        """
+        return TextRecord(par=par,
+                          metadata=metadata,
+                          id=m.id,
+                          subtype=frozenset(m.subtype),
+                          parent_id=list(m.parent)[0],
+                          ancestor_ids=frozenset(m.ancestors.keys()),
+                          parent_label=str(self.make_parents(m)[0]['label']),
+                          title=str(m.metadata.get_single(DC.title)),
+                          regest=str(m.metadata.get_single(DC.description)),
+                          abstract=str(m.metadata.get_single(DCTERMS.abstract)),
+                          dating=str(m.metadata.get_single(DCTERMS.temporal)),
+                          spatial=str(m.metadata.get_single(DCTERMS.spatial)),
+                          source=str(m.metadata.get_single(DC.source) or ''),
+                          source_edition=str(m.metadata.get_single(DCTERMS.source) or ''),
+                          is_version_of=tuple(str(x) for x in sorted(m.metadata.get(DCTERMS.isVersionOf))),
+                          alternative=str(m.metadata.get_single(DCTERMS.alternative) or ''),
+                          status=str(m.metadata.get_single(self.BF.status)),
+                          activity=str(m.metadata.get_single(self.BIBO.Activity) or ''))
+
+    def text_record(self, m: XmlCapitainsReadableMetadata, collection: str) -> TextRecord:
+        """ Builds the TextRecord for a readable descendant of a collection
+
+        :param m: the metadata for the descendant
+        :param collection: the collection to which readable collection belongs
+        :return: the TextRecord, which sorts in the same order as the tuple returned by ordered_corpora
+        """
+        return self.make_text_record(*self.ordered_corpora(m, collection))
+
+    def sorted_text_records(self, collection: str, key: Callable = None) -> List[TextRecord]:
+        """ Builds the sorted TextRecords of all readable descendants of a collection.
+        Since the records are shared by all users, the sort keys are always built in the default locale.
+
+        :param collection: the collection ID
+        :param key: the sort key function, e.g., sort_katalonien. Default: sort by (par, metadata)
+        :return: the sorted list of TextRecords
+        """
+        with force_locale(self.app.config['BABEL_DEFAULT_LOCALE']):
+            return sorted([self.text_record(r, collection) for r in self.resolver.getMetadata(collection).readableDescendants.values()],
+                          key=key)
+
+    def get_open_texts(self) -> Tuple[LazyTextIndex, List[str], List[str]]:
         """ Creates the lists of open and half-open texts to be used later.
+        The sorted TextRecords of a collection are only built the first time the collection is accessed in all_texts.
+        The open and half-open texts are found from the ancestors and the readable descendants of each collection.
 
-        :return: dictionary of all texts {collection: [readableDescendants]}, list of open texts, list of half-open texts
+        :return: lazy dictionary of all texts {collection: [TextRecord]}, list of open texts, list of half-open texts
         """
         open_texts = []
         half_open_texts = []
-        all_texts = {m['id']: sorted([self.ordered_corpora(r, m['id']) for r in self.resolver.getMetadata(m['id']).readableDescendants.values()])
-                     for l in self.sub_colls.values() for m in l if m['id'] not in ['urn:cts:formulae:anjou_archives',
-                                                                                    'urn:cts:formulae:katalonien',
-                                                                                    'urn:cts:formulae:marmoutier_manceau',
-                                                                                    'urn:cts:formulae:marmoutier_vendomois_appendix',
-                                                                                    'urn:cts:formulae:marmoutier_dunois']
-                     and 'urn:cts:formulae:' in m['id']}
-        all_texts.update({m: sorted([self.ordered_corpora(r, m)
-                                     for r in self.resolver.getMetadata(m).readableDescendants.values()],
-                                    key=self.sort_katalonien)
-                          for m in self.resolver.children['urn:cts:formulae:katalonien']})
-        all_texts.update({m: sorted([self.ordered_corpora(r, m)
-                                     for r in self.resolver.getMetadata(m).readableDescendants.values()])
-                          for m in self.resolver.children['urn:cts:formulae:marmoutier_manceau']})
-        all_texts.update({m: sorted([self.ordered_corpora(r, m)
-                                     for r in self.resolver.getMetadata(m).readableDescendants.values()])
-                          for m in self.resolver.children['urn:cts:formulae:marmoutier_vendomois_appendix']})
-        all_texts.update({m: sorted([self.ordered_corpora(r, m)
-                                     for r in self.resolver.getMetadata(m).readableDescendants.values()])
-                          for m in self.resolver.children['urn:cts:formulae:marmoutier_dunois']})
-        all_texts.update({m: sorted([self.ordered_corpora(r, m)
-                                     for r in self.resolver.getMetadata(m).readableDescendants.values()])
-                          for m in self.resolver.children['urn:cts:formulae:anjou_archives']})
-        all_texts.update({k: sorted(v) for k, v in self.collected_colls.items()})
-        for c in all_texts.keys():
-            parents = [p.id for p in self.resolver.getMetadata(c).ancestors.values() if 'urn:cts:formulae:' in p.id]
+        builders = OrderedDict()
+        for l in self.sub_colls.values():
+            for m in l:
+                if m['id'] not in ['urn:cts:formulae:anjou_archives',
+                                   'urn:cts:formulae:katalonien',
+                                   'urn:cts:formulae:marmoutier_manceau',
+                                   'urn:cts:formulae:marmoutier_vendomois_appendix',
+                                   'urn:cts:formulae:marmoutier_dunois'] and 'urn:cts:formulae:' in m['id']:
+                    builders[m['id']] = partial(self.sorted_text_records, m['id'])
+        for m in self.resolver.children['urn:cts:formulae:katalonien']:
+            builders[m] = partial(self.sorted_text_records, m, key=self.sort_katalonien)
+        for special_coll in ['urn:cts:formulae:marmoutier_manceau', 'urn:cts:formulae:marmoutier_vendomois_appendix',
+                             'urn:cts:formulae:marmoutier_dunois', 'urn:cts:formulae:anjou_archives']:
+            for m in self.resolver.children[special_coll]:
+                builders[m] = partial(self.sorted_text_records, m)
+        for k, v in self.collected_colls.items():
+            builders[k] = partial(sorted, v)
+        for c in builders.keys():
+            coll = self.resolver.getMetadata(c)
+            parents = [p.id for p in coll.ancestors.values() if 'urn:cts:formulae:' in p.id]
+            if c in self.collected_colls:
+                text_ids = [x.id for x in sorted(self.collected_colls[c])]
+            else:
+                text_ids = list(coll.readableDescendants.keys())
             if set(self.OPEN_COLLECTIONS).intersection(parents + [c]):
-                open_texts += [x[1][0] for x in all_texts[c]]
+                open_texts += text_ids
             if set(self.HALF_OPEN_COLLECTIONS).intersection(parents + [c]):
-                half_open_texts += [x[1][0] for x in all_texts[c]]
-        return all_texts, open_texts, half_open_texts
+                half_open_texts += text_ids
+        return LazyTextIndex(builders), open_texts, half_open_texts
 
-    def sort_katalonien(self, t: tuple):
+    def sort_katalonien(self, t: TextRecord):
         """ Correctly sort the Katalonien documents with mixed number and Roman numerals"""
-        return re.sub(r'[IVX]+\Z', lambda x: self.ROMAN_NUMERAL_SORTING[x.group(0)], t[0])
+        return re.sub(r'[IVX]+\Z', lambda x: self.ROMAN_NUMERAL_SORTING[x.group(0)], t.par)
 
     @staticmethod
     def check_project_team() -> bool:
@@ -860,7 +1091,7 @@ class NemoFormulae(Nemo):
         g.half_open_texts = self.half_open_texts
         g.open_collections = self.OPEN_COLLECTIONS
         if not re.search('texts|search|assets|favicon|reading_format|save_page', request.url):
-            session.pop('previous_search', None)
+            clear_previous_search()
 
     def after_request(self, response: Response) -> Response:
         """ Currently used only for the Cache-Control header.
@@ -876,9 +1107,11 @@ class NemoFormulae(Nemo):
         response.cache_control.max_age = max_age
         response.cache_control.public = True
         if getattr(g, 'previous_search', None) is not None:
-            session['previous_search'] = g.previous_search
+            save_previous_search(g.previous_search)
         if getattr(g, 'previous_search_args', None):
             session['previous_search_args'] = g.previous_search_args
+        if getattr(g, 'previous_search_paged', None) is not None:
+            session['previous_search_paged'] = g.previous_search_paged
         if getattr(g, 'previous_aggregations', None):
             session['previous_aggregations'] = g.previous_aggregations
         if getattr(g, 'highlighted_words', None):
@@ -1047,45 +1280,26 @@ class NemoFormulae(Nemo):
         data['breadcrumb_colls'] = [all_parent_colls]
         return data
     
-    def r_corpus(self, objectId: str, lang: str = None) -> Dict[str, Any]:
-        """ Route to browse collections and add another text to the view
+    def make_corpus_readable(self, collection: XmlCapitainsCollectionMetadata, objectId: str) -> OrderedDict:
+        """ Builds the ordered dictionary of the readable texts in a corpus for r_corpus.
+        The result only depends on the collection, the project team status of the user and the locale and is cached in self.corpus_cache.
 
-        :param objectId: Collection identifier
-        :param lang: Lang in which to express main data
-        :return: Template and collections contained in given collection
+        :param collection: the metadata for the corpus
+        :param objectId: the corpus identifier
+        :return: the readable texts ordered by their short keys
         """
-        collection = self.resolver.getMetadata(objectId)
         r = OrderedDict()
-        template = "main::sub_collection.html"
-        current_parents = self.make_parents(collection, lang=lang)
-        containing_colls = list()
         mss_editions = list()
-        for cont_coll in sorted(collection.metadata.get(DCTERMS.isPartOf), key=lambda x: self.sort_sigla(x.split(':')[-1])):
-            cont_coll_md = self.resolver.getMetadata(str(cont_coll)).metadata
-            containing_colls.append((Markup(cont_coll_md.get_single(self.BIBO.AbbreviatedTitle)), cont_coll_md.get_single(DC.title), str(cont_coll)))
-
-        form = None
-        if 'elexicon' in objectId:
-            template = "main::elex_collection.html"
-        # elif 'salzburg' in objectId:
-        #     template = "main::salzburg_collection.html"
-        elif objectId in self.FOUR_LEVEL_COLLECTIONS:
-            return redirect(url_for('InstanceNemo.r_collection', objectId=objectId, lang=lang))
-        if collection.id not in self.all_texts:
-            if collection.readable == True:
-                return redirect(url_for('InstanceNemo.r_multipassage', objectIds=objectId, subreferences='all'))
-            new_id = [x['id'] for x in self.make_parents(collection) if x['id'] in self.all_texts]
-            raise UnknownCollection('{}'.format(collection.get_label(lang)) + _l(' ist kein bekannter Korpus.'),
-                                    new_id[0] if new_id else '')
-        for par, metadata, m in self.all_texts[collection.id]:
-            if self.check_project_team() is True or m.id in self.open_texts:
-                manuscript_data = [m.metadata.get_single(DC.source) or
+        for text in self.all_texts[collection.id]:
+            par, metadata = text.par, text.metadata
+            if self.check_project_team() is True or text.id in self.open_texts:
+                manuscript_data = [text.source or
                                    '{}<seg class="manuscript-number">{}</seg>'.format(metadata[2][0].title(),
                                                                                       metadata[2][1]),
-                                   "manifest:" + m.id in self.app.picture_file]
-                if 'cts:edition' in m.subtype:
+                                   "manifest:" + text.id in self.app.picture_file]
+                if 'cts:edition' in text.subtype:
                     key = 'editions'
-                elif 'cts:translation' in m.subtype:
+                elif 'cts:translation' in text.subtype:
                     key = 'translations'
                 else:
                     key = 'transcriptions'
@@ -1116,7 +1330,7 @@ class NemoFormulae(Nemo):
                         'name': '',
                         'title': '',
                         'transcribed_edition': [],
-                        'parent_id': str(m.id)
+                        'parent_id': text.id
                     }
                     r[short_key]["versions"][key].append(metadata + [manuscript_data])
                 if key == 'editions' or 'manuscript_collection' in collection.ancestors:
@@ -1126,26 +1340,27 @@ class NemoFormulae(Nemo):
                         work_name = Markup(par.lstrip('0') if isinstance(par, str) else '')
                         # work_name = Markup(self.format_folia_range(par) if isinstance(par, str) else '')
                     #print('work_name',work_name,'par',par)
-                    parents = self.make_parents(m)
-                    parent_title = parents[0]['label']
+                    parent_title = text.parent_label
                     if 'manuscript_collection' in collection.ancestors:
+                        parents = self.make_parents(self.resolver.getMetadata(text.id))
                         parent_title = [x['label'] for x in parents if 'manuscript_collection' in self.resolver.getMetadata(x['id']).ancestors][0]
                     elif 'formulae_collection' in collection.ancestors:
+                        parents = self.make_parents(self.resolver.getMetadata(text.id))
                         parent_title = [x['label'] for x in parents if 'manuscript_collection' not in self.resolver.getMetadata(x['id']).ancestors][0]
-                    if 'urn:cts:formulae:marculf' in m.ancestors and key == 'editions':
+                    if 'urn:cts:formulae:marculf' in text.ancestor_ids and key == 'editions':
                         work_name = Markup(str(parent_title).replace('Marculf ', ''))
                     elif 'Computus' in work_name:
                         work_name = '(Computus)'
                     elif 'Titel' in work_name:
                         work_name = _('(Titel)')
-                    elif 'urn:cts:formulae:lorsch' in m.ancestors:
-                        name_part = re.search(r'(Kap\.|Nr\.).*', str(m.metadata.get_single(DC.title)))
+                    elif 'urn:cts:formulae:lorsch' in text.ancestor_ids:
+                        name_part = re.search(r'(Kap\.|Nr\.).*', text.title)
                         if name_part:
                             work_name = Markup(name_part.group(0))
-                    regest = [Markup(m.metadata.get_single(DC.description))] if 'formulae_collection' in collection.ancestors else [Markup(x) for x in str(m.metadata.get_single(DC.description)).split('***')]
-                    short_regest = str(m.metadata.get_single(DCTERMS.abstract)) or ''
+                    regest = [Markup(text.regest)] if 'formulae_collection' in collection.ancestors else [Markup(x) for x in text.regest.split('***')]
+                    short_regest = text.abstract or ''
                     bg_color = 'bg-color-0'
-                    for version_index, form_version in enumerate(sorted(m.metadata.get(DCTERMS.isVersionOf))):
+                    for version_index, form_version in enumerate(text.is_version_of):
                         if form_version:
                             if '_' in form_version.split('.')[-1]:
                                 mss_edition = re.sub(r'(.*)\.(form)?(([2-9]_)*).*', r'\1\3', form_version)
@@ -1168,20 +1383,20 @@ class NemoFormulae(Nemo):
                                         regest = [Markup(readable_form.metadata.get_single(DC.description))]
                                         short_regest = Markup(str(readable_form.metadata.get_single(DCTERMS.abstract)))
                     # The following lines are to deal with the Pancarte Noire double regests
-                    if self.check_project_team() is False and (m.id in self.closed_texts['half_closed'] or m.id in self.closed_texts['closed']):
+                    if self.check_project_team() is False and (text.id in self.closed_texts['half_closed'] or text.id in self.closed_texts['closed']):
                         if len(regest) == 2:
                            regest[1] = Markup('<b>REGEST EDITION</b>: ' + '<i>{}</i>'.format(_('Dieses Regest ist nicht öffentlich zugänglich.')))
 
                     r[short_key].update({"short_regest": short_regest,
                                    "regest": regest,
-                                   "dating": str(m.metadata.get_single(DCTERMS.temporal)),
-                                   "ausstellungsort": str(m.metadata.get_single(DCTERMS.spatial)),
+                                   "dating": text.dating,
+                                   "ausstellungsort": text.spatial,
                                    'name': work_name,
-                                   'title': Markup(str(self.make_parents(m)[0]['label'])),
-                                   'translated_title': str(m.metadata.get_single(DCTERMS.alternative) or ''),
-                                   'deperditum': str(m.metadata.get_single(self.BF.status)) == 'deperditum',
-                                   'problematic': str(m.metadata.get_single(self.BIBO.Activity)) if m.metadata.get_single(self.BIBO.Activity) else '',
-                                   "source_edition": str(m.metadata.get_single(DCTERMS.source) or ''),
+                                   'title': Markup(text.parent_label),
+                                   'translated_title': text.alternative,
+                                   'deperditum': text.status == 'deperditum',
+                                   'problematic': text.activity,
+                                   "source_edition": text.source_edition,
                                    'bg_color': bg_color})
 
 
@@ -1245,14 +1460,15 @@ class NemoFormulae(Nemo):
                 key=lambda x: x[2][0]
             )
 
- 
+        return r
 
-        if len(r) == 0:
-            if 'manuscript_collection' in collection.ancestors:
-                flash(_('Um das Digitalisat dieser Handschrift zu sehen, besuchen Sie bitte gegebenenfalls die Homepage der Bibliothek.'))
-            else:
-                flash(_('Diese Sammlung ist nicht öffentlich zugänglich.'))
+    def make_corpus_breadcrumb(self, collection: XmlCapitainsCollectionMetadata, current_parents: List[Dict[str, Any]]) -> List[List[Tuple[str, str]]]:
+        """ Builds the groups of parent collections shown in the breadcrumb of r_corpus
 
+        :param collection: the metadata for the corpus
+        :param current_parents: the parents of the corpus as returned by make_parents
+        :return: list of lists of (id, short title) for each level of parents, ending with the corpus itself
+        """
         all_parent_colls = list()
         parent_colls = defaultdict(list)
         parent_textgroups = [x for x in current_parents if 'cts:textgroup' in x['subtype']]
@@ -1263,6 +1479,45 @@ class NemoFormulae(Nemo):
             if v:
                 all_parent_colls.append([(x['id'], str(x['short_title'])) for x in v])
         all_parent_colls.append([(collection.id, str(collection.metadata.get_single(self.BIBO.AbbreviatedTitle) or ''))])
+        return all_parent_colls
+
+    def r_corpus(self, objectId: str, lang: str = None) -> Dict[str, Any]:
+        """ Route to browse collections and add another text to the view
+
+        :param objectId: Collection identifier
+        :param lang: Lang in which to express main data
+        :return: Template and collections contained in given collection
+        """
+        collection = self.resolver.getMetadata(objectId)
+        template = "main::sub_collection.html"
+        current_parents = self.make_parents(collection, lang=lang)
+        containing_colls = list()
+        for cont_coll in sorted(collection.metadata.get(DCTERMS.isPartOf), key=lambda x: self.sort_sigla(x.split(':')[-1])):
+            cont_coll_md = self.resolver.getMetadata(str(cont_coll)).metadata
+            containing_colls.append((Markup(cont_coll_md.get_single(self.BIBO.AbbreviatedTitle)), cont_coll_md.get_single(DC.title), str(cont_coll)))
+
+        form = None
+        if 'elexicon' in objectId:
+            template = "main::elex_collection.html"
+        # elif 'salzburg' in objectId:
+        #     template = "main::salzburg_collection.html"
+        elif objectId in self.FOUR_LEVEL_COLLECTIONS:
+            return redirect(url_for('InstanceNemo.r_collection', objectId=objectId, lang=lang))
+        if collection.id not in self.all_texts:
+            if collection.readable == True:
+                return redirect(url_for('InstanceNemo.r_multipassage', objectIds=objectId, subreferences='all'))
+            new_id = [x['id'] for x in self.make_parents(collection) if x['id'] in self.all_texts]
+            raise UnknownCollection('{}'.format(collection.get_label(lang)) + _l(' ist kein bekannter Korpus.'),
+                                    new_id[0] if new_id else '')
+        r, all_parent_colls = self.corpus_cache.get_or_set(
+            (self.corpus_key, objectId, self.check_project_team(), str(get_locale()), lang),
+            lambda: (self.make_corpus_readable(collection, objectId), self.make_corpus_breadcrumb(collection, current_parents)))
+
+        if len(r) == 0:
+            if 'manuscript_collection' in collection.ancestors:
+                flash(_('Um das Digitalisat dieser Handschrift zu sehen, besuchen Sie bitte gegebenenfalls die Homepage der Bibliothek.'))
+            else:
+                flash(_('Diese Sammlung ist nicht öffentlich zugänglich.'))
 
         return_value = {
             "template": template,
@@ -1313,7 +1568,7 @@ class NemoFormulae(Nemo):
         if 'manuscript_collection' in collection.ancestors:
             related_mss = set()
             for ms_r_d in list_of_readable_descendants:
-                form_parent = [self.resolver.getMetadata(v['id']) for v in self.make_parents(ms_r_d[-1]) if 'manuscript_collection' not in v['ancestors']][0]
+                form_parent = [self.resolver.getMetadata(v['id']) for v in self.make_parents(self.resolver.getMetadata(ms_r_d.id)) if 'manuscript_collection' not in v['ancestors']][0]
                 form_mss_r = [v_r for v_r in form_parent.readableDescendants.values() if 'manuscript_collection' in v_r.ancestors]
                 for form_ms_r in form_mss_r:
                     related_mss.add([v['id'] for v in self.make_parents(form_ms_r) if 'manuscript_collection' in v['ancestors']][-1])
@@ -1322,14 +1577,15 @@ class NemoFormulae(Nemo):
                 list_of_readable_descendants += self.all_texts[related_ms]
 
         if {'formulae_collection', 'manuscript_collection'} & set(collection.ancestors):
-            for par, metadata, m in list_of_readable_descendants:
-                if self.check_project_team() is True or m.id in self.open_texts:
-                    edition = str(m.id).split(".")[-1]
-                    if 'manuscript_collection' in m.ancestors:
-                        edition = str(m.id).split(':')[-1].split('.')[0]
+            for text in list_of_readable_descendants:
+                if self.check_project_team() is True or text.id in self.open_texts:
+                    m = self.resolver.getMetadata(text.id)
+                    edition = text.id.split(".")[-1]
+                    if 'manuscript_collection' in text.ancestor_ids:
+                        edition = text.id.split(':')[-1].split('.')[0]
                     if 'manuscript_collection' in collection.ancestors:
                         ed_titles = list()
-                        for ed_parent_id in sorted(m.metadata.get(DCTERMS.isVersionOf)):
+                        for ed_parent_id in text.is_version_of:
                             ed_parent = self.resolver.getMetadata(str(ed_parent_id))
                             ed_titles.append([v.metadata.get_single(DC.title) for v in ed_parent.readableDescendants.values() if 'cts:edition' in v.subtype][0].replace(' (lat)', ''))
                             form = ed_parent.id
@@ -1339,8 +1595,8 @@ class NemoFormulae(Nemo):
                         title = str(ed_parent.metadata.get_single(DC.title, lang=lang))
                         form = ed_parent.id
                     edition_name = ed_trans_mapping.get(edition, edition).title()
-                    regest = str(m.metadata.get_single(DCTERMS.abstract))
-                    if 'manuscript_collection' in m.ancestors:
+                    regest = text.abstract
+                    if 'manuscript_collection' in text.ancestor_ids:
                         full_edition = sorted([(k, v) for k, v in m.ancestors.items() if 'manuscript_collection' in v.ancestors])[0][-1]
                         edition_name = str(full_edition.metadata.get_single(self.BIBO.AbbreviatedTitle, lang=lang))
                         for k, v in ed_parent.readableDescendants.items():
@@ -1352,32 +1608,32 @@ class NemoFormulae(Nemo):
 
                     if edition not in translations.keys():
                         titles[edition] = [title]
-                        translations[edition] = [m.id]
+                        translations[edition] = [text.id]
                         forms[edition] = [form]
                         edition_names[edition] = edition_name
                         full_edition_names[edition] = full_edition_name
                         regesten[edition] = [regest]
-                        if "sg2" in m.id:
-                            par_parts = re.search(r'.*\[p\.\s*(\d+)\-?(\d+)?.*', str(m.metadata.get_single(DC.title)))
+                        if "sg2" in text.id:
+                            par_parts = re.search(r'.*\[p\.\s*(\d+)\-?(\d+)?.*', text.title)
                             ms_par = '{:04}'.format(int(par_parts.group(1)))
                             if len(par_parts.groups()) > 1:
                                 ms_par += '-' + par_parts.group(2)
                             parents[edition] = [ms_par]
                         else:
-                            parents[edition] = [re.sub(r'.*?(\d+[rvab]+)(\d+[rvab]+)?(\d)?\Z', self.sort_folia, list(m.parent)[0])]
+                            parents[edition] = [re.sub(r'.*?(\d+[rvab]+)(\d+[rvab]+)?(\d)?\Z', self.sort_folia, text.parent_id)]
                     else:
                         titles[edition].append(title)
-                        translations[edition].append(m.id)
+                        translations[edition].append(text.id)
                         forms[edition].append(form)
                         regesten[edition].append(regest)
-                        if "sg2" in m.id:
-                            par_parts = re.search(r'.*\[p\.\s*(\d+)\-?(\d+)?.*', str(m.metadata.get_single(DC.title)))
+                        if "sg2" in text.id:
+                            par_parts = re.search(r'.*\[p\.\s*(\d+)\-?(\d+)?.*', text.title)
                             ms_par = '{:04}'.format(int(par_parts.group(1)))
                             if len(par_parts.groups()) > 1:
                                 ms_par += '-' + par_parts.group(2)
                             parents[edition].append(ms_par)
                         else:
-                            parents[edition].append(re.sub(r'.*?(\d+[rvab]+)(\d+[rvab]+)?(\d)?\Z', self.sort_folia, list(m.parent)[0]))
+                            parents[edition].append(re.sub(r'.*?(\d+[rvab]+)(\d+[rvab]+)?(\d)?\Z', self.sort_folia, text.parent_id))
             for k, v in translations.items():
                 if k == 'lat001':
                     r['editions'].append({
@@ -1571,17 +1827,15 @@ class NemoFormulae(Nemo):
             sibling_texts = []
             for gp in grandparents:
                 for x in self.all_texts[gp]:
-                    if x[2].subtype & text.subtype and re.search(r'{}\d\d\d\Z'.format(language), x[1][0]):
-                        text_label = Markup(self.make_parents(x[2])[0]['label'])
-                        sibling_texts.append((x[1][0], text_label))
+                    if x.subtype & text.subtype and re.search(r'{}\d\d\d\Z'.format(language), x.id):
+                        sibling_texts.append((x.id, Markup(x.parent_label)))
         else:
             sibling_texts = []
             for gp in grandparents:
                 if gp in self.all_texts:
                     for x in self.all_texts[gp]:
-                        if x[1][0].split('.')[-1] == id_parts[-1]:
-                            text_label = Markup(self.make_parents(x[2])[0]['label'])
-                            sibling_texts.append((x[1][0], text_label))
+                        if x.id.split('.')[-1] == id_parts[-1]:
+                            sibling_texts.append((x.id, Markup(x.parent_label)))
         orig_index = sibling_texts.index((objectId, str(self.make_parents(text)[0]['label'])))
         return {'prev_version': sibling_texts[orig_index - 1][0] if orig_index > 0 else None,
                 'next_version': sibling_texts[orig_index + 1][0] if orig_index + 1 < len(sibling_texts) else None,
@@ -1674,10 +1928,11 @@ class NemoFormulae(Nemo):
             text = self.get_passage(objectId=objectId, subreference=new_subref)
             flash('{}, {}'.format(metadata.get_label(lang), subreference) + _l(' wurde nicht gefunden. Der ganze Text wird angezeigt.'))
             subreference = new_subref
-        passage = self.transform(text, text.export(Mimetypes.PYTHON.ETREE), objectId)
+        passage, notes = self.render_passage(text, objectId, subreference)
         # The following is to deal with the Pancarte Noire texts that are still under copyright
         if objectId in self.closed_texts['closed'] and self.check_project_team() is False:
             passage = '<div class="text lang_lat edition" data-lang="lat" lang="la"><div class="charta"><p>{}</p></div></div>'.format(_('Dieser Text ist nicht öffentlich zugänglich.'))
+            notes = self.extract_notes(passage) if 'notes' in self._transform else ''
         secondary_language = 'de'
         all_langs = [str(x) for x in metadata.metadata.get(DC.language, lang=None)]
         if len(all_langs) > 0:
@@ -1685,10 +1940,6 @@ class NemoFormulae(Nemo):
                 if l != 'lat':
                     secondary_language = l[:2]
         # metadata1 = self.resolver.getMetadata(objectId=objectId)
-        if 'notes' in self._transform:
-            notes = self.extract_notes(passage)
-        else:
-            notes = ''
         prev, next = self.get_siblings(objectId, subreference, text)
         inRefs = []
         for inRef in sorted(metadata.metadata.get(DCTERMS.isReferencedBy)):
@@ -1937,8 +2188,9 @@ class NemoFormulae(Nemo):
 
                     
                     self.app.logger.warn(msg='d["IIIFviewer"]: {}'.format(d["IIIFviewer"]))
-                    if 'previous_search' in session:
-                        result_ids = [x for x in session['previous_search'] if x['id'] == id]
+                    previous_search = load_previous_search()
+                    if previous_search:
+                        result_ids = [x for x in previous_search if x['id'] == id]
                         if result_ids and any([x.get('highlight') for x in result_ids]):
                             d['text_passage'] = self.highlight_found_sents(d['text_passage'], result_ids)
                     if d['collections']['current']['sigla'] != '':
@@ -2212,21 +2464,80 @@ class NemoFormulae(Nemo):
         """
         return {"template": "main::charter_formulae.html"}
 
-    def extract_notes(self, text: str) -> str:
+    def get_xslt(self, name: str) -> etree.XSLT:
+        """ Returns the compiled XSLT for one of the stylesheets in the transform dictionary.
+        The stylesheets are compiled once per thread and then reused, since XSLT objects should not be shared between threads.
+
+        :param name: the key of the stylesheet in the transform dictionary, e.g., 'default' or 'notes'
+        :return: the compiled stylesheet
+        """
+        cache = getattr(self._xslt_cache, 'xslts', None)
+        if cache is None:
+            cache = self._xslt_cache.xslts = dict()
+        if name not in cache:
+            with open(self._transform[name]) as f:
+                cache[name] = etree.XSLT(etree.parse(f))
+        return cache[name]
+
+    def transform_tree(self, work, xml: etree._Element, objectId: str, subreference: str = None) -> Union[etree._XSLTResultTree, str]:
+        """ Transforms a passage with the XSLT registered for objectId (or the default XSLT) without serializing the result
+
+        :param work: the metadata of the text
+        :param xml: the XML of the passage
+        :param objectId: the object identifier
+        :param subreference: the subreference of the passage
+        :return: the transformed tree or, if the transformation is not an XSLT file, the string returned by Nemo.transform
+        """
+        name = str(objectId) if str(objectId) in self._transform else "default"
+        if isinstance(self._transform[name], str):
+            return self.get_xslt(name)(xml)
+        return super(NemoFormulae, self).transform(work, xml, objectId, subreference)
+
+    @staticmethod
+    def serialize_html(tree: Union[etree._XSLTResultTree, str]) -> str:
+        """ Serializes the result of transform_tree the same way that Nemo.transform does
+
+        :param tree: the result of transform_tree
+        :return: the HTML string
+        """
+        if isinstance(tree, str):
+            return tree
+        return etree.tostring(tree, encoding=str, method="html", xml_declaration=None, pretty_print=False,
+                              with_tail=True, standalone=None)
+
+    def transform(self, work, xml: etree._Element, objectId: str, subreference: str = None) -> str:
+        """ Transforms a passage like Nemo.transform but with the compiled XSLTs cached by get_xslt
+
+        :param work: the metadata of the text
+        :param xml: the XML of the passage
+        :param objectId: the object identifier
+        :param subreference: the subreference of the passage
+        :return: the HTML string of the transformed passage
+        """
+        return self.serialize_html(self.transform_tree(work, xml, objectId, subreference))
+
+    def notes_xslt_name(self) -> Union[str, None]:
+        """ The name of the stylesheet that extracts the notes for the current request
+
+        :return: 'elex_notes' for the lexicon route, 'notes' otherwise or None if there is no notes stylesheet
+        """
+        if 'notes' not in self._transform:
+            return None
+        if '/lexicon/' in str(request.path):
+            return 'elex_notes'
+        return 'notes'
+
+    def extract_notes(self, text: Union[str, etree._XSLTResultTree, etree._Element], xslt_name: str = None) -> str:
         """ Constructs a dictionary that contains all notes with their ids. This will allow the notes to be
         rendered anywhere on the page and not only where they occur in the text.
 
-        :param text: the string to be transformed
+        :param text: the transformed passage, either as a string or as the tree returned by transform_tree
+        :param xslt_name: the stylesheet to use, by default the one returned by notes_xslt_name
         :return: dict('note_id': 'note_content')
         """
-        if '/lexicon/' in str(request.path):
-            with open(self._transform['elex_notes']) as f:
-                xslt = etree.XSLT(etree.parse(f))
-        else:
-            with open(self._transform['notes']) as f:
-                xslt = etree.XSLT(etree.parse(f))
+        xslt = self.get_xslt(xslt_name or self.notes_xslt_name())
 
-        notes_html = xslt(etree.fromstring(text))
+        notes_html = xslt(etree.fromstring(text) if isinstance(text, str) else text)
         # Insert internal links
         try:
             for form_link in notes_html.xpath('//a[contains(@class, "formula-link")]'):
@@ -2257,5 +2568,7 @@ class NemoFormulae(Nemo):
             transform=self.transform,
             get_passage=self.get_passage,
             get_reffs=self.get_reffs,
-            encryption_pw=self.app.config['PDF_ENCRYPTION_PW']
+            encryption_pw=self.app.config['PDF_ENCRYPTION_PW'],
+            cache=self.pdf_cache,
+            corpus_key=self.corpus_key
         )
@@ -1,12 +1,23 @@
-from flask import current_app, Markup, flash, session, g
+from flask import current_app, Markup, flash, g
 from flask_babel import _
 from tests.fake_es import FakeElasticsearch
 from string import punctuation
 import re
 from copy import deepcopy
-from typing import Dict, List, Union, Tuple, Set
+from typing import Any, Dict, Iterable, List, Union, Tuple, Set
 from itertools import product
 from Levenshtein import distance
+from .doc_attributes import get_doc_attributes
+from .executor import get_search_executor, run_all, submit, timed
+from .expansions import fuzzy_expansions
+from .result_store import clear_previous_search
+from .result_sets import compact_result_set, expand_result_set, get_result_set_cache, restrict_result_set, \
+    result_set_key, results_table, sort_results
+from .spans import find_spans
+from .token_store import current_index_key, load_doc_tokens
+from elasticsearch import ApiError, TransportError
+from formulae.services.cache_service import TwoTierCache
+from formulae.services.job_service import get_job_registry, job_owner
 from math import floor
 
 
@@ -115,7 +126,15 @@ AGGREGATIONS = {'range': range_agg,
                                  'no_date': no_date_agg,
                                  'forgeries': forgery_agg
                              }}}
+# The aggregations over the hits of a search. The 'all_docs' counts do not depend on the search and are cached.
+FACET_AGGREGATIONS = {k: v for k, v in AGGREGATIONS.items() if k != 'all_docs'}
+# Number of corpus combinations whose 'all_docs' counts are kept in the memory of each worker
+ALL_DOCS_CACHE_SIZE = 64
 HITS_TO_READER = 10000
+# Batch size for the search_after requests that collect the ids of all hits in paged mode
+SEARCH_AFTER_BATCH_SIZE = 10000
+# Fields of _source that are not needed to display or highlight a page of results
+PAGE_SOURCE_EXCLUDES = ['lemmas', 'autocomplete', 'autocomplete_lemmas', 'autocomplete_regest']
 LEMMA_INDICES = {'normal': ['lemmas'], 'auto': ['autocomplete_lemmas']}
 
 
@@ -142,6 +161,182 @@ def build_sort_list(sort_str: str) -> Union[str, List[Union[Dict[str, Dict[str,
         return ['sort_prefix', {'urn': {'order': 'desc'}}]
 
 
+def get_all_docs_cache() -> TwoTierCache:
+    """ The cache of the 'all_docs' aggregation per corpus, created once per process
+
+    :return: the cache
+    """
+    cache = current_app.extensions.get('all_docs_cache')
+    if cache is None:
+        timeout = current_app.config.get('ALL_DOCS_CACHE_TIMEOUT', 0)
+        cache = TwoTierCache(current_app.redis, 'formulae:all_docs', max_items=ALL_DOCS_CACHE_SIZE if timeout else 0,
+                             timeout=timeout)
+        current_app.extensions['all_docs_cache'] = cache
+    return cache
+
+
+def all_docs_key(corpus: list) -> Union[str, None]:
+    """ The key of the 'all_docs' aggregation of a corpus in the all_docs cache. It contains the fingerprint of the
+    indices, so that the counts of the old indices are not used after a reindexing.
+
+    :param corpus: the indices that are searched
+    :return: the key or None if the fingerprint of the indices cannot be read
+    """
+    try:
+        return '{}:{}'.format('+'.join(sorted(corpus)), current_index_key(corpus))
+    except (ApiError, TransportError) as E:
+        current_app.logger.warning('Unable to read the fingerprint of the indices: {}'.format(E))
+        return None
+
+
+def facet_aggregations(corpus: list) -> Tuple[dict, Union[dict, None]]:
+    """ The aggregations that have to be requested for a search in corpus
+
+    :param corpus: the indices that are searched
+    :return: the aggregations to request and the cached 'all_docs' aggregation or None if it has to be requested, too
+    """
+    cache = get_all_docs_cache()
+    key = all_docs_key(corpus) if cache.enabled else None
+    if key is not None:
+        found, all_docs = cache.get(key)
+        if found:
+            return FACET_AGGREGATIONS, all_docs
+    return AGGREGATIONS, None
+
+
+def complete_aggregations(corpus: list, aggregations: dict, all_docs: Union[dict, None]) -> dict:
+    """ Adds the cached 'all_docs' aggregation to the aggregations of a search or caches the requested one
+
+    :param corpus: the indices that are searched
+    :param aggregations: the aggregations returned by Elasticsearch
+    :param all_docs: the result of facet_aggregations
+    :return: the aggregations including 'all_docs'
+    """
+    if all_docs is not None:
+        return dict(aggregations, all_docs=all_docs)
+    cache = get_all_docs_cache()
+    key = all_docs_key(corpus) if cache.enabled and 'all_docs' in aggregations else None
+    if key is not None:
+        cache.set(key, aggregations['all_docs'])
+    return aggregations
+
+
+def search_all_hits(corpus: list, body: dict, source: Union[bool, List[str]] = None) -> List[Dict[str, Any]]:
+    """ Collects all hits of a query in sort order with search_after instead of one request with a huge size.
+    Only the ids and the fields in source are returned, without highlighting.
+
+    :param corpus: the indices to search
+    :param body: the search body. Only its query and sort are used. The sort must end with a unique field, e.g., 'urn'.
+    :param source: the _source fields to return, by default only the title
+    :return: the hits with their _id, _index, sort values and the requested _source fields
+    """
+    return search_all_hits_and_aggs(corpus, body, None, source=source)[0]
+
+
+def search_all_hits_and_aggs(corpus: list, body: dict, aggs: Union[dict, None],
+                             source: Union[bool, List[str]] = None) -> Tuple[List[Dict[str, Any]], dict]:
+    """ Like search_all_hits but also requests aggregations over all hits together with the first batch of hits
+
+    :param corpus: the indices to search
+    :param body: the search body. Only its query and sort are used. The sort must end with a unique field, e.g., 'urn'.
+        Without a sort, e.g., for an unknown sort order, the hits are collected in score order.
+    :param aggs: the aggregations to request or None
+    :param source: the _source fields to return, by default only the title
+    :return: the hits and the aggregations
+    """
+    id_body = {'query': body['query'], 'sort': body.get('sort') or ['_score', 'urn'], 'size': SEARCH_AFTER_BATCH_SIZE,
+               '_source': ['title'] if source is None else source}
+    if aggs:
+        id_body['aggs'] = aggs
+    hits = []
+    aggregations = {}
+    while True:
+        response = current_app.elasticsearch.search(index=corpus, **id_body)
+        if id_body.pop('aggs', None):
+            aggregations = response.get('aggregations', {})
+        batch = response['hits']['hits']
+        hits += batch
+        if len(batch) < SEARCH_AFTER_BATCH_SIZE:
+            return hits, aggregations
+        id_body['search_after'] = batch[-1]['sort']
+
+
+def page_body(body: dict, page_ids: List[str]) -> dict:
+    """ Restricts a search body to the hits of one page of results
+
+    :param body: the search body that was used to find all hits
+    :param page_ids: the ids of the hits on the page
+    :return: the new search body
+    """
+    body = deepcopy(body)
+    body['query']['bool']['must'].append({'ids': {'values': page_ids}})
+    body.update({'from': 0, 'size': len(page_ids), '_source': {'excludes': PAGE_SOURCE_EXCLUDES}})
+    return body
+
+
+def fetch_sources(corpus: list, doc_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """ The _source of documents as it is fetched for a page of results, i.e., without the PAGE_SOURCE_EXCLUDES
+
+    :param corpus: the indices to search
+    :param doc_ids: the ids of the documents
+    :return: {document id: _source}
+    """
+    if not doc_ids:
+        return dict()
+    response = current_app.elasticsearch.search(index=corpus, query={'ids': {'values': doc_ids}}, size=len(doc_ids),
+                                                _source={'excludes': PAGE_SOURCE_EXCLUDES})
+    return {h['_id']: h['_source'] for h in response['hits']['hits']}
+
+
+def combine_queries(body: dict, part_queries: List[Tuple[str, dict, dict]], bool_operator: str) -> dict:
+    """ Combines the queries of an advanced search into a single bool query. The clause of every query is named with
+        its query key so that the hits report which of the queries they matched in 'matched_queries'.
+
+    :param body: the search body with the clauses that all queries share, e.g., the date range
+    :param part_queries: the (query key, query values, search body) of every query
+    :param bool_operator: how the queries are combined: 'must', 'must_not' or 'should'
+    :return: the combined search body
+    """
+    body = deepcopy(body)
+    clauses = list()
+    for query_key, query_vals, template in part_queries:
+        # The clause of the query itself is always the last one in its search body
+        clause = deepcopy(template['query']['bool']['must'][-1])
+        clause['bool']['_name'] = query_key
+        clauses.append(clause)
+        body['highlight']['fields'].update(template['highlight']['fields'])
+    if bool_operator == 'must':
+        combination = {'bool': {'must': clauses}}
+    elif bool_operator == 'must_not':
+        combination = {'bool': {'must': clauses[:1], 'must_not': clauses[1:]}}
+    else:
+        combination = {'bool': {'should': clauses, 'minimum_should_match': 1}}
+    body['query']['bool']['must'].append(combination)
+    return body
+
+
+def split_combined_hits(hits: List[Dict[str, Any]], part_queries: List[Tuple[str, dict, dict]]) -> List[List[Dict[str, Any]]]:
+    """ Assigns the hits of a combined query to the queries that they matched. Each hit keeps only the highlighting of
+        the search field of the query that it is assigned to.
+
+    :param hits: the hits of the query built by combine_queries
+    :param part_queries: the (query key, query values, search body) of every query
+    :return: the hits of every query
+    """
+    part_hits = list()
+    for query_key, query_vals, template in part_queries:
+        query_hits = list()
+        for hit in hits:
+            if query_key in hit.get('matched_queries', []):
+                query_hit = dict(hit)
+                if 'highlight' in hit:
+                    query_hit['highlight'] = {k: v for k, v in hit['highlight'].items()
+                                              if k == query_vals['search_field']}
+                query_hits.append(query_hit)
+        part_hits.append(query_hits)
+    return part_hits
+
+
 def suggest_word_search(**kwargs) -> Union[List[str], None]:
     """ To enable search-as-you-type for the text search
 
@@ -185,6 +380,35 @@ def highlight_segment(orig_str: str) -> str:
     return orig_str[init_index:end_index]
 
 
+def mark_snippet(text: str, start_index: int, end_index: int, start_offsets: Iterable[int],
+                 end_offsets: Iterable[int]) -> Markup:
+    """ Cuts a snippet out of a text and marks the highlighted words in it.
+        PRE_TAGS is inserted before every character at a start offset and POST_TAGS after every character at an
+        end offset. The snippet is assembled from slices of the text so that its cost grows with the number of
+        highlighted words and not with the number of characters times the number of offsets.
+
+    :param text: the full text of the field
+    :param start_index: the offset in text at which the snippet begins
+    :param end_index: the offset in text at which the snippet ends (exclusive)
+    :param start_offsets: the offsets of the first character of every highlighted word
+    :param end_offsets: the offsets of the last character of every highlighted word
+    :return: the marked-up snippet
+    """
+    segment = text[start_index:end_index]
+    length = len(segment)
+    # (cut, 0) closes a highlight after the character before the cut, (cut, 1) opens one before the character at the cut
+    cuts = {(o - start_index + 1, 0) for o in end_offsets if 0 <= o - start_index < length}
+    cuts.update((o - start_index, 1) for o in start_offsets if 0 <= o - start_index < length)
+    parts = []
+    last = 0
+    for cut, opens in sorted(cuts):
+        parts.append(segment[last:cut])
+        parts.append(PRE_TAGS if opens else POST_TAGS)
+        last = cut
+    parts.append(segment[last:])
+    return Markup(''.join(parts))
+
+
 def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None,
                           result_ids: Set[Tuple[str, str]] = None,
                           download_id: str = '') -> Tuple[List[Dict[str, Union[str, list]]], Set[str]]:
@@ -200,17 +424,15 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
     # Experimental highlighter does not work with span queries so it is out of the question.
     if len(result_ids) == 0:
         return [], set()
+    registry = get_job_registry()
     if download_id:
-        current_app.redis.set(download_id, '20%')
+        registry.progress(download_id, 'tokens', 20)
     nemo_app = current_app.config['nemo_app']
     id_dict = dict()
     all_highlighted_terms = set()
-    mvectors_body = {'docs': [{'_index': h[1], '_id': h[0], 'term_statistics': False, 'field_statistics': False} for h in result_ids]}
-    corp_vectors = dict()
-    for d in current_app.elasticsearch.mtermvectors(**mvectors_body)['docs']:
-        corp_vectors[d['_id']] = {'term_vectors': d['term_vectors']}
+    corp_tokens = load_doc_tokens(result_ids)
     if download_id:
-        current_app.redis.set(download_id, '50%')
+        registry.progress(download_id, 'highlight', 50)
     for query_terms, query_results in args_plus_results:
         for list_index, hit in enumerate(query_results['hits']['hits']):
             hit_highlight_positions = list()
@@ -222,7 +444,7 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
             regest_sents = []
             part_sentences = []
             other_sentences = []
-            vectors = corp_vectors[hit['_id']]['term_vectors']
+            vectors = corp_tokens[hit['_id']]
             if query_terms.get('compare_field', None) and query_terms['compare_field'] not in vectors:
                 continue
             for s_field in hit['highlight']:
@@ -235,17 +457,11 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
                         if x:
                             highlight_offsets[x] = dict()
                     if s_field in [highlight_field, query_terms['compare_field']]:
-                        for k, v in vectors[s_field]['terms'].items():
-                            for o in v['tokens']:
-                                highlight_offsets[s_field][o['position']] = (o['start_offset'], o['end_offset'], k)
+                        highlight_offsets[s_field] = vectors[s_field].offsets()
                     if s_field != highlight_field:
-                        for k, v in vectors[highlight_field]['terms'].items():
-                            for o in v['tokens']:
-                                highlight_offsets[highlight_field][o['position']] = (o['start_offset'], o['end_offset'], k)
+                        highlight_offsets[highlight_field] = vectors[highlight_field].offsets()
                     if query_terms['compare_field'] and query_terms['compare_field'] not in [highlight_field, s_field]:
-                        for k, v in vectors[query_terms['compare_field']]['terms'].items():
-                            for o in v['tokens']:
-                                highlight_offsets[query_terms['compare_field']][o['position']] = (o['start_offset'], o['end_offset'], k)
+                        highlight_offsets[query_terms['compare_field']] = vectors[query_terms['compare_field']].offsets()
                     highlighted_words = set(query_terms['q'].split())
                     for highlight in hit['highlight'][s_field]:
                         for m in re.finditer(r'{}(\w+){}'.format(PRE_TAGS, POST_TAGS), highlight):
@@ -292,77 +508,42 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
                                     terms.update(fuzz_terms)
                             for w in terms:
                                 if s_field == 'lemmas':
-                                    if w in vectors['lemmas']['terms']:
-                                        positions[token] += [i['position'] for i in vectors['lemmas']['terms'][w]['tokens']]
+                                    positions[token] += vectors['lemmas'].positions_of(w)
                                     for other_lem in nemo_app.lem_to_lem_mapping.get(w, {}):
-                                        if other_lem in vectors['lemmas']['terms']:
-                                            positions[token] += [i['position'] for i in vectors['lemmas']['terms'][other_lem]['tokens']]
+                                        positions[token] += vectors['lemmas'].positions_of(other_lem)
                                     positions[token] = sorted(positions[w])
                                 else:
-                                    if w in vectors[s_field]['terms']:
-                                        positions[token] += [i['position'] for i in vectors[s_field]['terms'][w]['tokens']]
-                        search_range_start = int(query_terms['slop']) + len(q_words)
-                        search_range_end = int(query_terms['slop']) + len(q_words) + 1
-                        if query_terms['ordered_terms']:
-                            search_range_start = -1
-                        for pos in positions[q_words[0]]:
-                            index_range = range(max(pos - search_range_start - 1, 0), pos + search_range_end + 1)
-                            used_q_words = {q_words[0]}
-                            matching_positions = [[pos]]
-                            # This now works for 'non est incognetum' in Angers 5 'HIC EST Dum non est incognetum'
-                            # Need to write a test for it
-                            for w in q_words[1:]:
-                                this_pos = list()
-                                for next_pos in positions[w]:
-                                    if next_pos in index_range and next_pos not in this_pos:
-                                        this_pos.append(next_pos)
-                                        used_q_words.add(w)
-                                matching_positions.append(this_pos)
-                            for span in product(*matching_positions):
-                                span = set(span)
-                                compare_true = True
-                                if query_terms['compare_term']:
-                                    compare_true = False
-                                    for position in span:
-                                        if highlight_offsets[query_terms['compare_field']][position][-1] in query_terms['compare_term'] + [x for y in query_terms['compare_term'] for x in nemo_app.lem_to_lem_mapping.get(y, None)]:
-                                            compare_true = True
-                                            break
-                                if set(q_words) == used_q_words and len(span) == len(q_words) and compare_true:
-                                    ordered_span = sorted(span)
-                                    if (ordered_span[-1] - ordered_span[0]) - (len(ordered_span) - 1) <= int(query_terms['slop']):
-                                        hit_highlight_positions.append(ordered_span)
-                                        start_offsets = [highlight_offsets[highlight_field][x][0] for x in ordered_span]
-                                        end_offsets = [highlight_offsets[highlight_field][x][1] - 1 for x in ordered_span]
-                                        start_index = highlight_offsets[highlight_field][max(0, ordered_span[0] - 10)][0]
-                                        end_index = highlight_offsets[highlight_field][min(len(highlight_offsets[highlight_field]) - 1, ordered_span[-1] + 10)][1] + 1
-                                        sentence = ''
-                                        for i, x in enumerate(text[start_index:end_index]):
-                                            if i + start_index in start_offsets and i + start_index in end_offsets:
-                                                sentence += PRE_TAGS + x + POST_TAGS
-                                            elif i + start_index in start_offsets:
-                                                sentence += PRE_TAGS + x
-                                            elif i + start_index in end_offsets:
-                                                sentence += x + POST_TAGS
-                                            else:
-                                                sentence += x
-                                        marked_sent = Markup(sentence)
-                                        if marked_sent not in sentences:
-                                            sentences.append(marked_sent)
-                                            sentence_spans.append(range(max(0, ordered_span[0] - 10),
-                                                                        min(len(highlight_offsets[highlight_field]), ordered_span[-1] + 11)))
+                                    positions[token] += vectors[s_field].positions_of(w)
+                        span_filter = None
+                        if query_terms['compare_term']:
+                            def span_filter(span):
+                                for position in span:
+                                    if highlight_offsets[query_terms['compare_field']][position][-1] in query_terms['compare_term'] + [x for y in query_terms['compare_term'] for x in nemo_app.lem_to_lem_mapping.get(y, None)]:
+                                        return True
+                                return False
+                        # This now works for 'non est incognetum' in Angers 5 'HIC EST Dum non est incognetum'
+                        for ordered_span in find_spans([positions[w] for w in q_words], query_terms['slop'],
+                                                       query_terms['ordered_terms'], span_filter):
+                            hit_highlight_positions.append(ordered_span)
+                            start_offsets = [highlight_offsets[highlight_field][x][0] for x in ordered_span]
+                            end_offsets = [highlight_offsets[highlight_field][x][1] - 1 for x in ordered_span]
+                            start_index = highlight_offsets[highlight_field][max(0, ordered_span[0] - 10)][0]
+                            end_index = highlight_offsets[highlight_field][min(len(highlight_offsets[highlight_field]) - 1, ordered_span[-1] + 10)][1] + 1
+                            marked_sent = mark_snippet(text, start_index, end_index, start_offsets, end_offsets)
+                            if marked_sent not in sentences:
+                                sentences.append(marked_sent)
+                                sentence_spans.append(range(max(0, ordered_span[0] - 10),
+                                                            min(len(highlight_offsets[highlight_field]), ordered_span[-1] + 11)))
                     else:
                         terms = highlighted_words
                         positions = set()
                         for w in terms:
                             if s_field == 'lemmas':
-                                if w in vectors['lemmas']['terms']:
-                                    positions.update([i['position'] for i in vectors['lemmas']['terms'][w]['tokens']])
+                                positions.update(vectors['lemmas'].positions_of(w))
                                 for other_lem in nemo_app.lem_to_lem_mapping.get(w, {}):
-                                    if other_lem in vectors['lemmas']['terms']:
-                                        positions.update([i['position'] for i in vectors['lemmas']['terms'][other_lem]['tokens']])
+                                    positions.update(vectors['lemmas'].positions_of(other_lem))
                             else:
-                                if w in vectors[s_field]['terms']:
-                                    positions.update([i['position'] for i in vectors[s_field]['terms'][w]['tokens']])
+                                positions.update(vectors[s_field].positions_of(w))
                         hit_highlight_positions = sorted(positions)
                         for pos in hit_highlight_positions:
                             if query_terms['compare_term'] and highlight_offsets[query_terms['compare_field']][pos][-1] not in query_terms['compare_term'] + [x for y in query_terms['compare_term'] for x in nemo_app.lem_to_lem_mapping.get(y, None)]:
@@ -371,17 +552,7 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
                             end_offset = highlight_offsets[highlight_field][pos][1] - 1
                             start_index = highlight_offsets[highlight_field][max(0, pos - 10)][0]
                             end_index = highlight_offsets[highlight_field][min(len(highlight_offsets[highlight_field]) - 1, pos + 10)][1] + 1
-                            sentence = ''
-                            for i, x in enumerate(text[start_index:end_index]):
-                                if i + start_index == start_offset and i + start_index == end_offset:
-                                    sentence += PRE_TAGS + x + POST_TAGS
-                                elif i + start_index == start_offset:
-                                    sentence += PRE_TAGS + x
-                                elif i + start_index == end_offset:
-                                    sentence += x + POST_TAGS
-                                else:
-                                    sentence += x
-                            sentences.append(Markup(sentence))
+                            sentences.append(mark_snippet(text, start_index, end_index, [start_offset], [end_offset]))
                             sentence_spans.append(range(max(0, pos - 10), min(len(highlight_offsets[highlight_field]), pos + 11)))
                 elif 'regest' in s_field:
                     if show_regest is False:
@@ -389,7 +560,9 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
                     else:
                         regest_sents = [Markup(highlight_segment(x)) for x in hit['highlight'][s_field]]
                 if download_id and list_index % 500 == 0:
-                    current_app.redis.set(download_id, str(50 + floor((list_index / len(query_results['hits']['hits'])) * 50)) + '%')
+                    registry.progress(download_id, 'highlight',
+                                      50 + floor((list_index / len(query_results['hits']['hits'])) * 50),
+                                      list_index, len(query_results['hits']['hits']))
 
             ordered_sentences = list()
             ordered_sentence_spans = list()
@@ -416,7 +589,7 @@ def lem_highlight_to_text(args_plus_results: List[List[Union[str, Dict]]] = None
 
     ids = [v for v in id_dict.values()]
     if download_id:
-        current_app.redis.setex(download_id, 60, '100%')
+        registry.progress(download_id, 'highlight', 99)
     return ids, all_highlighted_terms
 
 
@@ -444,6 +617,8 @@ def advanced_query_index(corpus: list = None,
                          forgeries: str = 'include',
                          bool_operator: str = 'must',
                          qSource: str = '',
+                         paged: bool = False,
+                         manage_job: bool = True,
                          **kwargs) -> Tuple[List[Dict[str, Union[str, list, dict]]],
                                             int,
                                             dict,
@@ -453,12 +628,16 @@ def advanced_query_index(corpus: list = None,
         return [], 0, {}, []
     nemo_app = current_app.config['nemo_app']
     prev_search = None
+    g.search_timings = dict()
     if search_id:
         search_id = 'search_progress_' + search_id
+        # Background searches (formulae.search.async_search) create and finish their job themselves
+        if manage_job is True:
+            get_job_registry().create(search_id, 'search', owner=job_owner())
     old_sort = sort
     sort = build_sort_list(sort)
     if old_search is False:
-        session.pop('previous_search', None)
+        clear_previous_search()
     base_body_template = dict({"query": {"bool": {'must': []}}, "sort": sort, 'from': (page - 1) * per_page,
                                'size': per_page, 'highlight': {'number_of_fragments': 0,
                                                                'fields': {'text': {}},
@@ -471,9 +650,43 @@ def advanced_query_index(corpus: list = None,
         corpus = ['form_lit_chart']
     if special_days is None:
         special_days = []
+    result_set_cache = get_result_set_cache()
+    result_set_id = None
+    if result_set_cache.enabled and not paged and not qSource and 'elexicon' not in corpus and sort is not None:
+        result_set_id = result_set_key(dict(query_dict=query_dict, year=year, month=month, day=day,
+                                            year_start=year_start, month_start=month_start, day_start=day_start,
+                                            year_end=year_end, month_end=month_end, day_end=day_end,
+                                            date_plus_minus=date_plus_minus, exclusive_date_range=exclusive_date_range,
+                                            composition_place=composition_place, special_days=special_days,
+                                            source=source, forgeries=forgeries, bool_operator=bool_operator),
+                                       nemo_app.check_project_team() is True)
+        with timed('result_set'):
+            found, result_set = result_set_cache.get(result_set_id)
+            # A result set with per_page results may have been cut off, so it cannot be re-sorted or restricted
+            results = restrict_result_set(result_set, corpus) \
+                if found and len(result_set['results']) < per_page else None
+            all_docs = facet_aggregations(corpus)[1] if results is not None else None
+            if all_docs is not None:
+                # Another sort order or a part of the corpus of an earlier search: only the _source of the hits is
+                # requested from Elasticsearch
+                table = results_table(results)
+                ids = sort_results(results, old_sort, table)
+                ids = expand_result_set(ids, fetch_sources(corpus, [x['id'] for x in ids]))
+                g.highlighted_terms = result_set['highlighted_terms']
+                aggregations = complete_aggregations(corpus, table.aggregations([x['id'] for x in ids]), all_docs)
+        if all_docs is not None:
+            if search_id and manage_job is True:
+                get_job_registry().finish(search_id)
+            return ids, len(ids), aggregations, ids if old_search is False else None
     search_highlight = set()
     args_plus_results = list()
     searched_templates = list()
+    part_templates = list()
+    part_queries = list()
+    part_calls = list()
+    pending_expansions = list()
+    all_hits = None
+    inline_aggs = None
 
     # Function to control the replacement of uu, vu, vv, uv, and w when in brackets
     def repl(m):
@@ -486,13 +699,16 @@ def advanced_query_index(corpus: list = None,
         second = 'w|uu|vu|uv|vv'
         third = '|[' + m.group(2) + m.group(3) + ']'
         return '(' + ''.join([first, second, third]) + ')'
+    if 'elexicon' in corpus:
+        corpus = ['elexicon']
+    # The facets are only counted for the results page, not for the autocomplete suggestions (qSource)
+    agg_request, all_docs = facet_aggregations(corpus) if not qSource else (AGGREGATIONS, None)
     if 'elexicon' in corpus:
         elex_search = deepcopy(base_body_template)
         elex_search['highlight'] = {'fields': {'text': {}},
                                     'pre_tags': [PRE_TAGS],
                                     'post_tags': [POST_TAGS],
                                     'encoder': 'html'}
-        corpus = ['elexicon']
         clauses = []
         for query_key, query_vals in query_dict.items():
             query_clauses = []
@@ -667,19 +883,9 @@ def advanced_query_index(corpus: list = None,
                                 else:
                                     term_fuzz = int(query_vals['fuzziness']) if query_vals['fuzziness'] else 0
                                 if term_fuzz != 0:
-                                    suggest_body = {'suggest':
-                                                        {'fuzzy_suggest':
-                                                             {'text': term,
-                                                              'term':
-                                                                  {'field': query_vals['search_field'],
-                                                                   'suggest_mode': 'always',
-                                                                   'max_edits': term_fuzz,
-                                                                   'min_word_length': 3,
-                                                                   'max_term_freq': 20000}}}}
-                                    suggests = current_app.elasticsearch.search(index=corpus, **suggest_body)
-                                    if 'suggest' in suggests:
-                                        for s in suggests['suggest']['fuzzy_suggest'][0]['options']:
-                                            words.append(re.sub(r'[ij]', '[ij]', re.sub(r'(?<![uv])[uv](?![uv])', r'[uv]', re.sub(r'w|uu|uv|vu|vv', '(w|uu|vu|uv|vv)', s['text']))))
+                                    # The suggested terms are added to sub_clauses once all suggestions have been fetched
+                                    pending_expansions.append(((term, query_vals['search_field'], term_fuzz),
+                                                               sub_clauses, exclude_ending))
                                 for w in words:
                                     sub_clauses['span_or']['clauses'].append({'span_multi': {'match': {'regexp': {query_vals['search_field']: {
                                         'value': w + exclude_ending, 'flags': 'ALL', 'case_insensitive': True}}}}})
@@ -706,8 +912,59 @@ def advanced_query_index(corpus: list = None,
             #     search_part_template['query']['bool']['must'].append({'bool': {'should': bool_clauses, 'minimum_should_match': 1}})
 
             searched_templates.append(search_part_template)
+            part_queries.append((query_key, query_vals, search_part_template))
 
-            args_plus_results.append([query_vals, current_app.elasticsearch.search(index=corpus, **search_part_template)])
+            if paged and not qSource:
+                # Only the ids are needed to combine the results of the different queries
+                part_templates.append(search_part_template)
+                part_calls.append((query_vals, search_all_hits, (corpus, search_part_template), {}))
+            else:
+                part_calls.append((query_vals, current_app.elasticsearch.search, (), dict(index=corpus, **search_part_template)))
+
+        if pending_expansions:
+            with timed('suggest'):
+                expansions = fuzzy_expansions(corpus, [x[0] for x in pending_expansions])
+            for expansion_key, sub_clauses, exclude_ending in pending_expansions:
+                for suggestion in expansions[expansion_key]:
+                    w = re.sub(r'[ij]', '[ij]', re.sub(r'(?<![uv])[uv](?![uv])', r'[uv]', re.sub(r'w|uu|uv|vu|vv', '(w|uu|vu|uv|vv)', suggestion)))
+                    sub_clauses['span_or']['clauses'].append({'span_multi': {'match': {'regexp': {expansion_key[1]: {
+                        'value': w + exclude_ending, 'flags': 'ALL', 'case_insensitive': True}}}}})
+        combined_hits = None
+        if current_app.config.get('SEARCH_COMBINED_QUERY') and len(part_queries) > 1 and not qSource:
+            combined_body = combine_queries(base_body_template, part_queries, bool_operator)
+            search_fields = [x[1]['search_field'] for x in part_queries]
+            with timed('queries'):
+                # The highlighting of the must_not clauses is ignored, so only 'must' and 'should' queries on the same
+                # field cannot be told apart in the highlighting of a single response
+                if not paged and (bool_operator == 'must_not' or len(set(search_fields)) == len(search_fields)):
+                    part_results = [{'hits': {'hits': x}} for x in split_combined_hits(
+                        current_app.elasticsearch.search(index=corpus, **combined_body)['hits']['hits'], part_queries)]
+                elif paged:
+                    # The combined hits are all results, so the facets are requested with them
+                    combined_hits, inline_aggs = search_all_hits_and_aggs(corpus, combined_body, agg_request)
+                    part_results = [{'hits': {'hits': x}} for x in split_combined_hits(combined_hits, part_queries)]
+                else:
+                    combined_hits = search_all_hits(corpus, combined_body)
+                    part_results = [{'hits': {'hits': x}} for x in split_combined_hits(combined_hits, part_queries)]
+                    # Fetch the highlighted hits of every query separately, but only those that are kept
+                    part_ids = [[h['_id'] for h in r['hits']['hits']][(page - 1) * per_page:page * per_page]
+                                for r in part_results]
+                    fetched = iter(run_all([(current_app.elasticsearch.search, (), dict(index=corpus, **page_body(x[2], ids)))
+                                            for x, ids in zip(part_queries, part_ids) if ids]))
+                    part_results = [next(fetched) if ids else {'hits': {'hits': []}} for ids in part_ids]
+            for x, r in zip(part_queries, part_results):
+                args_plus_results.append([x[1], r])
+        else:
+            # The queries do not depend on each other and are sent concurrently if there is a search thread pool
+            with timed('queries'):
+                if part_templates and len(part_calls) == 1:
+                    # The hits of a single query are all results, so the facets are requested with them
+                    hits, inline_aggs = search_all_hits_and_aggs(corpus, part_templates[0], agg_request)
+                    part_results = [hits]
+                else:
+                    part_results = run_all([c[1:] for c in part_calls])
+            for call, r in zip(part_calls, part_results):
+                args_plus_results.append([call[0], {'hits': {'hits': r}} if part_templates else r])
 
         if args_plus_results:
             combined_results = list()
@@ -737,6 +994,26 @@ def advanced_query_index(corpus: list = None,
                     # If bool_operator is should, all results from all searches should be used
                     else:
                         shared_ids.update(*combined_results[1:])
+            if part_templates:
+                with timed('pages'):
+                    if combined_hits is not None:
+                        all_hits = combined_hits
+                    elif len(args_plus_results) == 1:
+                        all_hits = args_plus_results[0][1]['hits']['hits']
+                    else:
+                        all_hits, inline_aggs = search_all_hits_and_aggs(
+                            corpus, {'query': {'ids': {'values': sorted(x[0] for x in shared_ids)}}, 'sort': sort}, agg_request)
+                    page_hits = all_hits[(page - 1) * per_page:page * per_page]
+                    page_ids = [h['_id'] for h in page_hits]
+                    shared_ids = {(h['_id'], h['_index']) for h in page_hits}
+                    # The must_not operator only keeps the results of the first query
+                    if page_ids:
+                        page_results = run_all([(current_app.elasticsearch.search, (), dict(index=corpus, **page_body(template, page_ids)))
+                                                for template in part_templates[:len(args_plus_results)]])
+                    else:
+                        page_results = [{'hits': {'hits': []}} for _template in part_templates[:len(args_plus_results)]]
+                    for i, r in enumerate(page_results):
+                        args_plus_results[i][1] = r
             first = []
             second = []
             for q_v, q_r in args_plus_results:
@@ -745,9 +1022,26 @@ def advanced_query_index(corpus: list = None,
                 else:
                     second.append(q_r)
             search = first + second
+        elif paged and not qSource:
+            searched_templates.append(base_body_template)
+            all_hits, inline_aggs = search_all_hits_and_aggs(corpus, base_body_template, agg_request)
+            page_ids = [h['_id'] for h in all_hits[(page - 1) * per_page:page * per_page]]
+            search = [current_app.elasticsearch.search(index=corpus, **page_body(base_body_template, page_ids))
+                      if page_ids else {'hits': {'hits': []}}]
         else:
             searched_templates.append(base_body_template)
             search = [current_app.elasticsearch.search(index=corpus, **base_body_template)]
+    agg_future = None
+    agg_ids = None
+    # With a cached 'all_docs' aggregation, the facets of the hits can be counted in the document attribute table
+    doc_attributes = get_doc_attributes() if not qSource and inline_aggs is None and all_docs is not None else None
+    if not qSource and args_plus_results and inline_aggs is None and doc_attributes is None \
+            and get_search_executor() is not None:
+        # The aggregations are requested while the hits are highlighted. They are requested again below if hits without
+        # highlighted sentences have been dropped.
+        agg_ids = [h['_id'] for h in all_hits] if all_hits is not None else sorted(x[0] for x in shared_ids)
+        agg_future = submit(current_app.elasticsearch.search, index=corpus,
+                            **{'query': {'ids': {'values': agg_ids}}, 'size': 0, 'aggs': agg_request})
     if qSource:
         ids = [{'id': hit['_id'],
                 'info': hit['_source'],
@@ -778,19 +1072,45 @@ def advanced_query_index(corpus: list = None,
         # implement the process below depending on what the key is
         # Change the highlight parameters for each field to include number_of_fragments: 0. That will return the whole field
         # Then lem_highlight_to_text will just need to find the position of the highlighted terms and then transfer if need be
-        ids, g.highlighted_terms = lem_highlight_to_text(args_plus_results=args_plus_results,
-                                                         result_ids=shared_ids,
-                                                         download_id=search_id)
+        with timed('highlight'):
+            ids, g.highlighted_terms = lem_highlight_to_text(args_plus_results=args_plus_results,
+                                                             result_ids=shared_ids,
+                                                             download_id=search_id)
+        if all_hits is not None:
+            hit_order = {h['_id']: i for i, h in enumerate(all_hits)}
+            ids.sort(key=lambda x: hit_order.get(x['id'], len(hit_order)))
     else:
         ids = [{'id': hit['_id'], 'info': hit['_source'], 'sents': [], 'regest_sents': [], 'highlight': []}
                for hit in search[0]['hits']['hits']]
     aggregations = {}
     if not qSource:
-        if old_search is False:
+        all_ids = [x['id'] for x in ids]
+        if all_hits is not None:
+            # The hits that are not on the current page only carry their title for the navigation between results
+            page_results = {x['id']: x for x in ids}
+            all_ids = [h['_id'] for h in all_hits]
+            if old_search is False:
+                prev_search = [page_results.get(h['_id'], {'id': h['_id'], 'info': h.get('_source', {}), 'sents': [],
+                                                           'regest_sents': [], 'highlight': []})
+                               for h in all_hits]
+        elif old_search is False:
             prev_search = ids
-        agg_search_body = {'query': {'ids': {'values': [x['id'] for x in ids]}}, 'size': 0, 'aggs': AGGREGATIONS}
-        aggregations = current_app.elasticsearch.search(index=corpus,
-                                                        **agg_search_body)['aggregations']
+        agg_search_body = {'query': {'ids': {'values': all_ids}}, 'size': 0, 'aggs': agg_request}
+        with timed('aggregations'):
+            if inline_aggs is not None:
+                aggregations = inline_aggs
+            elif doc_attributes is not None and doc_attributes.covers(all_ids):
+                aggregations = doc_attributes.aggregations(all_ids)
+            elif agg_future is not None and set(agg_ids) == set(all_ids):
+                aggregations = agg_future.result()['aggregations']
+            else:
+                aggregations = current_app.elasticsearch.search(index=corpus,
+                                                                **agg_search_body)['aggregations']
+        aggregations = complete_aggregations(corpus, aggregations, all_docs)
+    if result_set_id is not None and len(ids) < per_page:
+        # Only complete result sets are stored: the first per_page hits in one sort order are not those in another
+        result_set_cache.set(result_set_id, {'corpus': corpus, 'results': compact_result_set(ids),
+                                             'highlighted_terms': getattr(g, 'highlighted_terms', set())})
     if current_app.config["SAVE_REQUESTS"]:
         q = []
         for k in ('q_1', 'q_2', 'q_3', 'q_4'):
@@ -825,7 +1145,10 @@ def advanced_query_index(corpus: list = None,
         fake.save_ids([{"id": x['id']} for x in ids])
         fake.save_response(search)
         fake.save_aggs(aggregations)
-    return ids, len(ids), aggregations, prev_search
+    current_app.logger.debug('Search timings (ms): {}'.format(', '.join('{}: {:.1f}'.format(k, v) for k, v in g.search_timings.items())))
+    if search_id and manage_job is True:
+        get_job_registry().finish(search_id)
+    return ids, len(ids) if all_hits is None else len(all_hits), aggregations, prev_search
 
 
 def build_spec_date_range_template(spec_year_start, spec_month_start, spec_day_start, spec_year_end, spec_month_end,
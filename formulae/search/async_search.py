@@ -0,0 +1,98 @@
+import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from typing import Any, Dict, Tuple, Union
+
+from flask import current_app, copy_current_request_context
+from redis.exceptions import RedisError
+
+from .Search import advanced_query_index
+from formulae.services.job_service import JobCancelled, get_job_registry, job_owner
+
+
+ASYNC_SEARCH_NAMESPACE = 'formulae:async_search'
+# The id of the job of a background search is this prefix followed by its key
+ASYNC_SEARCH_JOB_PREFIX = 'search_progress_async_'
+
+
+def async_search_key(search_args: Dict[str, Any], project_team: bool) -> str:
+    """ The key of a background search. Searches with the same arguments by users with the same access to the texts
+    have the same key, so that they are only run once, e.g., when the same search is opened in several tabs.
+
+    :param search_args: the arguments for advanced_query_index
+    :param project_team: whether the user belongs to the project team
+    :return: the key
+    """
+    args = {k: v for k, v in search_args.items() if k != 'search_id'}
+    return sha256(json.dumps([args, project_team], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_async_search_executor() -> ThreadPoolExecutor:
+    """ The thread pool of this worker for background searches, created on first use. It is kept apart from the pool
+    for the sub-queries of a search (formulae.search.executor), because the background searches wait for those.
+
+    :return: the executor
+    """
+    executor = current_app.extensions.get('async_search_executor')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=current_app.config.get('ASYNC_SEARCH_WORKERS', 1),
+                                      thread_name_prefix='async_search')
+        current_app.extensions['async_search_executor'] = executor
+    return executor
+
+
+def run_search(key: str, search_args: Dict[str, Any]):
+    """ Runs a background search and stores its results in Redis for ASYNC_SEARCH_TIMEOUT seconds. Its job is only
+    marked as done once the results are stored, so that the page that polls for them finds them when it reloads.
+    It runs in a thread of the background search executor in a copy of the context of the request that started it.
+
+    :param key: the key of the search as returned by async_search_key
+    :param search_args: the arguments for advanced_query_index
+    """
+    store_key = '{}:{}'.format(ASYNC_SEARCH_NAMESPACE, key)
+    job_id = ASYNC_SEARCH_JOB_PREFIX + key
+    registry = get_job_registry()
+    try:
+        # The search may have been cancelled while it was waiting for a thread
+        registry.check_cancelled(job_id)
+        results = advanced_query_index(**search_args, manage_job=False)
+        current_app.redis.setex(store_key, current_app.config.get('ASYNC_SEARCH_TIMEOUT', 600),
+                                pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL))
+        registry.finish(job_id)
+    except JobCancelled:
+        pass
+    except Exception as E:
+        current_app.logger.exception('The background search {} failed'.format(key))
+        registry.fail(job_id, str(E))
+    finally:
+        # Without the lock, the next request for these results starts the search again if they have not been stored
+        current_app.redis.delete(store_key + ':lock')
+
+
+def async_search(search_args: Dict[str, Any]) -> Tuple[Union[tuple, None], str]:
+    """ The results of a search that is run in the background. The first request for a search starts it in the
+    background search executor. Later requests, also from other workers, get the results when they are ready. While the
+    search is running, its progress can be read from the job with the returned id. If Redis cannot be reached, the
+    search is run in the request.
+
+    :param search_args: the arguments for advanced_query_index
+    :return: the results as returned by advanced_query_index or None if they are not ready yet, and the id of the job
+    """
+    key = async_search_key(search_args, current_app.config['nemo_app'].check_project_team() is True)
+    job_id = ASYNC_SEARCH_JOB_PREFIX + key
+    store_key = '{}:{}'.format(ASYNC_SEARCH_NAMESPACE, key)
+    registry = get_job_registry()
+    try:
+        data = current_app.redis.get(store_key)
+        if data is not None:
+            return pickle.loads(data), job_id
+        # Only the request that gets the lock starts the search
+        if current_app.redis.set(store_key + ':lock', job_id, nx=True, ex=registry.timeout):
+            registry.create(job_id, 'search', state='queued', owner=job_owner())
+            get_async_search_executor().submit(copy_current_request_context(run_search), key,
+                                               dict(search_args, search_id=job_id[len('search_progress_'):]))
+    except RedisError as E:
+        current_app.logger.warning('Unable to run the search in the background: {}'.format(E))
+        return advanced_query_index(**search_args), job_id
+    return None, job_id
@@ -0,0 +1,403 @@
+import os
+import pickle
+import tempfile
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+from flask import current_app
+from elasticsearch import ApiError, TransportError
+
+from .token_store import TOKEN_INDICES, current_index_key, file_version, token_store_key
+
+
+DOC_ATTRIBUTES_VERSION = 1
+DOC_ATTRIBUTES_PREFIX = 'doc_attributes_'
+# The fields of _source from which the attribute table is built
+DOC_ATTRIBUTE_FIELDS = ['collection', 'min_date', 'forgery', 'comp_ort', 'all_dates', 'specific_date', 'sort_prefix', 'urn']
+EPOCH = datetime(1970, 1, 1)
+# Stands for a missing date or date part in the integer columns
+MISSING = -1
+
+
+def date_number(date: Union[str, None]) -> int:
+    """ Converts a date string as stored in Elasticsearch into an integer that sorts in the same order.
+    As in Elasticsearch, a missing month or day counts as the first month or day, e.g., '0818' as '0818-01-01'.
+
+    :param date: the date, e.g., '0769-04-20'
+    :return: the date as yyyymmdd, e.g., 7690420, or MISSING if there is no valid date
+    """
+    if not date:
+        return MISSING
+    parts = date[:10].split('-') + ['1', '1']
+    try:
+        return int(parts[0]) * 10000 + int(parts[1]) * 100 + int(parts[2])
+    except ValueError:
+        return MISSING
+
+
+def year_millis(year: int) -> float:
+    """ The start of a year in milliseconds since the epoch, as in the buckets of a date_range aggregation
+
+    :param year: the year
+    :return: the milliseconds
+    """
+    return (datetime(year, 1, 1) - EPOCH).total_seconds() * 1000
+
+
+class DocAttributes(object):
+    """ The attributes of all indexed documents that are needed to count facets and to sort and filter results,
+    stored column by column in parallel arrays. Row i of every column belongs to the document ids[i].
+
+    The aggregations and sort orders that are computed here are the same as those of the corresponding
+    Elasticsearch requests, i.e., of AGGREGATIONS and of build_sort_list.
+
+    :param ids: the id of every document
+    :param collections: the distinct collections
+    :param collection_ids: the index of the collection of every document in collections
+    :param comp_orts: the distinct places of composition
+    :param comp_ort_ids: the index of the place of composition of every document in comp_orts
+    :param min_dates: the min_date of every document as date_number
+    :param first_dates: the earliest of the all_dates of every document as date_number
+    :param last_dates: the latest of the all_dates of every document as date_number
+    :param forgeries: 1 for forgeries, 0 for other documents and MISSING if the field is not set
+    :param sort_prefixes: the sort_prefix of every document
+    :param urns: the urn of every document
+    :param date_offsets: the specific dates of document i are found at date_offsets[i]:date_offsets[i + 1]
+    :param years: the year of every specific date
+    :param months: the month of every specific date
+    :param days: the day of every specific date
+    """
+    __slots__ = ('ids', 'collections', 'collection_ids', 'comp_orts', 'comp_ort_ids', 'min_dates', 'first_dates',
+                 'last_dates', 'forgeries', 'sort_prefixes', 'urns', 'date_offsets', 'years', 'months', 'days', 'rows')
+
+    def __init__(self, ids: Tuple[str, ...], collections: Tuple[str, ...], collection_ids: array,
+                 comp_orts: Tuple[str, ...], comp_ort_ids: array, min_dates: array, first_dates: array,
+                 last_dates: array, forgeries: array, sort_prefixes: array, urns: Tuple[str, ...],
+                 date_offsets: array, years: array, months: array, days: array):
+        self.ids = ids
+        self.collections = collections
+        self.collection_ids = collection_ids
+        self.comp_orts = comp_orts
+        self.comp_ort_ids = comp_ort_ids
+        self.min_dates = min_dates
+        self.first_dates = first_dates
+        self.last_dates = last_dates
+        self.forgeries = forgeries
+        self.sort_prefixes = sort_prefixes
+        self.urns = urns
+        self.date_offsets = date_offsets
+        self.years = years
+        self.months = months
+        self.days = days
+        self.rows = {doc_id: i for i, doc_id in enumerate(ids)}
+
+    @classmethod
+    def from_hits(cls, hits: Iterable[Dict[str, Any]]) -> 'DocAttributes':
+        """ Builds the table from search hits whose _source contains the DOC_ATTRIBUTE_FIELDS
+
+        :param hits: the hits as returned by Elasticsearch
+        :return: the attribute table
+        """
+        ids = []
+        collections = {}
+        comp_orts = {}
+        columns = {k: [] for k in ('collection_ids', 'comp_ort_ids', 'min_dates', 'first_dates', 'last_dates',
+                                   'forgeries', 'sort_prefixes', 'urns', 'years', 'months', 'days')}
+        date_offsets = [0]
+        for hit in hits:
+            source = hit.get('_source', {})
+            ids.append(hit['_id'])
+            columns['collection_ids'].append(collections.setdefault(source.get('collection', ''), len(collections)))
+            comp_ort = source.get('comp_ort', '')
+            if isinstance(comp_ort, list):
+                comp_ort = tuple(comp_ort)
+            columns['comp_ort_ids'].append(comp_orts.setdefault(comp_ort, len(comp_orts)))
+            min_date = source.get('min_date')
+            if isinstance(min_date, list):
+                min_date = min(min_date) if min_date else None
+            columns['min_dates'].append(date_number(min_date))
+            all_dates = source.get('all_dates') or []
+            if isinstance(all_dates, str):
+                all_dates = [all_dates]
+            all_dates = [d for d in (date_number(x) for x in all_dates) if d != MISSING]
+            columns['first_dates'].append(min(all_dates) if all_dates else MISSING)
+            columns['last_dates'].append(max(all_dates) if all_dates else MISSING)
+            forgery = source.get('forgery')
+            columns['forgeries'].append(MISSING if forgery is None else int(bool(forgery)))
+            columns['sort_prefixes'].append(int(source.get('sort_prefix', MISSING)))
+            columns['urns'].append(source.get('urn', ''))
+            specific_dates = source.get('specific_date') or []
+            if isinstance(specific_dates, dict):
+                specific_dates = [specific_dates]
+            for specific_date in specific_dates:
+                for part, column in (('year', 'years'), ('month', 'months'), ('day', 'days')):
+                    value = specific_date.get(part)
+                    columns[column].append(MISSING if value in (None, '') else int(value))
+            date_offsets.append(len(columns['years']))
+        return cls(tuple(ids), tuple(collections), array('H', columns['collection_ids']),
+                   tuple(comp_orts), array('H', columns['comp_ort_ids']),
+                   array('i', columns['min_dates']), array('i', columns['first_dates']),
+                   array('i', columns['last_dates']), array('b', columns['forgeries']),
+                   array('i', columns['sort_prefixes']), tuple(columns['urns']),
+                   array('I', date_offsets), array('h', columns['years']),
+                   array('b', columns['months']), array('b', columns['days']))
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in self.__slots__ if k != 'rows')
+
+    def __setstate__(self, state):
+        for k, v in zip([k for k in self.__slots__ if k != 'rows'], state):
+            setattr(self, k, v)
+        self.rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.rows
+
+    def covers(self, ids: Iterable[str]) -> bool:
+        """ Whether every document is in the table
+
+        :param ids: the document ids
+        :return: True if all of them are in the table
+        """
+        rows = self.rows
+        return all(doc_id in rows for doc_id in ids)
+
+    def aggregations(self, ids: Iterable[str]) -> Dict[str, Any]:
+        """ Counts the facets of FACET_AGGREGATIONS for a set of documents in the same form as Elasticsearch
+
+        :param ids: the document ids, which must all be in the table
+        :return: the 'range', 'corpus', 'no_date' and 'forgeries' aggregations
+        """
+        from .Search import corpus_agg, range_agg
+        rows = [self.rows[doc_id] for doc_id in set(ids)]
+        collection_counts = [0] * len(self.collections)
+        collection_ids = self.collection_ids
+        for i in rows:
+            collection_counts[collection_ids[i]] += 1
+        collections = {c: collection_counts[i] for i, c in enumerate(self.collections)}
+        min_dates = [d for d in (self.min_dates[i] for i in rows) if d != MISSING]
+        ranges = []
+        for date_range in range_agg['date_range']['ranges']:
+            bucket = {'key': date_range['key'], 'doc_count': 0}
+            low = high = None
+            if 'from' in date_range:
+                bucket.update({'from': year_millis(int(date_range['from'])), 'from_as_string': date_range['from']})
+                low = int(date_range['from']) * 10000 + 101
+            if 'to' in date_range:
+                bucket.update({'to': year_millis(int(date_range['to'])), 'to_as_string': date_range['to']})
+                high = int(date_range['to']) * 10000 + 101
+            bucket['doc_count'] = sum(1 for d in min_dates if (low is None or d >= low) and (high is None or d < high))
+            ranges.append(bucket)
+        return {'range': {'buckets': ranges},
+                'corpus': {'buckets': {name: {'doc_count': collections.get(f['match']['collection'], 0)}
+                                       for name, f in corpus_agg['filters']['filters'].items()}},
+                'no_date': {'doc_count': len(rows) - len(min_dates)},
+                'forgeries': {'doc_count': sum(1 for i in rows if self.forgeries[i] == 1)}}
+
+    def sort_ids(self, ids: Iterable[str], sort_str: str) -> List[str]:
+        """ Sorts documents in the order of the Elasticsearch sort that build_sort_list returns for sort_str.
+        As in Elasticsearch, documents without a value for the first sort field come last.
+
+        :param ids: the document ids, which must all be in the table
+        :param sort_str: 'urn', 'urn_desc', 'min_date_asc', 'min_date_desc', 'max_date_asc' or 'max_date_desc'
+        :return: the sorted ids
+        """
+        rows = self.rows
+        urns = self.urns
+        if sort_str in ('urn', 'urn_desc'):
+            prefixes = self.sort_prefixes
+            # ids is sorted twice because the urns are only reversed within the same sort_prefix
+            ids = sorted(ids, key=lambda x: urns[rows[x]], reverse=sort_str == 'urn_desc')
+            return sorted(ids, key=lambda x: (prefixes[rows[x]] == MISSING, prefixes[rows[x]]))
+        if sort_str not in ('min_date_asc', 'min_date_desc', 'max_date_asc', 'max_date_desc'):
+            raise ValueError('Unknown sort order {}'.format(sort_str))
+        dates = self.first_dates if sort_str.startswith('min') else self.last_dates
+        factor = -1 if sort_str.endswith('desc') else 1
+        return sorted(ids, key=lambda x: (dates[rows[x]] == MISSING, factor * dates[rows[x]], urns[rows[x]]))
+
+    def facet_filter(self, ids: Iterable[str], facet: str, key: str = '') -> List[str]:
+        """ Keeps the documents that are counted in one bucket of the aggregations
+
+        :param ids: the document ids, which must all be in the table
+        :param facet: 'corpus', 'range', 'no_date' or 'forgeries'
+        :param key: the key of the bucket for 'corpus' and 'range'
+        :return: the ids in the bucket in their original order
+        """
+        from .Search import corpus_agg, range_agg
+        rows = self.rows
+        if facet == 'no_date':
+            return [x for x in ids if self.min_dates[rows[x]] == MISSING]
+        if facet == 'forgeries':
+            return [x for x in ids if self.forgeries[rows[x]] == 1]
+        if facet == 'corpus':
+            collection = corpus_agg['filters']['filters'][key]['match']['collection']
+            if collection not in self.collections:
+                return []
+            collection_id = self.collections.index(collection)
+            return [x for x in ids if self.collection_ids[rows[x]] == collection_id]
+        if facet == 'range':
+            date_range = [r for r in range_agg['date_range']['ranges'] if r['key'] == key][0]
+            low = int(date_range['from']) * 10000 + 101 if 'from' in date_range else None
+            high = int(date_range['to']) * 10000 + 101 if 'to' in date_range else None
+            return [x for x in ids if self.min_dates[rows[x]] != MISSING
+                    and (low is None or self.min_dates[rows[x]] >= low)
+                    and (high is None or self.min_dates[rows[x]] < high)]
+        raise ValueError('Unknown facet {}'.format(facet))
+
+    def filter_forgeries(self, ids: Iterable[str], forgeries: str) -> List[str]:
+        """ Applies the forgeries option of the advanced search
+
+        :param ids: the document ids, which must all be in the table
+        :param forgeries: 'include', 'exclude' or 'only'
+        :return: the remaining ids in their original order
+        """
+        if forgeries == 'include':
+            return list(ids)
+        wanted = 1 if forgeries == 'only' else 0
+        return [x for x in ids if self.forgeries[self.rows[x]] == wanted]
+
+    def filter_specific_date_range(self, ids: Iterable[str], year_start: int = 0, month_start: int = 0,
+                                   day_start: int = 0, year_end: int = 0, month_end: int = 0,
+                                   day_end: int = 0) -> List[str]:
+        """ Applies the exclusive date range of the advanced search, i.e., the query of build_spec_date_range_template.
+        A document matches if one of its specific dates lies within the range.
+
+        :param ids: the document ids, which must all be in the table
+        :param year_start: the beginning year in which to search
+        :param month_start: the beginning month to search within each year in the year range
+        :param day_start: the beginning day in which to search within each month in the month range
+        :param year_end: the ending year in which to search
+        :param month_end: the ending month to search within each year in the year range
+        :param day_end: the ending day to search within each month in the month range
+        :return: the remaining ids in their original order
+        """
+        undated = (year_start or year_end) and year_end != year_start and not month_end and not month_start \
+            and not day_start and not day_end
+        year_start = year_start or 0
+        year_end = year_end or 2000
+        month_start = month_start or 1
+        month_end = month_end or 12
+        day_start = day_start or 1
+        day_end = day_end or 31
+
+        def date_matches(year: int, month: int, day: int) -> bool:
+            if undated and year == 1:
+                return True
+            if year == MISSING or not year_start <= year <= year_end or month == MISSING or day == MISSING:
+                return False
+            if month_start != month_end:
+                return (month == month_start and day >= day_start) or month_start < month < month_end \
+                    or (month == month_end and day <= day_end)
+            return month == month_end and day_start <= day <= day_end
+
+        offsets = self.date_offsets
+        result = []
+        for doc_id in ids:
+            i = self.rows[doc_id]
+            if any(date_matches(self.years[j], self.months[j], self.days[j]) for j in range(offsets[i], offsets[i + 1])):
+                result.append(doc_id)
+        return result
+
+
+def doc_attributes_path(attribute_folder: str, key: str) -> str:
+    """ The file in which the attribute table for a certain index fingerprint is stored
+
+    :param attribute_folder: the folder for attribute tables (``DOC_ATTRIBUTE_FOLDER``)
+    :param key: the fingerprint of the indices as returned by token_store_key
+    :return: the path to the table file
+    """
+    return os.path.join(attribute_folder, '{}{}.pickle'.format(DOC_ATTRIBUTES_PREFIX, key))
+
+
+def load_doc_attributes(attribute_folder: str, key: str) -> Union[DocAttributes, None]:
+    """ Loads the attribute table if one exists for the current index fingerprint
+
+    :param attribute_folder: the folder for attribute tables
+    :param key: the fingerprint of the indices
+    :return: the table or None if there is no valid table for this fingerprint
+    """
+    path = doc_attributes_path(attribute_folder, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if not isinstance(saved, dict) or saved.get('version') != DOC_ATTRIBUTES_VERSION or saved.get('key') != key:
+        return None
+    return saved['table']
+
+
+def save_doc_attributes(attribute_folder: str, key: str, table: DocAttributes) -> str:
+    """ Atomically writes the attribute table and removes the tables of older index fingerprints
+
+    :param attribute_folder: the folder for attribute tables
+    :param key: the fingerprint of the indices
+    :param table: the attribute table
+    :return: the path of the written table
+    """
+    os.makedirs(attribute_folder, exist_ok=True)
+    path = doc_attributes_path(attribute_folder, key)
+    fd, tmp_path = tempfile.mkstemp(dir=attribute_folder, prefix='.' + DOC_ATTRIBUTES_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': DOC_ATTRIBUTES_VERSION, 'key': key, 'table': table}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for old in os.listdir(attribute_folder):
+        if old.startswith(DOC_ATTRIBUTES_PREFIX) and os.path.join(attribute_folder, old) != path:
+            try:
+                os.remove(os.path.join(attribute_folder, old))
+            except OSError:
+                pass
+    return path
+
+
+def get_doc_attributes() -> Union[DocAttributes, None]:
+    """ Loads the attribute table from DOC_ATTRIBUTE_FOLDER for the current indices. The table is loaded again when the
+    indices change or when `flask build-doc-attributes` writes a new table.
+
+    :return: the table or None if DOC_ATTRIBUTE_FOLDER is not set or holds no table for the current indices
+    """
+    attribute_folder = current_app.config.get('DOC_ATTRIBUTE_FOLDER')
+    if not attribute_folder or not current_app.elasticsearch:
+        return None
+    try:
+        key = current_index_key()
+    except (ApiError, TransportError) as E:
+        current_app.logger.warning('Unable to load the document attributes: {}'.format(E))
+        return None
+    version = (key, file_version(doc_attributes_path(attribute_folder, key)))
+    loaded = current_app.extensions.get('doc_attributes')
+    if loaded is None or loaded[0] != version:
+        table = load_doc_attributes(attribute_folder, key)
+        if table is None:
+            current_app.logger.warning('There are no document attributes for the current indices in {}. '
+                                       'Run `flask build-doc-attributes` to create them.'.format(attribute_folder))
+        loaded = (version, table)
+        current_app.extensions['doc_attributes'] = loaded
+    return loaded[1]
+
+
+def build_doc_attributes(indices: List[str] = None) -> Tuple[str, int]:
+    """ Reads the attributes of every document in the indices and writes the attribute table to DOC_ATTRIBUTE_FOLDER
+
+    :param indices: the indices or aliases to read, by default TOKEN_INDICES
+    :return: the path of the table and the number of documents
+    """
+    from formulae.search.Search import search_all_hits
+    indices = list(indices or TOKEN_INDICES)
+    hits = search_all_hits(indices, {'query': {'match_all': {}}, 'sort': ['urn']}, source=DOC_ATTRIBUTE_FIELDS)
+    table = DocAttributes.from_hits(hits)
+    path = save_doc_attributes(current_app.config['DOC_ATTRIBUTE_FOLDER'], token_store_key(indices), table)
+    current_app.extensions.pop('doc_attributes', None)
+    return path, len(table)
@@ -0,0 +1,71 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from flask import current_app, g
+
+
+def get_search_executor() -> Union[ThreadPoolExecutor, None]:
+    """ The thread pool of this process for Elasticsearch requests that do not depend on each other.
+    It is created on first use, i.e., after gunicorn has forked the worker.
+
+    :return: the executor or None if SEARCH_THREADS is less than 2
+    """
+    workers = current_app.config.get('SEARCH_THREADS', 0)
+    if workers < 2:
+        return None
+    executor = current_app.extensions.get('search_executor')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='search')
+        current_app.extensions['search_executor'] = executor
+    return executor
+
+
+def submit(f: Callable, *args, **kwargs) -> Future:
+    """ Runs a function in the search thread pool inside an app context of the current app.
+    Without a thread pool, the function is run immediately and its result is returned as a finished Future.
+
+    :param f: the function to run
+    :return: the Future of the result
+    """
+    executor = get_search_executor()
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(f(*args, **kwargs))
+        except Exception as E:
+            future.set_exception(E)
+        return future
+    app = current_app._get_current_object()
+
+    def in_app_context():
+        with app.app_context():
+            return f(*args, **kwargs)
+    return executor.submit(in_app_context)
+
+
+def run_all(calls: List[Tuple[Callable, tuple, Dict[str, Any]]]) -> list:
+    """ Runs independent calls, concurrently if there is a search thread pool, and returns their results in order.
+    The first exception that is raised by a call is raised again here.
+
+    :param calls: the (function, args, kwargs) of every call
+    :return: the results of the calls
+    """
+    if len(calls) < 2 or get_search_executor() is None:
+        return [f(*args, **kwargs) for f, args, kwargs in calls]
+    return [future.result() for future in [submit(f, *args, **kwargs) for f, args, kwargs in calls]]
+
+
+@contextmanager
+def timed(phase: str):
+    """ Adds the time spent in the block to g.search_timings[phase] (in milliseconds)
+
+    :param phase: the name of the search phase, e.g., 'queries'
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('search_timings', dict())
+        timings[phase] = timings.get(phase, 0) + (perf_counter() - start) * 1000
@@ -0,0 +1,68 @@
+from typing import Dict, List, Tuple
+
+from flask import current_app
+from elasticsearch import ApiError, TransportError
+
+from .token_store import current_index_key
+from formulae.services.cache_service import TwoTierCache
+
+
+FUZZY_SUGGEST_NAMESPACE = 'formulae:fuzzy_suggest'
+# The options of the term suggester that are the same for every fuzzy term
+FUZZY_SUGGEST_OPTIONS = {'suggest_mode': 'always', 'min_word_length': 3, 'max_term_freq': 20000}
+
+
+def get_expansion_cache() -> TwoTierCache:
+    """ The cache of fuzzy term expansions, created once per process
+
+    :return: the cache
+    """
+    cache = current_app.extensions.get('fuzzy_expansion_cache')
+    if cache is None:
+        cache = TwoTierCache(current_app.redis, FUZZY_SUGGEST_NAMESPACE,
+                             max_items=current_app.config.get('FUZZY_CACHE_SIZE', 0),
+                             timeout=current_app.config.get('FUZZY_CACHE_TIMEOUT', 86400))
+        current_app.extensions['fuzzy_expansion_cache'] = cache
+    return cache
+
+
+def fuzzy_expansions(corpus: List[str], terms: List[Tuple[str, str, int]]) -> Dict[Tuple[str, str, int], List[str]]:
+    """ Finds the terms in the index that are within max_edits of each of the search terms.
+        Expansions are taken from the cache if possible. All others are requested together in a single suggest request
+        with one named term suggester per search term. The cache key contains the fingerprint of the indices, so that
+        the expansions of the old indices are not used after a reindexing.
+
+    :param corpus: the indices that are searched
+    :param terms: the (term, field, max_edits) of every search term that should be expanded
+    :return: {(term, field, max_edits): [suggested terms in the order of the suggester]}
+    """
+    cache = get_expansion_cache()
+    use_cache = cache.enabled
+    corpus_key = '+'.join(sorted(corpus))
+    if use_cache:
+        try:
+            corpus_key = '{}:{}'.format(corpus_key, current_index_key(corpus))
+        except (ApiError, TransportError) as E:
+            current_app.logger.warning('Unable to read the fingerprint of the indices: {}'.format(E))
+            use_cache = False
+    expansions = dict()
+    missing = list()
+    for term in terms:
+        if term in expansions or term in missing:
+            continue
+        found, value = cache.get(term + (corpus_key,)) if use_cache else (False, None)
+        if found:
+            expansions[term] = value
+        else:
+            missing.append(term)
+    if missing:
+        suggest_body = {'fuzzy_suggest_{}'.format(i): {'text': text,
+                                                        'term': dict(FUZZY_SUGGEST_OPTIONS, field=field, max_edits=max_edits)}
+                        for i, (text, field, max_edits) in enumerate(missing)}
+        suggests = current_app.elasticsearch.search(index=corpus, suggest=suggest_body).get('suggest', {})
+        for i, term in enumerate(missing):
+            suggested = suggests.get('fuzzy_suggest_{}'.format(i))
+            expansions[term] = [s['text'] for s in suggested[0]['options']] if suggested else []
+            if use_cache:
+                cache.set(term + (corpus_key,), expansions[term])
+    return expansions
@@ -0,0 +1,173 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from typing import Any, Callable, Dict, List, Union
+from uuid import uuid4
+
+from flask import current_app
+from redis import Redis
+from reportlab.platypus import Paragraph, SimpleDocTemplate
+from reportlab.lib.styles import getSampleStyleSheet
+
+from formulae.services.job_service import JobCancelled, JobRegistry, get_job_registry, job_owner
+
+
+# Progress is reported, and cancellation is checked, every time this many search results have been laid out
+PDF_EXPORT_CHUNK = 500
+
+
+def bold_highlighting(sentence: str) -> str:
+    """ Turns the highlighting of a search result sentence into the bold markup of ReportLab
+
+    :param sentence: the highlighted sentence
+    :return: the sentence for a Paragraph
+    """
+    return '- {}'.format(re.sub(r'(?:</small>)?<strong>(.*?)</strong>(?:<small>)?', r'<b>\1</b>', str(sentence)))
+
+
+def export_entries(results: List[Dict[str, Any]], regest_heading: str) -> List[Dict[str, Union[str, List[str]]]]:
+    """ The titles and sentences of the search results as they are written to the PDF
+
+    :param results: the results of the search
+    :param regest_heading: the translated heading of the regest sentences
+    :return: the title, text sentences and regest sentences of every result
+    """
+    entries = list()
+    for d in results:
+        r = {'title': d['info']['title'], 'sents': [], 'regest_sents': []}
+        if 'sents' in d and d['sents'] != []:
+            r['sents'] = [bold_highlighting(s) for s in d['sents']]
+        if 'regest_sents' in d and d['regest_sents'] != []:
+            r['regest_sents'] = ['<u>' + regest_heading + '</u>']
+            r['regest_sents'] += [bold_highlighting(s) for s in d['regest_sents']]
+        entries.append(r)
+    return entries
+
+
+class SearchResultsDocTemplate(SimpleDocTemplate):
+    """ A SimpleDocTemplate that reports how many search results have been laid out"""
+
+    def __init__(self, *args, progress: Callable[[int], None] = None, **kwargs):
+        super(SearchResultsDocTemplate, self).__init__(*args, **kwargs)
+        self.progress = progress
+        self.results_done = 0
+
+    def afterFlowable(self, flowable):
+        if getattr(flowable, 'search_result', False):
+            self.results_done += 1
+            if self.progress is not None and self.results_done % PDF_EXPORT_CHUNK == 0:
+                self.progress(self.results_done)
+
+
+def render_search_pdf(target, description: str, headings: List[str], arg_list: List[str],
+                      entries: List[Dict[str, Union[str, List[str]]]], progress: Callable[[int], None] = None):
+    """ Renders the search parameters and results to a PDF
+
+    :param target: the file name or file-like object the PDF is written to
+    :param description: the title of the document
+    :param headings: the translated headings of the search parameters and of the search results
+    :param arg_list: the search parameters
+    :param entries: the search results as returned by export_entries
+    :param progress: called with the number of results laid out every PDF_EXPORT_CHUNK results
+    """
+    my_doc = SearchResultsDocTemplate(target, title=description, progress=progress)
+    sample_style_sheet = getSampleStyleSheet()
+    flowables = list([Paragraph(headings[0], sample_style_sheet['Heading3'])])
+    for a in arg_list:
+        flowables.append(Paragraph(a, sample_style_sheet['Normal']))
+    flowables.append(Paragraph(headings[1], sample_style_sheet['Heading3']))
+    for p in entries:
+        title = Paragraph(p['title'], sample_style_sheet['Heading4'])
+        title.search_result = True
+        flowables.append(title)
+        for sentence in p['sents']:
+            flowables.append(Paragraph(sentence, sample_style_sheet['Normal']))
+        for r_sentence in p['regest_sents']:
+            flowables.append(Paragraph(r_sentence, sample_style_sheet['Normal']))
+    my_doc.build(flowables)
+
+
+def export_search_pdf(path: str, description: str, headings: List[str], arg_list: List[str],
+                      entries: List[Dict[str, Union[str, List[str]]]], redis_url: str, job_id: str, timeout: int):
+    """ Renders the search results to a PDF file in a worker process of the export pool.
+        The progress is reported to the export job, which is stopped if it is cancelled.
+        The file only appears under path when it is complete.
+
+    :param path: the file name of the finished PDF
+    :param redis_url: the URL of the Redis server of the job registry
+    :param job_id: the id of the export job, e.g., 'pdf_download_1234'
+    :param timeout: seconds the job is kept in Redis
+    """
+    registry = JobRegistry(Redis.from_url(redis_url), timeout=timeout)
+    total = max(len(entries), 1)
+
+    def progress(done: int):
+        registry.progress(job_id, 'render', min(int(done / total * 100), 99), done, len(entries))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        registry.progress(job_id, 'render', 0, 0, len(entries))
+        render_search_pdf(tmp_path, description, headings, arg_list, entries, progress=progress)
+        os.replace(tmp_path, path)
+    except JobCancelled:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return
+    except Exception as E:
+        registry.fail(job_id, str(E))
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+    registry.finish(job_id, result=os.path.basename(path))
+
+
+def get_export_executor() -> ProcessPoolExecutor:
+    """ The process pool of this worker for the background rendering of search results, created on first use
+
+    :return: the executor
+    """
+    executor = current_app.extensions.get('pdf_export_executor')
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=current_app.config.get('SEARCH_EXPORT_WORKERS', 1))
+        current_app.extensions['pdf_export_executor'] = executor
+    return executor
+
+
+def export_path(export_id: str) -> str:
+    """ The file name of the PDF of a background export
+
+    :param export_id: the id of the export
+    :return: the path in SEARCH_EXPORT_FOLDER
+    """
+    return os.path.join(current_app.config['SEARCH_EXPORT_FOLDER'], 'search_{}.pdf'.format(export_id))
+
+
+def remove_old_exports():
+    """ Removes the exported PDFs that are older than SEARCH_EXPORT_TIMEOUT seconds"""
+    folder = current_app.config['SEARCH_EXPORT_FOLDER']
+    oldest = time() - current_app.config.get('SEARCH_EXPORT_TIMEOUT', 3600)
+    for file_name in os.listdir(folder):
+        file_path = os.path.join(folder, file_name)
+        try:
+            if file_name.startswith('search_') and os.path.getmtime(file_path) < oldest:
+                os.remove(file_path)
+        except OSError:
+            pass
+
+
+def start_export(job_id: str, description: str, headings: List[str], arg_list: List[str],
+                 entries: List[Dict[str, Union[str, List[str]]]]) -> str:
+    """ Starts the rendering of search results in the export process pool
+
+    :param job_id: the id of the export job, e.g., 'pdf_download_1234'
+    :return: the id of the export
+    """
+    os.makedirs(current_app.config['SEARCH_EXPORT_FOLDER'], exist_ok=True)
+    remove_old_exports()
+    export_id = uuid4().hex
+    registry = get_job_registry()
+    registry.create(job_id, 'pdf_export', state='queued', total=len(entries), owner=job_owner())
+    get_export_executor().submit(export_search_pdf, export_path(export_id), description, headings, arg_list, entries,
+                                 current_app.config['REDIS_URL'], job_id, registry.timeout)
+    return export_id
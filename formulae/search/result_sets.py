@@ -0,0 +1,111 @@
+import json
+from hashlib import sha256
+from typing import Any, Dict, List, Union
+
+from flask import current_app
+
+from formulae.services.cache_service import TwoTierCache
+from .doc_attributes import DOC_ATTRIBUTE_FIELDS, DocAttributes
+
+
+RESULT_SET_NAMESPACE = 'formulae:result_sets'
+# The arguments of advanced_query_index that neither change the matching documents nor their highlighting.
+# A search that only differs from an earlier one in these arguments is answered from the earlier result set.
+RESULT_SET_IGNORED_ARGS = ('corpus', 'sort', 'page', 'per_page', 'paged', 'old_search', 'search_id')
+
+
+def get_result_set_cache() -> TwoTierCache:
+    """ The cache of the highlighted results of recent searches, created once per process
+
+    :return: the cache
+    """
+    cache = current_app.extensions.get('result_set_cache')
+    if cache is None:
+        cache = TwoTierCache(current_app.redis, RESULT_SET_NAMESPACE,
+                             max_items=current_app.config.get('RESULT_SET_CACHE_SIZE', 0),
+                             timeout=current_app.config.get('RESULT_SET_TIMEOUT', 3600))
+        current_app.extensions['result_set_cache'] = cache
+    return cache
+
+
+def result_set_key(search_args: Dict[str, Any], project_team: bool) -> str:
+    """ The key of the result set of a search
+
+    :param search_args: the arguments of advanced_query_index
+    :param project_team: whether the user is a member of the project team, who can see more regest highlighting
+    :return: the hex digest of the search arguments that define the result set
+    """
+    key_args = {k: v for k, v in search_args.items() if k not in RESULT_SET_IGNORED_ARGS}
+    key_args['project_team'] = project_team
+    return sha256(json.dumps(key_args, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def restrict_result_set(result_set: Dict[str, Any], corpus: List[str]) -> Union[List[Dict[str, Any]], None]:
+    """ The results of a stored search that belong to a corpus
+
+    :param result_set: the stored result set, i.e., {'corpus': [...], 'results': [...], 'highlighted_terms': {...}}
+    :param corpus: the indices of the new search
+    :return: the results in corpus or None if corpus is not part of the corpus of the stored search
+    """
+    if corpus == result_set['corpus']:
+        return list(result_set['results'])
+    from .Search import corpus_agg
+    collections = {f['match']['collection'] for f in corpus_agg['filters']['filters'].values()}
+    wanted = {'form_lit_chart-' + x for x in corpus}
+    if not wanted <= collections:
+        return None
+    if result_set['corpus'] != ['form_lit_chart'] and not set(corpus) <= set(result_set['corpus']):
+        return None
+    return [r for r in result_set['results'] if r['info'].get('collection') in wanted]
+
+
+def compact_result_set(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ Reduces search results to what a result set needs to restrict, sort and count them: the id, the highlighted
+    sentences with their spans and the DOC_ATTRIBUTE_FIELDS of every hit. The rest of the _source is fetched again
+    when the results are served, see expand_result_set.
+
+    :param results: the results as returned by advanced_query_index
+    :return: the compact results, whose 'info' only holds the DOC_ATTRIBUTE_FIELDS
+    """
+    return [{'id': r['id'],
+             'info': {k: r['info'][k] for k in DOC_ATTRIBUTE_FIELDS if k in r['info']},
+             'sents': r.get('sents', []),
+             'sentence_spans': r.get('sentence_spans', []),
+             'regest_sents': r.get('regest_sents', [])}
+            for r in results]
+
+
+def expand_result_set(results: List[Dict[str, Any]], sources: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ Turns compact results back into results with the keys that the readers of the results use
+
+    :param results: the results as returned by compact_result_set
+    :param sources: the _source of every hit, without the PAGE_SOURCE_EXCLUDES
+    :return: the results
+    """
+    expanded = []
+    for r in results:
+        info = sources.get(r['id'], r['info'])
+        expanded.append(dict(r, info=info, title=info.get('title', ''), highlight=r['sents']))
+    return expanded
+
+
+def results_table(results: List[Dict[str, Any]]) -> DocAttributes:
+    """ The attribute table of a list of results, which is used to sort them and to count their facets
+
+    :param results: the results as returned by advanced_query_index
+    :return: the attribute table
+    """
+    return DocAttributes.from_hits({'_id': r['id'], '_source': r['info']} for r in results)
+
+
+def sort_results(results: List[Dict[str, Any]], sort: str, table: DocAttributes = None) -> List[Dict[str, Any]]:
+    """ Sorts results in the order in which Elasticsearch returns them for a sort option
+
+    :param results: the results as returned by advanced_query_index
+    :param sort: the sort option of the search, e.g., 'min_date_asc'
+    :param table: the attribute table of the results if it has already been built
+    :return: the sorted results
+    """
+    table = table or results_table(results)
+    by_id = {r['id']: r for r in results}
+    return [by_id[doc_id] for doc_id in table.sort_ids(by_id, sort)]
@@ -0,0 +1,160 @@
+import json
+import pickle
+import zlib
+from typing import Any, Dict, List, Union
+from uuid import uuid4
+
+from flask import current_app, g, Markup, session
+from redis.exceptions import RedisError
+
+
+RESULT_STORE_NAMESPACE = 'formulae:previous_search'
+# The session only keeps this key of the results of the last search in the result store
+RESULT_STORE_SESSION_KEY = 'previous_search_key'
+# The first byte of encoded results. It must be raised, and decode_results must keep reading the older versions,
+# whenever the format of compact_results changes.
+RESULT_CODEC_VERSION = 1
+
+
+def compact_results(results: List[Dict[str, Any]]) -> List[list]:
+    """ Reduces the results of a search to what is needed to navigate between them, to highlight them in the
+    reading view and to download them: the id and title and the highlighted text and regest sentences of every hit.
+    The full _source of the hits is dropped.
+
+    :param results: the results as returned by advanced_query_index
+    :return: [id, title, sentences, sentence spans, regest sentences] for every hit
+    """
+    compact = []
+    for r in results:
+        info = r.get('info') if isinstance(r.get('info'), dict) else {}
+        compact.append([r['id'],
+                        info.get('title', r.get('title', '')),
+                        [str(s) for s in r.get('sents', [])],
+                        [[s.start, s.stop] if isinstance(s, range) else s for s in r.get('sentence_spans', [])],
+                        [str(s) for s in r.get('regest_sents', [])]])
+    return compact
+
+
+def expand_results(compact: List[list]) -> List[Dict[str, Any]]:
+    """ Turns compact results back into result dictionaries with the keys that the readers of the results use
+
+    :param compact: the results as returned by compact_results
+    :return: the result dictionaries
+    """
+    results = []
+    for doc_id, title, sents, spans, regest_sents in compact:
+        sents = [Markup(s) for s in sents]
+        results.append({'id': doc_id,
+                        'info': {'title': title},
+                        'title': title,
+                        'sents': sents,
+                        'sentence_spans': [range(*s) if isinstance(s, (list, tuple)) else s for s in spans],
+                        'regest_sents': [Markup(s) for s in regest_sents],
+                        'highlight': sents})
+    return results
+
+
+def is_compact(results: list) -> bool:
+    """ Whether results are compact results or result dictionaries
+
+    :param results: the results
+    :return: True if the results are compact results
+    """
+    return bool(results) and isinstance(results[0], list)
+
+
+def encode_results(results: List[Union[Dict[str, Any], list]]) -> bytes:
+    """ Encodes search results in a versioned, compressed format, e.g., to save them with a page
+
+    :param results: the results as returned by advanced_query_index or by compact_results
+    :return: the version byte followed by the zlib-compressed JSON of the compact results
+    """
+    compact = results if is_compact(results) else compact_results(results)
+    return bytes([RESULT_CODEC_VERSION]) + zlib.compress(json.dumps(compact, separators=(',', ':')).encode())
+
+
+def decode_results(data: bytes) -> List[list]:
+    """ Decodes results that were encoded with encode_results. The snippets are only turned into Markup again by
+    expand_results when the results are used.
+
+    :param data: the encoded results
+    :return: the compact results
+    """
+    if not data or data[0] != RESULT_CODEC_VERSION:
+        raise ValueError('Unknown version of encoded search results: {}'.format(data[:1]))
+    return json.loads(zlib.decompress(data[1:]).decode())
+
+
+def save_previous_search(results: Union[List[Dict[str, Any]], Any]):
+    """ Keeps the results of the last search of the current user. They are stored in Redis for
+    PREVIOUS_SEARCH_TIMEOUT seconds and the session only keeps their key. If PREVIOUS_SEARCH_TIMEOUT is 0, the results
+    are stored in the session itself. If Redis cannot be reached, the compact results are stored in the session.
+
+    :param results: the results as returned by advanced_query_index or by compact_results
+    """
+    timeout = current_app.config.get('PREVIOUS_SEARCH_TIMEOUT', 0)
+    if not timeout:
+        session['previous_search'] = results
+        return
+    clear_previous_search()
+    compact = results if is_compact(results) else compact_results(results)
+    key = uuid4().hex
+    try:
+        current_app.redis.setex('{}:{}'.format(RESULT_STORE_NAMESPACE, key), timeout,
+                                pickle.dumps(compact, protocol=pickle.HIGHEST_PROTOCOL))
+    except RedisError as E:
+        current_app.logger.warning('Unable to store the search results in Redis: {}'.format(E))
+        session['previous_search'] = compact
+        return
+    session[RESULT_STORE_SESSION_KEY] = key
+    g.stored_previous_search = (key, expand_results(compact))
+
+
+def load_previous_search() -> Union[List[Dict[str, Any]], None]:
+    """ The results of the last search of the current user. Results from Redis are loaded once per request.
+
+    :return: the result dictionaries or None if there are no results
+    """
+    key = session.get(RESULT_STORE_SESSION_KEY)
+    if key is None:
+        results = session.get('previous_search')
+        if isinstance(results, list) and is_compact(results):
+            return expand_results(results)
+        return results
+    stored = g.get('stored_previous_search')
+    if stored is not None and stored[0] == key:
+        return stored[1]
+    try:
+        data = current_app.redis.get('{}:{}'.format(RESULT_STORE_NAMESPACE, key))
+    except RedisError as E:
+        current_app.logger.warning('Unable to load the search results from Redis: {}'.format(E))
+        data = None
+    results = None
+    if data is not None:
+        try:
+            results = expand_results(pickle.loads(data))
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            results = None
+    g.stored_previous_search = (key, results)
+    return results
+
+
+def previous_search_incomplete() -> bool:
+    """ Whether the last search of the current user was a paged search with more than one page. Only the hits on the
+    page that was shown then carry highlighted sentences, so its results cannot be downloaded.
+
+    :return: True if hits of the last search have no sentences because they were not on the shown page
+    """
+    return g.get('previous_search_paged', session.get('previous_search_paged', False))
+
+
+def clear_previous_search():
+    """ Removes the results of the last search of the current user"""
+    session.pop('previous_search', None)
+    key = session.pop(RESULT_STORE_SESSION_KEY, None)
+    if key is not None:
+        g.pop('stored_previous_search', None)
+        try:
+            current_app.redis.delete('{}:{}'.format(RESULT_STORE_NAMESPACE, key))
+        except RedisError:
+            pass
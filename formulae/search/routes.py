@@ -1,14 +1,17 @@
-from flask import redirect, request, url_for, g, flash, current_app, session, Response
+from flask import redirect, request, url_for, g, flash, current_app, session, Response, send_file, jsonify
 from flask_babel import _
 from math import ceil
 from .Search import advanced_query_index, suggest_word_search, AGGREGATIONS, lem_highlight_to_text
+from .async_search import async_search
 from .forms import AdvancedSearchForm, FORM_PARTS
+from .export import export_entries, export_path, render_search_pdf, start_export
+from .result_store import load_previous_search, previous_search_incomplete
 from formulae.search import bp
+from formulae.services.job_service import FINISHED_STATES, JobCancelled, get_job_registry, job_owner
 from json import dumps
+import os
 import re
 from io import BytesIO
-from reportlab.platypus import Paragraph, SimpleDocTemplate
-from reportlab.lib.styles import getSampleStyleSheet
 from datetime import date
 from math import floor
 from json import load
@@ -201,7 +204,23 @@ def r_results():
                              query_dict=query_dict,
                              bool_operator=search_args.get('bool_operator', 'must')
                              )
-    posts, total, aggs, g.previous_search = advanced_query_index(**final_search_args)
+    if current_app.config['SEARCH_RESULTS_PER_PAGE'] and 'elexicon' not in corpus:
+        posts_per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+        page = max(int(request.args.get('page', 1)) if request.args.get('page', '1').isdigit() else 1, 1)
+        final_search_args.update(per_page=posts_per_page, page=page, paged=True)
+    try:
+        if current_app.config.get('ASYNC_SEARCH_WORKERS') and 'elexicon' not in corpus:
+            search_results, job_id = async_search(final_search_args)
+            if search_results is None:
+                # The page polls the job of the search and is reloaded to show the results when they are ready
+                return current_app.config['nemo_app'].render(template='search::search_pending.html',
+                                                             title=_('Suche'), url=dict(), job_id=job_id)
+            posts, total, aggs, g.previous_search = search_results
+        else:
+            posts, total, aggs, g.previous_search = advanced_query_index(**final_search_args)
+    except JobCancelled:
+        # The user has left the page, so nobody waits for the results
+        return Response(status=204)
     old_search_args = {k: v for k, v in request.args.items()}
     old_search_args.pop('page', None)
     old_search_args['corpus'] = '+'.join(corpus)
@@ -211,6 +230,8 @@ def r_results():
     if old_search is False:
         g.previous_search_args = old_search_args
         g.previous_aggregations = aggs
+        # The hits on the other pages of a paged search are stored without their sentences
+        g.previous_search_paged = bool(final_search_args.get('paged')) and total > posts_per_page
         g.previous_search_args['corpus'] = '+'.join(corps)
     inf_to_lemmas = {q_term: list() for q_term in final_search_args['query_dict']}
     for k, v in sorted(final_search_args['query_dict'].items()):
@@ -240,10 +261,18 @@ def r_results():
         if v and all(v):
             searched_lems[k] = v
             max_cols = max(len(v), max_cols)
+    page_urls = dict()
+    if final_search_args.get('paged'):
+        page_args = {k: v for k, v in request.args.items() if k != 'page'}
+        if page > 1:
+            page_urls['prev'] = url_for('.r_results', page=page - 1, **page_args)
+        if page * posts_per_page < total:
+            page_urls['next'] = url_for('.r_results', page=page + 1, **page_args)
     return current_app.config['nemo_app'].render(template=template, title=_('Suche'), posts=posts, current_page=page,
                                                  url=dict(), open_texts=g.open_texts, half_open_texts=g.half_open_texts,
                                                  total_results=total, aggs=aggs, searched_lems=searched_lems, 
-                                                 max_cols=max_cols)
+                                                 max_cols=max_cols, page_urls=page_urls,
+                                                 last_page=ceil(total / posts_per_page) if total else 1)
 
 
 @bp.route("/advanced_search", methods=["GET"])
@@ -364,9 +393,14 @@ def word_search_suggester(qSource: str):
 
 @bp.route('/download/<download_id>', methods=["GET"])
 def download_search_results(download_id: str) -> Response:
-    if 'previous_search' not in session or 'previous_search_args' not in session:
+    previous_search = load_previous_search()
+    if previous_search is None or 'previous_search_args' not in session:
         flash(_('Keine Suchergebnisse zum Herunterladen.'))
         return redirect(url_for('InstanceNemo.r_index'))
+    elif previous_search_incomplete():
+        # Only the hits on the page that was shown have been highlighted
+        flash(_('Suchergebnisse, die auf mehrere Seiten verteilt sind, können nicht heruntergeladen werden.'))
+        return redirect(url_for('InstanceNemo.r_index'))
     else:
         download_id = 'pdf_download_' + str(download_id)
         resp = list()
@@ -422,39 +456,22 @@ def download_search_results(download_id: str) -> Response:
             if arg == 'special_days':
                 value = ' - '.join([special_day_dict[x] for x in value.split('+')])
             arg_list.append('<b>{}</b>: {}'.format(s, value if value != '0' else ''))
-        try:
-            ids = session['previous_search']
-        # This finally statement makes sure that the JS function to get the progress halts on an error.
-        finally:
-            current_app.redis.setex(download_id, 60, '99%')
-        for d in ids:
-            r = {'title': d['info']['title'], 'sents': [], 'regest_sents': []}
-            if 'sents' in d and d['sents'] != []:
-                r['sents'] = ['- {}'.format(re.sub(r'(?:</small>)?<strong>(.*?)</strong>(?:<small>)?', r'<b>\1</b>',
-                                                   str(s)))
-                              for s in d['sents']]
-            if 'regest_sents' in d and d['regest_sents'] != []:
-                r['regest_sents'] = ['<u>' + _('Aus dem Regest') + '</u>']
-                r['regest_sents'] += ['- {}'.format(re.sub(r'(?:</small>)?<strong>(.*?)</strong>(?:<small>)?',
-                                                           r'<b>\1</b>',
-                                                           str(s)))
-                                      for s in d['regest_sents']]
-            resp.append(r)
-        pdf_buffer = BytesIO()
+        ids = previous_search
         description = 'Formulae-Litterae-Chartae Suchergebnisse ({})'.format(date.today().isoformat())
-        my_doc = SimpleDocTemplate(pdf_buffer, title=description)
-        sample_style_sheet = getSampleStyleSheet()
-        flowables = list([Paragraph(_('Suchparameter'), sample_style_sheet['Heading3'])])
-        for a in arg_list:
-            flowables.append(Paragraph(a, sample_style_sheet['Normal']))
-        flowables.append(Paragraph(_('Suchergebnisse'), sample_style_sheet['Heading3']))
-        for p in resp:
-            flowables.append(Paragraph(p['title'], sample_style_sheet['Heading4']))
-            for sentence in p['sents']:
-                flowables.append(Paragraph(sentence, sample_style_sheet['Normal']))
-            for r_sentence in p['regest_sents']:
-                flowables.append(Paragraph(r_sentence, sample_style_sheet['Normal']))
-        my_doc.build(flowables)
+        headings = [_('Suchparameter'), _('Suchergebnisse')]
+        entries = export_entries(ids, _('Aus dem Regest'))
+        if current_app.config['SEARCH_EXPORT_FOLDER']:
+            return background_download(download_id, description, headings, arg_list, entries)
+        registry = get_job_registry()
+        registry.create(download_id, 'pdf_export', total=len(entries), owner=job_owner())
+        pdf_buffer = BytesIO()
+        try:
+            render_search_pdf(pdf_buffer, description, headings, arg_list, entries)
+        # This makes sure that the JS function to get the progress halts on an error.
+        except Exception as E:
+            registry.fail(download_id, str(E))
+            raise
+        registry.finish(download_id)
         pdf_value = pdf_buffer.getvalue()
         pdf_buffer.close()
         session.pop(download_id, None)
@@ -462,14 +479,61 @@ def download_search_results(download_id: str) -> Response:
                         headers={'Content-Disposition': 'attachment;filename={}.pdf'.format(description.replace(' ', '_'))})
 
 
-@bp.route('/pdf_progress/<download_id>', methods=["GET"])
-def pdf_download_progress(download_id: str) -> str:
-    """ Function periodically called by JS from client to check progress of PDF download"""
+def background_download(download_id: str, description: str, headings: list, arg_list: list, entries: list) -> Response:
+    """ Renders the PDF of the search results in the export process pool instead of the request.
+        The first request starts the export and returns 202. The client polls pdf_download_progress and requests the
+        download again when the progress is '100%', which then sends the finished file.
+
+    :param download_id: the id of the export job
+    :return: the PDF file or an empty 202 response while the export is running
+    """
+    exports = session.get('search_exports', dict())
+    export = exports.get(download_id)
+    if export is not None:
+        path = export_path(export['id'])
+        if os.path.isfile(path):
+            return send_file(path, mimetype='application/pdf', as_attachment=True,
+                             download_name='{}.pdf'.format(export['description'].replace(' ', '_')))
+        job = get_job_registry().get(download_id)
+        if job is not None and job['state'] not in FINISHED_STATES:
+            return Response(status=202)
+    exports[download_id] = {'id': start_export(download_id, description, headings, arg_list, entries),
+                            'description': description}
+    session['search_exports'] = exports
+    return Response(status=202)
+
+
+def job_id_for(download_id: str) -> str:
+    """ The job id of a search ('search_progress_<id>') or of a PDF download (only the number)"""
     if not download_id.startswith('search_progress_'):
         download_id = 'pdf_download_' + str(download_id)
-    if current_app.redis.get(download_id):
-        return current_app.redis.get(download_id).decode('utf-8') or '0%'
-    return '0%'
+    return download_id
+
+
+@bp.route('/pdf_progress/<download_id>', methods=["GET"])
+def pdf_download_progress(download_id: str) -> Response:
+    """ Function periodically called by JS from client to check the progress of a search or of a PDF download
+
+    :return: the job as JSON, with state 'unknown' if there is no such job
+    """
+    job = get_job_registry().get(job_id_for(download_id))
+    if job is None:
+        job = {'id': job_id_for(download_id), 'state': 'unknown', 'phase': '', 'done': 0, 'total': 0, 'percent': 0,
+               'progress': '0%', 'cancelled': False, 'result': '', 'error': ''}
+    # The owner token would allow anyone who knows the job id to cancel the job
+    job.pop('owner', None)
+    return jsonify(job)
+
+
+@bp.route('/cancel/<download_id>', methods=["POST"])
+def cancel_job(download_id: str) -> Response:
+    """ Cancels a running search or PDF download, e.g., when the user closes the tab. Only the session that started
+    the job can cancel it.
+
+    :return: JSON with 'cancelled': whether a running job was cancelled
+    """
+    return jsonify({'cancelled': get_job_registry().cancel(job_id_for(download_id), owner=job_owner())})
+
 
 @bp.route('/lemmata', methods=['GET'])
 def lemma_list():
@@ -0,0 +1,96 @@
+from bisect import bisect_left, bisect_right
+from typing import Callable, List, Set
+
+
+class PositionList(object):
+    """ The positions of one query word in their original order together with a sorted copy for range lookups
+
+    :param positions: the positions of the word in the order in which the highlighter collected them
+    """
+    __slots__ = ('positions', 'sorted_positions', 'order', 'is_sorted')
+
+    def __init__(self, positions: List[int]):
+        self.positions = positions
+        self.order = sorted(range(len(positions)), key=positions.__getitem__)
+        self.sorted_positions = [positions[i] for i in self.order]
+        self.is_sorted = self.sorted_positions == positions
+
+    def between(self, low: int, high: int) -> List[int]:
+        """ The positions from low to high (inclusive) in their original order, each position only once
+
+        :param low: the lowest position
+        :param high: the highest position
+        :return: the list of positions
+        """
+        i = bisect_left(self.sorted_positions, low)
+        j = bisect_right(self.sorted_positions, high, lo=i)
+        if self.is_sorted:
+            candidates = self.positions[i:j]
+        else:
+            candidates = [self.positions[k] for k in sorted(self.order[i:j])]
+        seen = set()
+        return [p for p in candidates if not (p in seen or seen.add(p))]
+
+
+def find_spans(word_positions: List[List[int]], slop: int, ordered_terms: bool,
+               span_filter: Callable[[Set[int]], bool] = None) -> List[List[int]]:
+    """ Finds the spans of positions that contain every word of a multi-word query.
+
+    A span contains one distinct position for every query word and covers at most len(word_positions) + slop
+    positions. With ordered_terms, the words after the first one must not occur before the first word.
+    Starting from every position of the first word, only the positions of the other words within the span width are
+    looked up (by bisection) and then combined depth-first, abandoning a combination as soon as it becomes too wide.
+    The spans are returned in the same order, and with the same repetitions, as a Cartesian product of the positions of
+    all words would produce them.
+
+    :param word_positions: the positions of every query word, in query order
+    :param slop: the number of positions that may lie between the query words
+    :param ordered_terms: whether the other words must follow the first word
+    :param span_filter: an optional further test that every span (as a set of positions) has to pass
+    :return: the sorted positions of every matching span
+    """
+    slop = int(slop)
+    n_words = len(word_positions)
+    width = slop + n_words - 1
+    range_start = -1 if ordered_terms else slop + n_words
+    range_end = slop + n_words + 1
+    other_words = [PositionList(p) for p in word_positions[1:]]
+    spans = list()
+    for pos in word_positions[0]:
+        low = max(pos - range_start - 1, 0, pos - width)
+        high = min(pos + range_end, pos + width)
+        candidates = list()
+        for word in other_words:
+            word_candidates = word.between(low, high)
+            if not word_candidates:
+                break
+            candidates.append(word_candidates)
+        else:
+            _combine_spans(spans, [pos], candidates, pos, pos, width, span_filter)
+    return spans
+
+
+def _combine_spans(spans: List[List[int]], chosen: List[int], candidates: List[List[int]], low: int, high: int,
+                   width: int, span_filter: Callable[[Set[int]], bool] = None):
+    """ Adds all spans that extend the chosen positions with one position from each of the remaining candidate lists
+
+    :param spans: the list to which the matching spans are added
+    :param chosen: the positions chosen so far
+    :param candidates: the candidate positions of the remaining words
+    :param low: the lowest chosen position
+    :param high: the highest chosen position
+    :param width: the maximum distance between the lowest and the highest position of a span
+    :param span_filter: an optional further test that every span has to pass
+    """
+    if not candidates:
+        span = set(chosen)
+        if span_filter is None or span_filter(span):
+            spans.append(sorted(span))
+        return
+    for p in candidates[0]:
+        new_low, new_high = min(low, p), max(high, p)
+        if new_high - new_low > width or p in chosen:
+            continue
+        chosen.append(p)
+        _combine_spans(spans, chosen, candidates[1:], new_low, new_high, width, span_filter)
+        chosen.pop()
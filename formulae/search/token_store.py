@@ -0,0 +1,251 @@
+import os
+import pickle
+from array import array
+from hashlib import sha256
+from time import time
+from typing import Dict, Iterable, List, Tuple, Union
+
+from flask import current_app
+from elasticsearch import ApiError, TransportError
+
+from formulae.services.blob_store import INDEX_FILE, BlobStore, BlobStoreWriter, blob_store_path
+
+
+TOKEN_STORE_PREFIX = 'tokens_'
+# The number of documents whose term vectors are requested at once when the token store is built
+TERM_VECTOR_BATCH_SIZE = 500
+TOKEN_INDICES = ['form_lit_chart']
+
+
+class FieldTokens(object):
+    """ The tokens of one field of a document as parallel arrays that are sorted by position.
+
+    This replaces the term vector JSON that Elasticsearch returns for the field. Each token is stored as
+    (position, start offset, end offset, term id) and the term ids point into the tuple of terms.
+
+    :param terms: the distinct terms of the field
+    :param positions: the position of every token
+    :param starts: the start offset of every token
+    :param ends: the end offset of every token
+    :param term_ids: the index of the term of every token in terms
+    """
+    __slots__ = ('terms', 'positions', 'starts', 'ends', 'term_ids', '_term_positions')
+
+    def __init__(self, terms: Tuple[str, ...], positions: array, starts: array, ends: array, term_ids: array):
+        self.terms = terms
+        self.positions = positions
+        self.starts = starts
+        self.ends = ends
+        self.term_ids = term_ids
+        self._term_positions = None
+
+    @classmethod
+    def from_term_vector(cls, field_vector: dict) -> 'FieldTokens':
+        """ Builds the token table from the term vector of one field as returned by Elasticsearch
+
+        :param field_vector: the term vector of the field, i.e., {'terms': {term: {'tokens': [...]}}}
+        :return: the token table
+        """
+        terms = tuple(field_vector['terms'])
+        rows = []
+        for term_id, term in enumerate(terms):
+            for token in field_vector['terms'][term]['tokens']:
+                rows.append((token['position'], term_id, token.get('start_offset', -1), token.get('end_offset', -1)))
+        # If several terms share a position, the last one in the term vector comes last, as in the term vector itself
+        rows.sort()
+        return cls(terms,
+                   array('i', [r[0] for r in rows]),
+                   array('i', [r[2] for r in rows]),
+                   array('i', [r[3] for r in rows]),
+                   array('i', [r[1] for r in rows]))
+
+    def __getstate__(self):
+        return self.terms, self.positions, self.starts, self.ends, self.term_ids
+
+    def __setstate__(self, state):
+        self.terms, self.positions, self.starts, self.ends, self.term_ids = state
+        self._term_positions = None
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.term_positions
+
+    @property
+    def term_positions(self) -> Dict[str, List[int]]:
+        """ The sorted positions of every term. The dictionary is built on first access."""
+        if self._term_positions is None:
+            term_positions = {t: [] for t in self.terms}
+            terms = self.terms
+            for position, term_id in zip(self.positions, self.term_ids):
+                term_positions[terms[term_id]].append(position)
+            self._term_positions = term_positions
+        return self._term_positions
+
+    def positions_of(self, term: str) -> List[int]:
+        """ The positions at which a term occurs
+
+        :param term: the term
+        :return: the sorted positions or an empty list if the term does not occur in the field
+        """
+        return self.term_positions.get(term, [])
+
+    def offsets(self) -> Dict[int, Tuple[int, int, str]]:
+        """ Maps every position to the start offset, end offset and term of its token
+
+        :return: {position: (start_offset, end_offset, term)}
+        """
+        terms = self.terms
+        return dict(zip(self.positions, zip(self.starts, self.ends, [terms[i] for i in self.term_ids])))
+
+
+def doc_tokens_from_term_vectors(term_vectors: dict) -> Dict[str, FieldTokens]:
+    """ Converts the term vectors of a document into token tables
+
+    :param term_vectors: the 'term_vectors' of a document as returned by mtermvectors
+    :return: {field: FieldTokens}
+    """
+    return {field: FieldTokens.from_term_vector(v) for field, v in term_vectors.items()}
+
+
+class TokenStoreWriter(BlobStoreWriter):
+    """ Writes the token tables of all documents into a new token store"""
+    prefix = TOKEN_STORE_PREFIX
+
+    def add(self, key: str, doc_tokens: Dict[str, FieldTokens]):
+        """ Stores the token tables of one document
+
+        :param key: the document id
+        :param doc_tokens: {field: FieldTokens}
+        """
+        super(TokenStoreWriter, self).add(key, pickle.dumps(doc_tokens, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class TokenStore(BlobStore):
+    """ Read access to the token tables of the documents in the current Elasticsearch indices"""
+    prefix = TOKEN_STORE_PREFIX
+
+    def get(self, key: str) -> Union[Dict[str, FieldTokens], None]:
+        """ Returns the token tables of a document
+
+        :param key: the document id
+        :return: {field: FieldTokens} or None if the document is not in the store
+        """
+        data = super(TokenStore, self).get(key)
+        return None if data is None else pickle.loads(data)
+
+
+def token_store_key(indices: Iterable[str] = None) -> str:
+    """ The fingerprint of the Elasticsearch indices from which the token store is built.
+    Every reindexing creates indices with new uuids and so invalidates the token store.
+
+    :param indices: the indices or aliases that are searched
+    :return: the hex digest of the fingerprint
+    """
+    settings = current_app.elasticsearch.indices.get_settings(index=list(indices or TOKEN_INDICES))
+    h = sha256()
+    for name in sorted(settings):
+        h.update('{}\0{}\n'.format(name, settings[name]['settings']['index']['uuid']).encode())
+    return h.hexdigest()
+
+
+def current_index_key(indices: Iterable[str] = None) -> str:
+    """ The fingerprint of the indices as returned by token_store_key. Each process asks Elasticsearch for it again
+    when it is older than INDEX_CHECK_INTERVAL seconds, so that a reindexing is noticed without a restart.
+
+    :param indices: the indices or aliases that are searched, by default TOKEN_INDICES
+    :return: the hex digest of the fingerprint
+    """
+    indices = tuple(sorted(indices or TOKEN_INDICES))
+    checked_keys = current_app.extensions.setdefault('index_keys', dict())
+    key, checked = checked_keys.get(indices, (None, 0))
+    if key is None or time() - checked >= current_app.config.get('INDEX_CHECK_INTERVAL', 60):
+        key = token_store_key(indices)
+        checked_keys[indices] = (key, time())
+    return key
+
+
+def file_version(path: str) -> Union[int, None]:
+    """ The modification time of a file, to notice when it is written again
+
+    :param path: the path of the file
+    :return: the modification time in nanoseconds or None if the file does not exist
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_token_store() -> Union[TokenStore, None]:
+    """ Opens the token store in TOKEN_STORE_FOLDER for the current indices. The store is opened again when the
+    indices change or when `flask build-token-store` writes a new store.
+
+    :return: the token store or None if TOKEN_STORE_FOLDER is not set
+    """
+    store_folder = current_app.config.get('TOKEN_STORE_FOLDER')
+    if not store_folder or not current_app.elasticsearch:
+        return None
+    try:
+        key = current_index_key()
+    except (ApiError, TransportError) as E:
+        current_app.logger.warning('Unable to open the token store: {}'.format(E))
+        return None
+    version = (key, file_version(os.path.join(blob_store_path(store_folder, TOKEN_STORE_PREFIX, key), INDEX_FILE)))
+    opened = current_app.extensions.get('token_store')
+    if opened is None or opened[0] != version:
+        opened = (version, TokenStore(store_folder, key))
+        current_app.extensions['token_store'] = opened
+    return opened[1]
+
+
+def load_doc_tokens(result_ids: Iterable[Tuple[str, str]]) -> Dict[str, Dict[str, FieldTokens]]:
+    """ Loads the token tables of the search hits, from the token store if possible and otherwise with one
+    mtermvectors request for all hits that are not in the store
+
+    :param result_ids: the (id, index) of every hit
+    :return: {document id: {field: FieldTokens}}
+    """
+    store = get_token_store()
+    doc_tokens = dict()
+    missing = []
+    for doc_id, index in result_ids:
+        tokens = store.get(doc_id) if store is not None else None
+        if tokens is None:
+            missing.append((doc_id, index))
+        else:
+            doc_tokens[doc_id] = tokens
+    if missing:
+        mvectors_body = {'docs': [{'_index': h[1], '_id': h[0], 'term_statistics': False, 'field_statistics': False} for h in missing]}
+        for d in current_app.elasticsearch.mtermvectors(**mvectors_body)['docs']:
+            doc_tokens[d['_id']] = doc_tokens_from_term_vectors(d['term_vectors'])
+    return doc_tokens
+
+
+def build_token_store(indices: List[str] = None) -> Tuple[str, int]:
+    """ Fetches the term vectors of every document in the indices and writes their token tables to a new token store
+
+    :param indices: the indices or aliases to read, by default TOKEN_INDICES
+    :return: the path of the new store and the number of documents
+    """
+    from formulae.search.Search import search_all_hits
+    indices = list(indices or TOKEN_INDICES)
+    writer = TokenStoreWriter(current_app.config['TOKEN_STORE_FOLDER'], token_store_key(indices))
+    written = 0
+    try:
+        hits = search_all_hits(indices, {'query': {'match_all': {}}, 'sort': ['urn']}, source=False)
+        for i in range(0, len(hits), TERM_VECTOR_BATCH_SIZE):
+            batch = hits[i:i + TERM_VECTOR_BATCH_SIZE]
+            mvectors_body = {'docs': [{'_index': h['_index'], '_id': h['_id'], 'term_statistics': False,
+                                       'field_statistics': False} for h in batch]}
+            for d in current_app.elasticsearch.mtermvectors(**mvectors_body)['docs']:
+                if d.get('term_vectors'):
+                    writer.add(d['_id'], doc_tokens_from_term_vectors(d['term_vectors']))
+                    written += 1
+    except BaseException:
+        writer.abort()
+        raise
+    path = writer.commit()
+    current_app.extensions.pop('token_store', None)
+    return path, written
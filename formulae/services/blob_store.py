@@ -0,0 +1,149 @@
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from hashlib import sha256
+from typing import Dict, Hashable, Tuple, Union
+
+
+BLOB_STORE_VERSION = 1
+BLOB_FILE = 'blobs.bin'
+INDEX_FILE = 'index.pickle'
+
+
+def blob_store_path(store_folder: str, prefix: str, key: str) -> str:
+    """ The directory in which a blob store for a certain fingerprint is stored
+
+    :param store_folder: the folder that contains the stores
+    :param prefix: the prefix of the kind of store, e.g., 'passages_'
+    :param key: the fingerprint of the data from which the store was built
+    :return: the path to the store directory
+    """
+    return os.path.join(store_folder, '{}{}'.format(prefix, key))
+
+
+class BlobStoreWriter(object):
+    """ Writes a new content-addressed blob store.
+
+    Every distinct blob is compressed with zlib and appended once to the blob file. The index maps each entry key to
+    the (offset, length) of its blob, so that identical blobs are stored only once.
+    The store is built in a temporary directory that replaces the final directory on commit.
+
+    :param store_folder: the folder that contains the stores
+    :param key: the fingerprint of the data from which the store is built
+    """
+    prefix = 'blobs_'
+
+    def __init__(self, store_folder: str, key: str):
+        os.makedirs(store_folder, exist_ok=True)
+        self.store_folder = store_folder
+        self.key = key
+        self.tmp_dir = tempfile.mkdtemp(dir=store_folder, prefix='.' + self.prefix)
+        self.blob_file = open(os.path.join(self.tmp_dir, BLOB_FILE), 'wb')
+        self.offset = 0
+        self.digests = dict()
+        self.index = dict()
+
+    def add_blob(self, data: bytes) -> Tuple[int, int]:
+        """ Adds a blob to the blob file if it is not already there
+
+        :param data: the uncompressed blob
+        :return: the offset and length of the compressed blob
+        """
+        digest = sha256(data).digest()
+        if digest not in self.digests:
+            compressed = zlib.compress(data, 9)
+            self.blob_file.write(compressed)
+            self.digests[digest] = (self.offset, len(compressed))
+            self.offset += len(compressed)
+        return self.digests[digest]
+
+    def add(self, key: Hashable, data: bytes):
+        """ Stores the blob for one entry
+
+        :param key: the entry key
+        :param data: the uncompressed blob
+        """
+        self.index[key] = self.add_blob(data)
+
+    def commit(self) -> str:
+        """ Writes the index, moves the store into place and removes the stores of older fingerprints
+
+        :return: the path of the store directory
+        """
+        self.blob_file.close()
+        with open(os.path.join(self.tmp_dir, INDEX_FILE), 'wb') as f:
+            pickle.dump({'version': BLOB_STORE_VERSION, 'key': self.key, 'index': self.index}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        path = blob_store_path(self.store_folder, self.prefix, self.key)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(self.tmp_dir, path)
+        for old in os.listdir(self.store_folder):
+            old_path = os.path.join(self.store_folder, old)
+            if old.startswith(self.prefix) and old_path != path:
+                shutil.rmtree(old_path, ignore_errors=True)
+        return path
+
+    def abort(self):
+        """ Removes the unfinished store"""
+        self.blob_file.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class BlobStore(object):
+    """ Read access to a store written by BlobStoreWriter.
+
+    The blob file is memory-mapped read-only so that all gunicorn workers share its pages through the OS page cache.
+    If there is no store for the fingerprint, the store is empty and every lookup returns None.
+
+    :param store_folder: the folder that contains the stores
+    :param key: the fingerprint of the data from which the store should have been built
+    """
+    prefix = 'blobs_'
+
+    def __init__(self, store_folder: str, key: str):
+        self.index = dict()
+        self.blobs = None
+        if not store_folder:
+            return
+        path = blob_store_path(store_folder, self.prefix, key)
+        try:
+            with open(os.path.join(path, INDEX_FILE), 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') != BLOB_STORE_VERSION or data.get('key') != key:
+                return
+            with open(os.path.join(path, BLOB_FILE), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                self.blobs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index = data['index']
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, KeyError):
+            self.index = dict()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.index
+
+    def get(self, key: Hashable) -> Union[bytes, None]:
+        """ Returns the blob of an entry
+
+        :param key: the entry key
+        :return: the uncompressed blob or None if the entry is not in the store
+        """
+        location = self.index.get(key)
+        if location is None:
+            return None
+        offset, length = location
+        return zlib.decompress(self.blobs[offset:offset + length])
+
+    def stats(self) -> Dict[str, int]:
+        """ The number of entries and the size of the blob file
+
+        :return: dict with 'entries' and 'bytes'
+        """
+        return {'entries': len(self.index), 'bytes': len(self.blobs) if self.blobs is not None else 0}
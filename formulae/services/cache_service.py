@@ -0,0 +1,163 @@
+import pickle
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from redis.exceptions import RedisError
+
+
+class TwoTierCache(object):
+    """ A cache for computed page data with an in-process LRU tier and a Redis tier that is shared by all workers.
+
+    Values are pickled for the Redis tier. If Redis is not reachable, the cache silently falls back to the local tier.
+    Hits and misses are counted per process. The counts are added to the Redis hash '<namespace>:stats' together with
+    the next Redis request of the cache, at the latest STATS_FLUSH_INTERVAL seconds later, so that hits in the local
+    tier do not need a Redis request of their own.
+
+    :param redis: the Redis client, normally app.redis
+    :param namespace: the prefix for all Redis keys of this cache
+    :param max_items: the maximum number of entries in the local tier. 0 disables the cache.
+    :param timeout: the number of seconds an entry is kept in Redis
+    """
+    STAT_FIELDS = ('local_hits', 'redis_hits', 'misses')
+    STATS_FLUSH_INTERVAL = 60
+
+    def __init__(self, redis, namespace: str, max_items: int = 128, timeout: int = 86400):
+        self.redis = redis
+        self.namespace = namespace
+        self.max_items = max_items
+        self.timeout = timeout
+        self.local = OrderedDict()
+        self.lock = Lock()
+        self.counts = dict.fromkeys(self.STAT_FIELDS, 0)
+        # The counts that have not been added to Redis yet
+        self.unflushed = dict.fromkeys(self.STAT_FIELDS, 0)
+        self.flushed_at = time()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0
+
+    def redis_key(self, key: Hashable) -> str:
+        if isinstance(key, tuple):
+            key = ':'.join(str(x) for x in key)
+        return '{}:{}'.format(self.namespace, key)
+
+    def count(self, field: str):
+        """ Increments one of the hit and miss counters
+
+        :param field: 'local_hits', 'redis_hits' or 'misses'
+        """
+        with self.lock:
+            self.counts[field] += 1
+            self.unflushed[field] += 1
+        # Redis hits and misses have already asked Redis, so one more request does not matter
+        if field != 'local_hits' or time() - self.flushed_at >= self.STATS_FLUSH_INTERVAL:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """ Adds the counts of this process that have not been added yet to the shared counters in Redis"""
+        with self.lock:
+            unflushed = {k: v for k, v in self.unflushed.items() if v}
+            self.unflushed = dict.fromkeys(self.STAT_FIELDS, 0)
+            self.flushed_at = time()
+        if not unflushed:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for field, value in unflushed.items():
+                pipe.hincrby(self.namespace + ':stats', field, value)
+            pipe.execute()
+        except RedisError:
+            # The counts are kept for the next try
+            with self.lock:
+                for field, value in unflushed.items():
+                    self.unflushed[field] += value
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """ Looks a key up, first in the local tier and then in Redis
+
+        :param key: the cache key
+        :return: whether the key was found and the cached value
+        """
+        with self.lock:
+            found = key in self.local
+            if found:
+                self.local.move_to_end(key)
+                value = self.local[key]
+        if found:
+            self.count('local_hits')
+            return True, value
+        try:
+            stored = self.redis.get(self.redis_key(key))
+        except RedisError:
+            stored = None
+        if stored is not None:
+            try:
+                value = pickle.loads(stored)
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                self.count('misses')
+                return False, None
+            self._set_local(key, value)
+            self.count('redis_hits')
+            return True, value
+        self.count('misses')
+        return False, None
+
+    def set(self, key: Hashable, value: Any):
+        """ Stores a value in both tiers
+
+        :param key: the cache key
+        :param value: the picklable value
+        """
+        self._set_local(key, value)
+        try:
+            self.redis.setex(self.redis_key(key), self.timeout, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except (RedisError, pickle.PicklingError, TypeError):
+            pass
+
+    def _set_local(self, key: Hashable, value: Any):
+        with self.lock:
+            self.local[key] = value
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_items:
+                self.local.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """ Returns the cached value for a key or computes and caches it
+
+        :param key: the cache key
+        :param func: the function that computes the value on a miss
+        :return: the cached or computed value
+        """
+        if not self.enabled:
+            return func()
+        found, value = self.get(key)
+        if not found:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """ Removes all entries of this cache from the local tier and from Redis"""
+        with self.lock:
+            self.local.clear()
+        try:
+            keys = [k for k in self.redis.scan_iter(match=self.namespace + ':*') if not k.endswith(b':stats')]
+            if keys:
+                self.redis.delete(*keys)
+        except RedisError:
+            pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """ The hit and miss counters of this process and of all workers together
+
+        :return: {'process': {...}, 'shared': {...}} where 'shared' is empty if Redis is not reachable
+        """
+        self.flush_stats()
+        try:
+            shared = {k.decode('utf-8'): int(v) for k, v in self.redis.hgetall(self.namespace + ':stats').items()}
+        except RedisError:
+            shared = {}
+        return {'process': dict(self.counts, local_entries=len(self.local)), 'shared': shared}
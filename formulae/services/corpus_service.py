@@ -1,4 +1,13 @@
+import os
+import pickle
 import re
+import tempfile
+from collections import OrderedDict
+from collections.abc import Mapping
+from hashlib import sha256
+from threading import RLock
+from typing import Callable, Iterable, Iterator, List, Union
+
 
 def extract_folio_sort_key(par: str) -> tuple[int, int]:
     """
@@ -31,3 +40,178 @@ def extract_folio_sort_key(par: str) -> tuple[int, int]:
 
     # Fallback: sort last
     return (9999, 99)
+
+
+CORPUS_SNAPSHOT_VERSION = 2
+CORPUS_SNAPSHOT_PREFIX = 'corpus_snapshot_'
+
+
+def corpus_hash(folders: Iterable[str], extra_files: Iterable[str] = (), extra_values: Iterable[str] = ()) -> str:
+    """ Computes a fingerprint of the corpus from the path, size and modification time of every file in the corpus folders.
+
+    Only the output of ``os.stat`` is used so that the hash can be computed in a fraction of the time it takes to parse the corpus.
+
+    :param folders: the corpus folders (normally ``CORPUS_FOLDERS``)
+    :param extra_files: further files whose changes should invalidate the fingerprint (e.g., the COLLECTED_COLLS JSON files)
+    :param extra_values: further strings that should be part of the fingerprint (e.g., the list of open collections)
+    :return: the hex digest of the fingerprint
+    """
+    h = sha256()
+    h.update('v{}'.format(CORPUS_SNAPSHOT_VERSION).encode())
+    for folder in folders:
+        h.update(b'\0folder\0' + folder.encode())
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                h.update('{}\0{}\0{}\n'.format(os.path.relpath(path, folder), st.st_size, st.st_mtime_ns).encode())
+    for path in extra_files:
+        try:
+            st = os.stat(path)
+            h.update('{}\0{}\0{}\n'.format(path, st.st_size, st.st_mtime_ns).encode())
+        except OSError:
+            h.update('{}\0missing\n'.format(path).encode())
+    for value in extra_values:
+        h.update('{}\n'.format(value).encode())
+    return h.hexdigest()
+
+
+def snapshot_path(snapshot_folder: str, key: str) -> str:
+    """ The file in which the corpus snapshot for a certain corpus fingerprint is stored
+
+    :param snapshot_folder: the folder for corpus snapshots (``CORPUS_SNAPSHOT_FOLDER``)
+    :param key: the corpus fingerprint as returned by corpus_hash
+    :return: the path to the snapshot file
+    """
+    return os.path.join(snapshot_folder, '{}{}.pickle'.format(CORPUS_SNAPSHOT_PREFIX, key))
+
+
+def load_corpus_snapshot(snapshot_folder: str, key: str) -> Union[dict, None]:
+    """ Loads a corpus snapshot if one exists for the current corpus fingerprint
+
+    :param snapshot_folder: the folder for corpus snapshots
+    :param key: the corpus fingerprint as returned by corpus_hash
+    :return: the snapshot dictionary or None if there is no valid snapshot for this fingerprint
+    """
+    path = snapshot_path(snapshot_folder, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != CORPUS_SNAPSHOT_VERSION or snapshot.get('key') != key:
+        return None
+    return snapshot
+
+
+def save_corpus_snapshot(snapshot_folder: str, key: str, data: dict) -> str:
+    """ Atomically writes a corpus snapshot and removes the snapshots of older corpus fingerprints
+
+    :param snapshot_folder: the folder for corpus snapshots
+    :param key: the corpus fingerprint as returned by corpus_hash
+    :param data: the picklable data that should be stored
+    :return: the path of the written snapshot
+    """
+    os.makedirs(snapshot_folder, exist_ok=True)
+    path = snapshot_path(snapshot_folder, key)
+    snapshot = dict(data, version=CORPUS_SNAPSHOT_VERSION, key=key)
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_folder, prefix='.' + CORPUS_SNAPSHOT_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for old in os.listdir(snapshot_folder):
+        if old.startswith(CORPUS_SNAPSHOT_PREFIX) and os.path.join(snapshot_folder, old) != path:
+            try:
+                os.remove(os.path.join(snapshot_folder, old))
+            except OSError:
+                pass
+    return path
+
+
+class TextRecord(object):
+    """ The data about a readable text that the corpus routes need, extracted once from the resolver metadata.
+
+    The records replace the (par, metadata, XmlCapitainsReadableMetadata) tuples in NemoFormulae.all_texts so that
+    neither the metadata objects nor rdflib have to be consulted when a corpus page is rendered.
+    Records are sorted by (par, metadata), which is the order of the former tuples.
+    """
+    __slots__ = ('par', 'metadata', 'id', 'subtype', 'parent_id', 'ancestor_ids', 'parent_label', 'title', 'regest',
+                 'abstract', 'dating', 'spatial', 'source', 'source_edition', 'is_version_of', 'alternative',
+                 'status', 'activity')
+
+    def __init__(self, **kwargs):
+        for slot in self.__slots__:
+            setattr(self, slot, kwargs.get(slot, ''))
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    @property
+    def sort_key(self) -> tuple:
+        return self.par, self.metadata
+
+    def __lt__(self, other: 'TextRecord') -> bool:
+        return self.sort_key < other.sort_key
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, TextRecord) and self.__getstate__() == other.__getstate__()
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return 'TextRecord({!r}, {!r})'.format(self.id, self.par)
+
+
+class LazyTextIndex(Mapping):
+    """ A read-only mapping {collection: [TextRecord]} whose keys are known in advance but whose values are only
+    computed the first time a collection is accessed. Computed values are kept for the lifetime of the process.
+
+    :param builders: {collection: function that returns the sorted TextRecords for the collection}
+    """
+    def __init__(self, builders: 'OrderedDict[str, Callable[[], List[TextRecord]]]'):
+        self._builders = builders
+        self._data = dict()
+        self._lock = RLock()
+
+    def __getitem__(self, key: str) -> List[TextRecord]:
+        if key in self._data:
+            return self._data[key]
+        builder = self._builders[key]
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = builder()
+        return self._data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._builders)
+
+    def __len__(self) -> int:
+        return len(self._builders)
+
+    def __contains__(self, key) -> bool:
+        return key in self._builders
+
+    @property
+    def loaded(self) -> int:
+        """ The number of collections that have already been computed"""
+        return len(self._data)
+
+    def warm_up(self):
+        """ Computes all collections that have not been accessed yet"""
+        for key in self._builders:
+            self[key]
@@ -0,0 +1,154 @@
+from time import time
+from typing import Any, Dict, Union
+from uuid import uuid4
+
+from flask import current_app, has_request_context, session
+
+
+JOB_NAMESPACE = 'formulae:jobs'
+# The states of a job. Jobs in one of the FINISHED_STATES are not changed anymore.
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """ Raised in a job when it has been cancelled by the user"""
+
+
+class JobRegistry(object):
+    """ Keeps the state and the progress of long-running jobs, e.g., searches and PDF exports, in Redis hashes so that
+    every worker and every background process can report and read them.
+
+    Each job is the hash '<namespace>:<job_id>' with the fields kind, state, phase, done, total, percent, cancelled,
+    result (e.g., the id of a finished file), error, owner (the job_owner token of the session that started it), created
+    and updated. The hash expires timeout seconds after its last change.
+
+    :param redis: the Redis client, normally app.redis
+    :param timeout: the number of seconds a job is kept after its last change
+    :param namespace: the prefix for all Redis keys of jobs
+    """
+
+    def __init__(self, redis, timeout: int = 3600, namespace: str = JOB_NAMESPACE):
+        self.redis = redis
+        self.timeout = timeout
+        self.namespace = namespace
+
+    def key(self, job_id: str) -> str:
+        return '{}:{}'.format(self.namespace, job_id)
+
+    def set_fields(self, job_id: str, **fields):
+        """ Changes fields of a job and renews its expiry
+
+        :param job_id: the id of the job
+        """
+        fields['updated'] = time()
+        self.redis.hset(self.key(job_id), mapping={k: str(v) for k, v in fields.items()})
+        self.redis.expire(self.key(job_id), self.timeout)
+
+    def create(self, job_id: str, kind: str, state: str = 'running', total: int = 0, owner: str = ''):
+        """ Registers a new job. An earlier job with the same id, including its cancellation, is replaced.
+
+        :param job_id: the id of the job, e.g., 'search_progress_1234'
+        :param kind: the kind of job, e.g., 'search' or 'pdf_export'
+        :param state: 'queued' or 'running'
+        :param total: the number of items the job has to process, if it is known
+        :param owner: the token of the session that may cancel the job, normally job_owner()
+        """
+        self.redis.delete(self.key(job_id))
+        self.set_fields(job_id, kind=kind, state=state, phase='', done=0, total=total, percent=0, cancelled=0,
+                        result='', error='', owner=owner, created=time())
+
+    def progress(self, job_id: str, phase: str, percent: int, done: int = 0, total: int = 0):
+        """ Reports the progress of a running job and stops the job if it has been cancelled
+
+        :param job_id: the id of the job
+        :param phase: the name of the current phase, e.g., 'highlight'
+        :param percent: the progress of the whole job from 0 to 100
+        :param done: the number of items of the phase that have been processed
+        :param total: the number of items of the phase
+        :raises JobCancelled: if the job has been cancelled
+        """
+        self.check_cancelled(job_id)
+        self.set_fields(job_id, state='running', phase=phase, percent=percent, done=done, total=total)
+
+    def check_cancelled(self, job_id: str):
+        """ Stops a job if it has been cancelled
+
+        :param job_id: the id of the job
+        :raises JobCancelled: if the job has been cancelled
+        """
+        if self.redis.hget(self.key(job_id), 'cancelled') == b'1':
+            raise JobCancelled(job_id)
+
+    def finish(self, job_id: str, result: str = ''):
+        """ Marks a job as done
+
+        :param job_id: the id of the job
+        :param result: a pointer to the result of the job, e.g., the id of the written file
+        """
+        self.set_fields(job_id, state='done', percent=100, result=result)
+
+    def fail(self, job_id: str, error: str):
+        """ Marks a job as failed
+
+        :param job_id: the id of the job
+        :param error: the description of the error
+        """
+        self.set_fields(job_id, state='failed', error=error)
+
+    def cancel(self, job_id: str, owner: str = '') -> bool:
+        """ Asks a job to stop. The job stops the next time it reports its progress.
+
+        :param job_id: the id of the job
+        :param owner: the token of the session that asks, normally job_owner()
+        :return: False if the job does not exist, is already finished or was started by another session
+        """
+        job = self.get(job_id)
+        if job is None or job['state'] in FINISHED_STATES or job.get('owner', '') != owner:
+            return False
+        self.set_fields(job_id, cancelled=1, state='cancelled')
+        return True
+
+    def get(self, job_id: str) -> Union[Dict[str, Any], None]:
+        """ The state and the progress of a job
+
+        :param job_id: the id of the job
+        :return: the fields of the job, with 'progress' as a percentage string, or None if there is no such job
+        """
+        fields = {k.decode(): v.decode() for k, v in self.redis.hgetall(self.key(job_id)).items()}
+        if not fields:
+            return None
+        job = dict(fields)
+        for field in ('done', 'total', 'percent', 'cancelled'):
+            job[field] = int(fields.get(field) or 0)
+        for field in ('created', 'updated'):
+            job[field] = float(fields.get(field) or 0)
+        job['cancelled'] = bool(job['cancelled'])
+        job['id'] = job_id
+        job['progress'] = '{}%'.format(job['percent'])
+        return job
+
+
+def get_job_registry() -> JobRegistry:
+    """ The job registry of the current app, created once per process
+
+    :return: the registry
+    """
+    registry = current_app.extensions.get('job_registry')
+    if registry is None:
+        registry = JobRegistry(current_app.redis, timeout=current_app.config.get('JOB_TIMEOUT', 3600))
+        current_app.extensions['job_registry'] = registry
+    return registry
+
+
+def job_owner() -> str:
+    """ The token that identifies the session of the current request as the owner of the jobs it starts, so that
+    only this session can cancel them. The job ids themselves are not secret, e.g., those of background searches.
+
+    :return: the token or '' outside of a request
+    """
+    if not has_request_context():
+        return ''
+    if 'job_owner' not in session:
+        session['job_owner'] = uuid4().hex
+    return session['job_owner']
@@ -0,0 +1,82 @@
+import os
+import sys
+from typing import Dict, List, Tuple
+
+SMAPS_FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+                'Private_Clean': 'private', 'Private_Dirty': 'private'}
+
+
+def process_memory(pid: int) -> Dict[str, int]:
+    """ Reads the memory usage of a process from /proc (Linux only).
+
+    RSS counts every resident page of the process, PSS divides shared pages by the number of processes sharing them.
+    The sum of the PSS of the gunicorn master and its workers is therefore the real memory footprint of the application.
+
+    :param pid: the process ID
+    :return: dictionary with 'rss', 'pss', 'shared' and 'private' in kB. Empty if the values cannot be read.
+    """
+    values = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0}
+    for file_name in ('smaps_rollup', 'smaps'):
+        try:
+            with open('/proc/{}/{}'.format(pid, file_name)) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0].rstrip(':') in SMAPS_FIELDS:
+                        values[SMAPS_FIELDS[parts[0].rstrip(':')]] += int(parts[1])
+            return values
+        except (OSError, ValueError):
+            continue
+    return {}
+
+
+def child_pids(pid: int) -> List[int]:
+    """ Finds the direct children of a process, i.e., the workers of a gunicorn master
+
+    :param pid: the process ID of the parent
+    :return: the sorted process IDs of the children
+    """
+    children = set()
+    try:
+        tasks = os.listdir('/proc/{}/task'.format(pid))
+    except OSError:
+        return []
+    for task in tasks:
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                children.update(int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return sorted(children)
+
+
+def memory_report(master_pid: int) -> List[Tuple[str, int, Dict[str, int]]]:
+    """ Collects the memory usage of a gunicorn master and all of its workers
+
+    :param master_pid: the process ID of the gunicorn master
+    :return: list of (role, pid, memory values) with the master first
+    """
+    rows = [('master', master_pid, process_memory(master_pid))]
+    rows += [('worker', pid, process_memory(pid)) for pid in child_pids(master_pid)]
+    return rows
+
+
+def format_memory_report(rows: List[Tuple[str, int, Dict[str, int]]]) -> str:
+    """ Formats the output of memory_report as a table with a total line
+
+    :param rows: the rows returned by memory_report
+    :return: the table as a string
+    """
+    lines = ['{:<8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('role', 'pid', 'rss_kb', 'pss_kb', 'shared_kb', 'private_kb')]
+    for role, pid, values in rows:
+        lines.append('{:<8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(role, pid, values.get('rss', '-'), values.get('pss', '-'),
+                                                                   values.get('shared', '-'), values.get('private', '-')))
+    lines.append('{:<8} {:>8} {:>10} {:>10}'.format('total', '', sum(v.get('rss', 0) for r, p, v in rows),
+                                                    sum(v.get('pss', 0) for r, p, v in rows)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Usage: python -m formulae.services.memory_service <gunicorn master pid>
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python -m formulae.services.memory_service <gunicorn master pid>')
+    print(format_memory_report(memory_report(int(sys.argv[1]))))
@@ -0,0 +1,51 @@
+from typing import Hashable, Union
+
+from formulae.services.blob_store import BlobStore, BlobStoreWriter, blob_store_path
+
+
+PASSAGE_STORE_PREFIX = 'passages_'
+
+
+def passage_store_path(store_folder: str, key: str) -> str:
+    """ The directory in which the pre-rendered passages for a certain corpus fingerprint are stored
+
+    :param store_folder: the folder for passage stores (``PASSAGE_STORE_FOLDER``)
+    :param key: the fingerprint of the corpus and the XSLT stylesheets
+    :return: the path to the store directory
+    """
+    return blob_store_path(store_folder, PASSAGE_STORE_PREFIX, key)
+
+
+class PassageStoreWriter(BlobStoreWriter):
+    """ Writes pre-rendered HTML into a new passage store. Identical HTML strings (e.g., empty notes) are stored only once.
+
+    :param store_folder: the folder for passage stores (``PASSAGE_STORE_FOLDER``)
+    :param key: the fingerprint of the corpus and the XSLT stylesheets
+    """
+    prefix = PASSAGE_STORE_PREFIX
+
+    def add(self, key: Hashable, html: str):
+        """ Stores the HTML for one entry
+
+        :param key: the entry key, e.g., (objectId, subreference, 'passage')
+        :param html: the rendered HTML
+        """
+        super(PassageStoreWriter, self).add(key, html.encode('utf-8'))
+
+
+class PassageStore(BlobStore):
+    """ Read access to the pre-rendered passages for the current corpus fingerprint
+
+    :param store_folder: the folder for passage stores (``PASSAGE_STORE_FOLDER``)
+    :param key: the fingerprint of the corpus and the XSLT stylesheets
+    """
+    prefix = PASSAGE_STORE_PREFIX
+
+    def get(self, key: Hashable) -> Union[str, None]:
+        """ Returns the stored HTML for an entry
+
+        :param key: the entry key, e.g., (objectId, subreference, 'passage')
+        :return: the HTML string or None if the entry is not in the store
+        """
+        data = super(PassageStore, self).get(key)
+        return None if data is None else data.decode('utf-8')
@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from typing import Iterable, Iterator, List, Tuple
+
+from formulae.services.pdf_service import pdf_description, pdf_filename, write_pdf
+
+
+# The NemoFormulae instance of the batch, inherited by the forked worker processes
+_batch_nemo = None
+
+
+def init_pdf_worker():
+    """ Registers the fonts once in every worker process of the batch"""
+    _batch_nemo.register_font()
+
+
+def render_text_pdf(objectId: str, folder: str, encrypt: bool) -> Tuple[str, str, float, int]:
+    """ Renders the PDF of a text into a folder, in a worker process of the batch
+
+    :param objectId: the URN of the text
+    :param folder: the folder for the PDF
+    :param encrypt: whether texts of the formulae collection are encrypted as for users outside the project team
+    :return: the URN, the file name, the seconds it took to render the PDF and the size of the PDF in bytes
+    """
+    nemo = _batch_nemo
+    start = perf_counter()
+    metadata = nemo.resolver.getMetadata(objectId=objectId)
+    doc_title, description = pdf_description(metadata)
+    # The URN keeps the file names of texts with the same title apart
+    file_name = '{}_{}.pdf'.format(re.sub(r'\W+', '_', objectId.split(':')[-1]), pdf_filename(description))
+    path = os.path.join(folder, file_name)
+    with nemo.app.test_request_context():
+        write_pdf(path, objectId, metadata, doc_title, description,
+                  encrypt and 'formulae_collection' in metadata.ancestors, nemo.static_folder, nemo.transform,
+                  nemo.get_passage, nemo.get_reffs, nemo.app.config['PDF_ENCRYPTION_PW'])
+    return objectId, file_name, perf_counter() - start, os.path.getsize(path)
+
+
+def render_pdfs(nemo, object_ids: List[str], folder: str, processes: int,
+                encrypt: bool = False) -> Iterator[Tuple[str, str, float, int]]:
+    """ Renders the PDFs of many texts in a pool of processes. The processes are forked from the current process, so
+    they share the resolver and the corpus data of nemo without loading them again.
+
+    :param nemo: the NemoFormulae instance of the app
+    :param object_ids: the URNs of the texts
+    :param folder: the folder for the PDFs
+    :param processes: the number of worker processes
+    :param encrypt: whether texts of the formulae collection are encrypted as for users outside the project team
+    :return: the result of render_text_pdf for every text in the order in which they are finished.
+        Texts whose PDF cannot be rendered are logged and skipped.
+    """
+    global _batch_nemo
+    _batch_nemo = nemo
+    os.makedirs(folder, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_pdf_worker) as executor:
+        futures = {executor.submit(render_text_pdf, objectId, folder, encrypt): objectId for objectId in object_ids}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as E:
+                nemo.app.logger.warning('No PDF for {}: {}'.format(futures[future], E))
+
+
+def collection_texts(nemo, collection_ids: Iterable[str]) -> List[str]:
+    """ The URNs of the readable texts of collections
+
+    :param nemo: the NemoFormulae instance of the app
+    :param collection_ids: the URNs of the collections, e.g., 'urn:cts:formulae:marculf'
+    :return: the URNs of the texts in the order of the collection
+    """
+    object_ids = list()
+    seen = set()
+    for collection_id in collection_ids:
+        for text in nemo.all_texts[collection_id]:
+            if text.id not in seen:
+                seen.add(text.id)
+                object_ids.append(text.id)
+    return object_ids
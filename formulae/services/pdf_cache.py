@@ -0,0 +1,95 @@
+import os
+import tempfile
+from hashlib import sha256
+from typing import Callable, Iterable, Union
+
+
+PDF_CACHE_PREFIX = 'pdf_'
+
+
+class PdfCache(object):
+    """ Keeps generated PDFs as files in a folder.
+
+    Every PDF is written to a temporary file that replaces the final file when it is complete, so readers never see a
+    partial PDF. Reading a PDF updates its modification time. When the PDFs in the folder are larger than max_bytes,
+    the least recently used ones are removed.
+
+    :param folder: the folder for the PDFs
+    :param max_bytes: the maximum size of all PDFs in the folder (0 -> no caching)
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.folder) and self.max_bytes > 0
+
+    def path(self, key: Iterable[str]) -> str:
+        """ The file of the PDF for a key
+
+        :param key: the values that determine the content of the PDF
+        :return: the path of the PDF in the cache folder
+        """
+        digest = sha256('\0'.join(str(k) for k in key).encode()).hexdigest()
+        return os.path.join(self.folder, '{}{}.pdf'.format(PDF_CACHE_PREFIX, digest))
+
+    def get(self, key: Iterable[str]) -> Union[str, None]:
+        """ The cached PDF for a key
+
+        :param key: the values that determine the content of the PDF
+        :return: the path of the PDF or None if it is not in the cache
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key: Iterable[str], write: Callable[[str], None]) -> str:
+        """ Writes a PDF to the cache and removes the least recently used PDFs if the cache is too large
+
+        :param key: the values that determine the content of the PDF
+        :param write: the function that writes the PDF to the file name it is given
+        :return: the path of the cached PDF
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.' + PDF_CACHE_PREFIX)
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = None):
+        """ Removes the least recently used PDFs until the PDFs in the folder are not larger than max_bytes
+
+        :param keep: a PDF that should not be removed, e.g., the one that has just been written
+        """
+        files = list()
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith(PDF_CACHE_PREFIX) and entry.is_file():
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
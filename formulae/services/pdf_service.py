@@ -104,10 +104,12 @@ def str_from_xml_paragraph(paragraph: etree._Element) -> str:
     return re.sub(u'\u200c', '', paragraph_str)
 
 from datetime import date
+from hashlib import sha256
 from io import BytesIO
 import re
 from copy import copy
-from flask import Response, url_for
+from typing import Tuple
+from flask import Response, send_file, url_for
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable, Frame
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import inch
@@ -117,11 +119,24 @@ from lxml import etree
 
 
 from reportlab.lib.pdfencrypt import EncryptionFlowable
+from formulae.services.pdf_cache import PdfCache
 
-def render_pdf_response(objectId, resolver, static_folder, check_project_team, transform,
-                        get_passage, get_reffs, encryption_pw) -> Response:
-    """Generates a PDF from TEI XML and returns a Flask Response with encryption if required."""
-    metadata = resolver.getMetadata(objectId=objectId)
+def pdf_cache_key(objectId: str, corpus_key: str, encrypted: bool, encryption_pw: str) -> Tuple[str, ...]:
+    """ The values that determine the content of the PDF of a text
+
+    :param objectId: the URN of the text
+    :param corpus_key: the fingerprint of the corpus
+    :param encrypted: whether the PDF is encrypted
+    :param encryption_pw: the owner password of encrypted PDFs
+    :return: the key of the PDF in the PdfCache
+    """
+    return (objectId, corpus_key, 'encrypted' if encrypted else 'open',
+            sha256(encryption_pw.encode()).hexdigest() if encrypted else '', date.today().isoformat())
+
+
+def write_pdf(target, objectId, metadata, doc_title, description, encrypted, static_folder, transform,
+              get_passage, get_reffs, encryption_pw):
+    """Renders the PDF of a text from its TEI XML to target, a file name or a file-like object."""
     is_formula = 'formulae_collection' in metadata.ancestors
 
     new_subref = get_reffs(objectId)[0][0]
@@ -132,14 +147,7 @@ def render_pdf_response(objectId, resolver, static_folder, check_project_team, t
     transformed_str = transformed_str.replace('<?xml version="1.0" encoding="UTF-8"?>', '')
     transformed_xml = etree.fromstring(transformed_str)
 
-    doc_title_raw = str(metadata.metadata.get_single('http://purl.org/dc/elements/1.1/title', lang=None))
-    doc_title = re.sub(r'<span class="manuscript-number">(\w+)</span>', r'<sub>\1</sub>',
-                       re.sub(r'<span class="verso-recto">([^<]+)</span>', r'<super>\1</super>', doc_title_raw))
-    description = f'{doc_title} ({date.today().isoformat()})'
-    filename = _slugify_filename(description)
-
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, title=description)
+    doc = SimpleDocTemplate(target, title=description)
 
     style_sheet = getSampleStyleSheet()
     style_sheet['BodyText'].fontName = 'Liberation'
@@ -160,7 +168,7 @@ def render_pdf_response(objectId, resolver, static_folder, check_project_team, t
     flowables = build_flowables(transformed_xml, doc_title, style_sheet, note_style)
 
     # Only add encryption flowable if needed
-    if check_project_team() is False and is_formula:
+    if encrypted:
         flowables.append(EncryptionFlowable(
             userPassword='',
             ownerPassword=encryption_pw,
@@ -176,13 +184,59 @@ def render_pdf_response(objectId, resolver, static_folder, check_project_team, t
         onLaterPages=lambda c, d: add_citation_info(c, d, metadata, is_formula, static_folder, objectId, cit_style)
     )
 
-    safe_filename = re.sub(r'\W+', '_', filename)
+
+def cached_pdf(objectId, resolver, static_folder, encrypted, transform, get_passage, get_reffs, encryption_pw,
+               cache: PdfCache, corpus_key: str) -> str:
+    """Returns the file of the PDF of a text from the PDF cache and renders it into the cache if it is not there."""
+    key = pdf_cache_key(objectId, corpus_key, encrypted, encryption_pw)
+    path = cache.get(key)
+    if path is None:
+        metadata = resolver.getMetadata(objectId=objectId)
+        doc_title, description = pdf_description(metadata)
+        path = cache.put(key, lambda target: write_pdf(target, objectId, metadata, doc_title, description, encrypted,
+                                                       static_folder, transform, get_passage, get_reffs, encryption_pw))
+    return path
+
+
+def pdf_description(metadata) -> Tuple[str, str]:
+    """Returns the title of a text as ReportLab markup and the dated title of its PDF."""
+    doc_title_raw = str(metadata.metadata.get_single('http://purl.org/dc/elements/1.1/title', lang=None))
+    doc_title = re.sub(r'<span class="manuscript-number">(\w+)</span>', r'<sub>\1</sub>',
+                       re.sub(r'<span class="verso-recto">([^<]+)</span>', r'<super>\1</super>', doc_title_raw))
+    description = f'{doc_title} ({date.today().isoformat()})'
+    return doc_title, description
+
+
+def render_pdf_response(objectId, resolver, static_folder, check_project_team, transform,
+                        get_passage, get_reffs, encryption_pw, cache: PdfCache = None, corpus_key: str = '') -> Response:
+    """Generates a PDF from TEI XML and returns a Flask Response with encryption if required.
+    If the PDF cache is enabled, the PDF is taken from the cache or rendered into it and then sent from there."""
+    metadata = resolver.getMetadata(objectId=objectId)
+    is_formula = 'formulae_collection' in metadata.ancestors
+    encrypted = check_project_team() is False and is_formula
+
+    doc_title, description = pdf_description(metadata)
+    safe_filename = pdf_filename(description)
+
+    if cache is not None and cache.enabled:
+        path = cached_pdf(objectId, resolver, static_folder, encrypted, transform, get_passage, get_reffs,
+                          encryption_pw, cache, corpus_key)
+        return send_file(path, mimetype='application/pdf', as_attachment=True, download_name=f'{safe_filename}.pdf')
+
+    buffer = BytesIO()
+    write_pdf(buffer, objectId, metadata, doc_title, description, encrypted, static_folder, transform,
+              get_passage, get_reffs, encryption_pw)
     return Response(buffer.getvalue(), mimetype='application/pdf',
                     headers={'Content-Disposition': f'attachment;filename={safe_filename}.pdf'})
 
 
 
 
+def pdf_filename(description: str) -> str:
+    """Returns the file name, without extension, of the PDF with the dated title description."""
+    return re.sub(r'\W+', '_', _slugify_filename(description))
+
+
 def _slugify_filename(description: str) -> str:
     trans_table = str.maketrans({
         'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss',
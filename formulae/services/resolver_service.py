@@ -0,0 +1,201 @@
+import io
+import logging
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Any, List, Optional, Tuple
+
+from lxml import etree
+from MyCapytain.common.constants import get_graph
+from MyCapytain.resolvers.capitains.local import XmlCapitainsLocalResolver
+
+logger = logging.getLogger(__name__)
+
+GRAPH_PERSISTENT_ID = 'mycapytain_graph'
+CAPITAINS_NS = 'http://purl.org/capitains/ns/1.0#'
+# The same pattern that XmlCapitainsLocalResolver uses to find the top-level collections of a corpus folder
+TEXTGROUP_PATTERN = '{base_folder}/data/*/__capitains__.xml'
+
+
+class ResolverMergeError(Exception):
+    """ Raised when the resolvers of several corpus folders cannot be merged safely"""
+
+
+class _GraphPickler(pickle.Pickler):
+    """ Pickles resolver objects without the MyCapytain triple graph that all metadata objects share"""
+    def persistent_id(self, obj: Any):
+        if obj is get_graph():
+            return GRAPH_PERSISTENT_ID
+        return None
+
+
+class _GraphUnpickler(pickle.Unpickler):
+    """ Reconnects unpickled resolver objects to the MyCapytain triple graph of the current process"""
+    def persistent_load(self, pid: str):
+        if pid == GRAPH_PERSISTENT_ID:
+            return get_graph()
+        raise pickle.UnpicklingError('Unknown persistent id {}'.format(pid))
+
+
+def corpus_shards(folder: str) -> List[List[str]]:
+    """ Splits the top-level collections (textgroups) of a corpus folder into groups that can be parsed independently.
+
+    A textgroup whose __capitains__.xml lists a member in another textgroup of the folder (e.g., a collected collection)
+    is put in the same group as that textgroup. Each group is a run of consecutive textgroups in the order in which
+    XmlCapitainsLocalResolver parses them, so that merging the resolvers of the groups in order gives the same order as
+    parsing the whole folder.
+
+    :param folder: the corpus folder
+    :return: the names of the textgroup directories of each group
+    """
+    files = glob(TEXTGROUP_PATTERN.format(base_folder=folder))
+    names = [os.path.basename(os.path.dirname(f)) for f in files]
+    position = {name: i for i, name in enumerate(names)}
+    data_folder = os.path.normpath(os.path.join(folder, 'data'))
+    # The last position that the group starting at each textgroup has to reach
+    ends = list(range(len(names)))
+    for i, f in enumerate(files):
+        for member in etree.parse(f).iterfind('.//{{{}}}members/{{{}}}collection[@path]'.format(CAPITAINS_NS, CAPITAINS_NS)):
+            path = os.path.relpath(os.path.normpath(os.path.join(os.path.dirname(f), member.get('path'))), data_folder)
+            j = position.get(path.split(os.sep)[0], i)
+            ends[min(i, j)] = max(ends[min(i, j)], i, j)
+    shards = []
+    end = -1
+    for i, name in enumerate(names):
+        if i > end:
+            shards.append([])
+        shards[-1].append(name)
+        end = max(end, ends[i])
+    return shards
+
+
+def parse_corpus_shard(folder: str, textgroups: Optional[List[str]] = None) -> Tuple[bytes, List[tuple]]:
+    """ Parses a corpus folder, or only some of its textgroups, in a worker process
+
+    :param folder: the corpus folder
+    :param textgroups: the names of the textgroup directories to parse. None -> the whole folder
+    :return: the pickled resolver and the triples that parsing added to the MyCapytain graph
+    """
+    graph = get_graph()
+    # The worker may have parsed another shard before. Only the triples of this shard are sent back.
+    graph.remove((None, None, None))
+    resolver_module = sys.modules[XmlCapitainsLocalResolver.__module__]
+    if textgroups is not None:
+        data_folder = os.path.normpath(os.path.join(folder, 'data'))
+
+        def shard_glob(pattern: str, *args, **kwargs) -> List[str]:
+            return [f for f in glob(pattern, *args, **kwargs)
+                    if os.path.dirname(os.path.dirname(os.path.normpath(f))) != data_folder
+                    or os.path.basename(os.path.dirname(f)) in textgroups]
+        resolver_module.glob = shard_glob
+    try:
+        resolver = XmlCapitainsLocalResolver([folder])
+    finally:
+        resolver_module.glob = glob
+    f = io.BytesIO()
+    _GraphPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(resolver)
+    return f.getvalue(), list(graph)
+
+
+def merge_mapping(target: dict, source: dict, name: str, shared_ids: set):
+    """ Merges one of the resolver's lookup dictionaries (e.g., id_to_coll or children) into the same dictionary of another resolver
+
+    :param target: the dictionary of the resolver that is kept
+    :param source: the dictionary of the resolver of the next corpus folder
+    :param name: the name of the attribute for error messages
+    :param shared_ids: the collection IDs that may occur in both resolvers
+    """
+    for k, v in source.items():
+        if k not in target:
+            target[k] = v
+        elif isinstance(target[k], set) and isinstance(v, set):
+            target[k] |= v
+        elif isinstance(target[k], list) and isinstance(v, list):
+            target[k] += [x for x in v if x not in target[k]]
+        elif isinstance(target[k], dict) and isinstance(v, dict):
+            target[k].update(v)
+        elif k not in shared_ids and target[k] != v:
+            raise ResolverMergeError('{} contains conflicting values for {}'.format(name, k))
+
+
+def reparent(collection: Any, old_root: Any, new_root: Any):
+    """ Replaces the references of a collection to the root collection of its own resolver with the root of the merged resolver
+
+    :param collection: a collection of the resolver that is merged
+    :param old_root: the root collection of that resolver
+    :param new_root: the root collection of the merged resolver
+    """
+    for name, value in vars(collection).items():
+        if value is old_root:
+            setattr(collection, name, new_root)
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                if v is old_root:
+                    value[k] = new_root
+        elif isinstance(value, list):
+            value[:] = [new_root if v is old_root else v for v in value]
+
+
+def merge_resolvers(resolvers: List[XmlCapitainsLocalResolver]) -> XmlCapitainsLocalResolver:
+    """ Merges the resolvers of several corpus folders into the first one, in the order of the folders.
+
+    Only the root collection may be shared between the folders. If any other collection is defined in more than one
+    folder, ResolverMergeError is raised because its members would have to be merged object by object. The collections
+    of the other resolvers are attached to the root collection of the first one.
+
+    :param resolvers: the resolvers, one per corpus folder
+    :return: the merged resolver
+    """
+    base = resolvers[0]
+    base_root = base.getMetadata()
+    for other in resolvers[1:]:
+        other_root = other.getMetadata()
+        shared_ids = set(base.id_to_coll).intersection(other.id_to_coll)
+        if shared_ids - {base_root.id}:
+            raise ResolverMergeError('Collections defined in more than one folder: {}'.format(sorted(shared_ids)[:10]))
+        if not isinstance(getattr(base_root, 'children', None), dict) or not isinstance(getattr(other_root, 'children', None), dict):
+            raise ResolverMergeError('The root collection does not expose its children.')
+        for name, value in vars(base).items():
+            other_value = getattr(other, name, None)
+            if isinstance(value, dict) and isinstance(other_value, dict) and value is not base_root.children:
+                merge_mapping(value, other_value, name, shared_ids)
+        for collection in other.id_to_coll.values():
+            if collection is not other_root:
+                reparent(collection, other_root, base_root)
+        base_root.children.update(other_root.children)
+    return base
+
+
+def make_resolver(folders: List[str], processes: int = 0) -> XmlCapitainsLocalResolver:
+    """ Builds the resolver for the corpus folders, optionally parsing them in parallel.
+
+    With processes > 1, the textgroups of each folder are split into groups that do not refer to each other
+    (corpus_shards) and each group is parsed by its own resolver in a process pool. The resolvers are merged in the
+    order of the folders and textgroups, so the result is the same as that of a serial parse. If the resolvers cannot
+    be transferred between the processes or cannot be merged safely, the folders are parsed serially as before.
+
+    :param folders: the corpus folders (CORPUS_FOLDERS)
+    :param processes: the maximum number of worker processes. 0 or 1 -> serial parsing
+    :return: the resolver
+    """
+    if processes > 1:
+        try:
+            if getattr(sys.modules[XmlCapitainsLocalResolver.__module__], 'glob', None) is glob:
+                shards = [(folder, textgroups) for folder in folders for textgroups in corpus_shards(folder)]
+            else:
+                # The resolver does not look for the textgroups with glob, so a folder cannot be parsed in parts
+                shards = [(folder, None) for folder in folders]
+            if len(shards) > 1:
+                with ProcessPoolExecutor(max_workers=min(processes, len(shards))) as executor:
+                    results = list(executor.map(parse_corpus_shard, *zip(*shards)))
+                resolver = merge_resolvers([_GraphUnpickler(io.BytesIO(pickled_resolver)).load() for pickled_resolver, triples in results])
+                graph = get_graph()
+                for pickled_resolver, triples in results:
+                    for triple in triples:
+                        graph.add(triple)
+                return resolver
+        except Exception as E:
+            logger.warning('Parallel corpus ingestion failed ({}: {}). Parsing the corpus folders serially.'.format(type(E).__name__, E))
+    return XmlCapitainsLocalResolver(folders)
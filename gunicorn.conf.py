@@ -0,0 +1,37 @@
+""" Gunicorn settings for production, e.g., `gunicorn -c gunicorn.conf.py app:flask_app`
+
+The application, including the XmlCapitainsLocalResolver and the NemoFormulae corpus data, is built once in the master.
+The objects that exist at that point are then moved to the permanent generation with gc.freeze() so that the garbage
+collector does not touch them in the workers and the copy-on-write pages stay shared between all workers.
+Set GUNICORN_PRELOAD=0 to build the application separately in every worker.
+"""
+import gc
+import os
+
+from formulae.services.memory_service import process_memory
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    """ Called in the master after the application has been loaded and before the workers are forked"""
+    if server.cfg.preload_app:
+        from formulae.app import nemo
+        nemo.finish_corpus_warm_up()
+        gc.collect()
+        gc.freeze()
+        server.log.info('Froze %s objects before forking the workers', gc.get_freeze_count())
+    server.log.info('Master %s memory (kB): %s', os.getpid(), process_memory(os.getpid()))
+
+
+def post_fork(server, worker):
+    """ Database connections must not be shared between processes, so drop any connection the master might have opened"""
+    if server.cfg.preload_app:
+        from formulae import db
+        from formulae.app import flask_app
+        with flask_app.app_context():
+            db.engine.dispose()
+
+
+def post_worker_init(worker):
+    worker.log.info('Worker %s memory (kB): %s', worker.pid, process_memory(worker.pid))
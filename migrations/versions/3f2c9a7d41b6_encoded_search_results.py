@@ -0,0 +1,92 @@
+"""encoded search results
+
+Revision ID: 3f2c9a7d41b6
+Revises: 8e1e2fd2031a
+Create Date: 2026-10-18 09:30:12.513274
+
+"""
+import json
+import zlib
+
+from alembic import op
+from markupsafe import Markup
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2c9a7d41b6'
+down_revision = '8e1e2fd2031a'
+branch_labels = None
+depends_on = None
+
+# The codec of formulae.search.result_store as it was when this revision was written. It is copied here so that later
+# changes to the application cannot change what this migration writes or reads.
+RESULT_CODEC_VERSION = 1
+
+
+def encode_results(results):
+    """ The saved results in version 1 of the codec: the version byte followed by the zlib-compressed JSON of
+    [id, title, sentences, sentence spans, regest sentences] for every hit
+
+    :param results: the result dictionaries that were pickled in saved_page.search_results
+    :return: the encoded results
+    """
+    compact = []
+    for r in results:
+        info = r.get('info') if isinstance(r.get('info'), dict) else {}
+        compact.append([r['id'],
+                        info.get('title', r.get('title', '')),
+                        [str(s) for s in r.get('sents', [])],
+                        [[s.start, s.stop] if isinstance(s, range) else s for s in r.get('sentence_spans', [])],
+                        [str(s) for s in r.get('regest_sents', [])]])
+    return bytes([RESULT_CODEC_VERSION]) + zlib.compress(json.dumps(compact, separators=(',', ':')).encode())
+
+
+def decode_results(data):
+    """ The result dictionaries of results in version 1 of the codec
+
+    :param data: the encoded results
+    :return: the result dictionaries
+    """
+    if not data or data[0] != RESULT_CODEC_VERSION:
+        raise ValueError('Unknown version of encoded search results: {}'.format(data[:1]))
+    results = []
+    for doc_id, title, sents, spans, regest_sents in json.loads(zlib.decompress(data[1:]).decode()):
+        sents = [Markup(s) for s in sents]
+        results.append({'id': doc_id,
+                        'info': {'title': title},
+                        'title': title,
+                        'sents': sents,
+                        'sentence_spans': [range(*s) if isinstance(s, (list, tuple)) else s for s in spans],
+                        'regest_sents': [Markup(s) for s in regest_sents],
+                        'highlight': sents})
+    return results
+
+
+def convert_column(old_type, new_type, convert):
+    """ Replaces saved_page.search_results with a column of new_type and converts the saved results
+
+    :param old_type: the type of the existing column
+    :param new_type: the type of the new column
+    :param convert: the function that converts the value of a row
+    """
+    op.add_column('saved_page', sa.Column('search_results_new', new_type, nullable=True))
+    saved_page = sa.table('saved_page', sa.column('id', sa.Integer()), sa.column('search_results', old_type),
+                          sa.column('search_results_new', new_type))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(saved_page.c.id, saved_page.c.search_results)).fetchall()
+    for page_id, search_results in rows:
+        if search_results:
+            connection.execute(saved_page.update().where(saved_page.c.id == page_id)
+                               .values(search_results_new=convert(search_results)))
+    with op.batch_alter_table('saved_page') as batch_op:
+        batch_op.drop_column('search_results')
+        batch_op.alter_column('search_results_new', new_column_name='search_results')
+
+
+def upgrade():
+    convert_column(sa.PickleType(), sa.LargeBinary(), encode_results)
+
+
+def downgrade():
+    convert_column(sa.LargeBinary(), sa.PickleType(), decode_results)
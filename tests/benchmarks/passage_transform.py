@@ -0,0 +1,43 @@
+""" Compares the time per passage for the XSLT transformation and the extraction of the notes with and without the
+cached stylesheets of NemoFormulae.
+
+Usage: python -m tests.benchmarks.passage_transform [number of repetitions]
+"""
+import sys
+import timeit
+
+from flask_nemo import Nemo
+from lxml import etree
+from MyCapytain.common.constants import Mimetypes
+
+from formulae.nemo import NemoFormulae
+from tests.test_routes import TestFunctions
+
+OBJECT_ID = 'urn:cts:formulae:andecavensis.form004.lat001'
+
+
+def compare_passage_transform(nemo: NemoFormulae, number: int = 50) -> str:
+    xml = nemo.get_passage(objectId=OBJECT_ID, subreference='1')
+
+    def uncached():
+        html = Nemo.transform(nemo, xml, xml.export(Mimetypes.PYTHON.ETREE), OBJECT_ID)
+        with open(nemo._transform['notes']) as f:
+            str(etree.XSLT(etree.parse(f))(etree.fromstring(html)))
+
+    def cached():
+        tree = nemo.transform_tree(xml, xml.export(Mimetypes.PYTHON.ETREE), OBJECT_ID)
+        nemo.serialize_html(tree)
+        nemo.extract_notes(tree)
+
+    cached()
+    return 'Per passage: uncached {:.2f} ms, cached {:.2f} ms'.format(timeit.timeit(uncached, number=number) / number * 1000,
+                                                                     timeit.timeit(cached, number=number) / number * 1000)
+
+
+if __name__ == '__main__':
+    case = TestFunctions()
+    case.setUp()
+    try:
+        print(compare_passage_transform(case.nemo, int(sys.argv[1]) if len(sys.argv) > 1 else 50))
+    finally:
+        case.tearDown()
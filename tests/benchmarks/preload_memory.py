@@ -0,0 +1,79 @@
+""" Compares the memory of gunicorn workers with and without a preloaded application and gc.freeze().
+
+The corpus of the real application cannot be built without the corpus repositories, so this benchmark builds a
+stand-in with the same kind of objects: CORPUS_SIZE TextRecords (formulae.services.corpus_service) with their strings,
+indexed by id and by collection like NemoFormulae.all_texts. Every request reads all records and allocates enough
+objects to start a full garbage collection, as the corpus routes do in a running worker.
+
+Usage: python -m tests.benchmarks.preload_memory [number of workers]
+"""
+import gc
+import os
+import subprocess
+import sys
+import time
+from urllib.request import urlopen
+
+from formulae.services.corpus_service import TextRecord
+from formulae.services.memory_service import format_memory_report, memory_report
+
+CORPUS_SIZE = int(os.environ.get('BENCHMARK_CORPUS_SIZE', 100000))
+PORT = 8765
+MODES = [('no preload', []), ('preload', ['--preload']), ('preload + gc.freeze()', ['--preload'])]
+
+
+def build_corpus():
+    records = [TextRecord(par='{:04}'.format(i % 1000), metadata=[i, 'lat', ('form', str(i))],
+                          id='urn:cts:formulae:collection{}.text{:06}.lat001'.format(i % 50, i),
+                          parent_id='urn:cts:formulae:collection{}.text{:06}'.format(i % 50, i),
+                          ancestor_ids=frozenset({'urn:cts:formulae:collection{}'.format(i % 50)}),
+                          title='Collection {} Nr. {}'.format(i % 50, i), regest='Regest of text {} '.format(i) * 10,
+                          dating='{}'.format(700 + i % 300), spatial='Place {}'.format(i % 200),
+                          source='Edition {}, p. {}'.format(i % 50, i))
+               for i in range(CORPUS_SIZE)]
+    by_collection = dict()
+    for r in records:
+        by_collection.setdefault(next(iter(r.ancestor_ids)), []).append(r)
+    return {r.id: r for r in records}, by_collection
+
+
+corpus, all_texts = build_corpus()
+if os.environ.get('BENCHMARK_FREEZE') == '1':
+    gc.collect()
+    gc.freeze()
+
+
+def app(environ, start_response):
+    titles = sum(len(r.title) for texts in all_texts.values() for r in texts)
+    garbage = [[x] for x in range(200000)]
+    gc.collect()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(titles + len(garbage)).encode()]
+
+
+def measure(workers: int, options: list, freeze: bool) -> str:
+    env = dict(os.environ, BENCHMARK_FREEZE='1' if freeze else '0')
+    # gunicorn.conf.py of the repository would load the real application, so the empty __init__.py is used as configuration
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', os.path.join(os.path.dirname(__file__), '__init__.py'), '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(PORT),
+                               '--log-level', 'warning'] + options + ['tests.benchmarks.preload_memory:app'], env=env)
+    try:
+        for _ in range(600):
+            try:
+                urlopen('http://127.0.0.1:{}/'.format(PORT)).read()
+                break
+            except OSError:
+                time.sleep(0.5)
+        for _ in range(workers * 20):
+            urlopen('http://127.0.0.1:{}/'.format(PORT)).read()
+        return format_memory_report(memory_report(server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    number_of_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    for name, gunicorn_options in MODES:
+        print('{} ({} TextRecords, {} workers)'.format(name, CORPUS_SIZE, number_of_workers))
+        print(measure(number_of_workers, gunicorn_options, 'freeze' in name))
+        print()
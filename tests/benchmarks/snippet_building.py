@@ -0,0 +1,29 @@
+""" Compares the time that mark_snippet and the former character loop of lem_highlight_to_text need to build one
+highlighted snippet per hit, using the snippets around the spans of the term vector fixtures of the tests.
+
+Usage: python -m tests.benchmarks.snippet_building [number of hits]
+"""
+import sys
+import timeit
+
+from formulae.search.Search import mark_snippet
+from tests.test_routes import TestES
+
+
+def compare_snippet_building(case: TestES, hits: int = 10000) -> str:
+    cases = list(case.snippet_test_cases())
+    cases = [cases[i % len(cases)] for i in range(hits)]
+    lines = []
+    for name, f in (('character loop', TestES.char_loop_snippet), ('mark_snippet', mark_snippet)):
+        t = timeit.timeit(lambda: [f(*c) for c in cases], number=3) / 3
+        lines.append('{}: {:.1f} ms for {} snippets ({:.0f} snippets/s)'.format(name, t * 1000, hits, hits / t))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    test_case = TestES()
+    test_case.setUp()
+    try:
+        print(compare_snippet_building(test_case, int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
+    finally:
+        test_case.tearDown()
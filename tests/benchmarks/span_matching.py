@@ -0,0 +1,28 @@
+""" Compares the time that find_spans and the former Cartesian product need for the multi-word queries built from the
+term vector fixtures of the tests.
+
+Usage: python -m tests.benchmarks.span_matching [slop]
+"""
+import sys
+import timeit
+
+from formulae.search.spans import find_spans
+from tests.test_routes import TestES
+
+
+def compare_span_matching(case: TestES, slop: int = 10) -> str:
+    cases = list(case.span_test_cases())
+    lines = []
+    for name, f in (('product', TestES.product_spans), ('find_spans', find_spans)):
+        t = timeit.timeit(lambda: [f(c, slop, False) for c in cases], number=3) / 3
+        lines.append('{}: {:.1f} ms for {} queries with slop {}'.format(name, t * 1000, len(cases), slop))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    test_case = TestES()
+    test_case.setUp()
+    try:
+        print(compare_span_matching(test_case, int(sys.argv[1]) if len(sys.argv) > 1 else 10))
+    finally:
+        test_case.tearDown()
@@ -0,0 +1,42 @@
+""" Compares the memory and the access time of the TextRecords in NemoFormulae.all_texts with the former
+(par, metadata, metadata object) tuples for all texts of the test corpus.
+
+Usage: python -m tests.benchmarks.text_records
+"""
+import timeit
+import tracemalloc
+
+from rdflib.namespace import DC, DCTERMS
+
+from formulae.nemo import NemoFormulae
+from tests.test_routes import TestFunctions
+
+FIELDS = [DC.title, DC.description, DCTERMS.abstract, DCTERMS.temporal, DCTERMS.spatial, DC.source]
+
+
+def compare_text_records(nemo: NemoFormulae, number: int = 10) -> str:
+    texts = [x for v in nemo.all_texts.values() for x in v]
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    records = [nemo.text_record(nemo.resolver.getMetadata(x.id), c) for c, v in nemo.all_texts.items() for x in v]
+    record_size = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(snapshot_before, 'filename'))
+    snapshot_before = tracemalloc.take_snapshot()
+    tuples = [nemo.ordered_corpora(nemo.resolver.getMetadata(x.id), c) for c, v in nemo.all_texts.items() for x in v]
+    tuple_size = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(snapshot_before, 'filename'))
+    tracemalloc.stop()
+    tuple_time = timeit.timeit(lambda: [[str(x[2].metadata.get_single(f)) for f in FIELDS] for x in tuples], number=number)
+    record_time = timeit.timeit(lambda: [[x.title, x.regest, x.abstract, x.dating, x.spatial, x.source] for x in records],
+                                number=number)
+    return '\n'.join(['{} texts: records {} bytes, tuples {} bytes (the metadata objects are kept by the resolver in both cases)'
+                      .format(len(texts), record_size, tuple_size),
+                      'Reading {} fields {} times: records {:.4f}s, tuples with rdflib {:.4f}s'
+                      .format(len(FIELDS), number, record_time, tuple_time)])
+
+
+if __name__ == '__main__':
+    case = TestFunctions()
+    case.setUp()
+    try:
+        print(compare_text_records(case.nemo))
+    finally:
+        case.tearDown()
@@ -4,11 +4,31 @@ from config import Config
 from MyCapytain.resolvers.capitains.local import XmlCapitainsLocalResolver
 from formulae import create_app, db, mail
 from formulae.nemo import NemoFormulae
+from formulae.services.corpus_service import TextRecord
+from formulae.services.cache_service import TwoTierCache
+from formulae.services.passage_store import PassageStore, PassageStoreWriter
+from formulae.services.job_service import JobCancelled, JobRegistry, get_job_registry
+from formulae.services.pdf_batch import collection_texts, render_pdfs
+from formulae.services.pdf_cache import PdfCache
+from formulae.services.resolver_service import corpus_shards, make_resolver, merge_resolvers, ResolverMergeError
 from formulae.models import User, load_user
 from formulae.search.Search import advanced_query_index, build_sort_list, \
-    suggest_word_search, PRE_TAGS, POST_TAGS
+    suggest_word_search, mark_snippet, PRE_TAGS, POST_TAGS
 from formulae.search import Search
+from formulae.search.async_search import async_search, async_search_key, get_async_search_executor
+from formulae.search.doc_attributes import DOC_ATTRIBUTE_FIELDS, DocAttributes, get_doc_attributes, load_doc_attributes, \
+    save_doc_attributes
+from formulae.search.executor import get_search_executor
+from formulae.search.expansions import fuzzy_expansions, get_expansion_cache
+from formulae.search.export import export_entries, export_search_pdf, render_search_pdf
+from formulae.search.result_sets import get_result_set_cache
+from formulae.search.result_store import RESULT_STORE_NAMESPACE, RESULT_STORE_SESSION_KEY, clear_previous_search, \
+    compact_results, decode_results, encode_results, expand_results, load_previous_search, save_previous_search
+from formulae.search.spans import find_spans
+from formulae.search.token_store import FieldTokens, TokenStore, TokenStoreWriter, doc_tokens_from_term_vectors, \
+    current_index_key, get_token_store, load_doc_tokens, TOKEN_INDICES
 from formulae.search.routes import make_query_dict, build_search_args
+from flask_nemo import Nemo
 from flask_nemo.filters import slugify
 from formulae.search.forms import AdvancedSearchForm, SearchForm
 from formulae.auth.forms import LoginForm, PasswordChangeForm, LanguageChangeForm, ResetPasswordForm, \
@@ -16,22 +36,28 @@ from formulae.auth.forms import LoginForm, PasswordChangeForm, LanguageChangeFor
 from flask_login import current_user
 from flask_babel import _
 from elasticsearch import Elasticsearch
-from unittest.mock import patch, mock_open
+from reportlab import rl_config
+from unittest.mock import patch, mock_open, Mock
 from unittest import TestCase
 from tests.fake_es import FakeElasticsearch
 from collections import OrderedDict
 import os
+import tempfile
+import threading
 from MyCapytain.common.constants import Mimetypes
 from flask import Markup, session, g, url_for, abort, template_rendered, message_flashed
 from json import dumps, load
+from io import BytesIO
 import re
 from datetime import date
 from copy import copy, deepcopy
 from lxml import etree
-from itertools import cycle
+from itertools import combinations, cycle, product
 from werkzeug import exceptions
 import rdflib
+from rdflib.namespace import DC, DCTERMS
 import requests
+from redis.exceptions import ConnectionError as RedisConnectionError
 
 
 def mocked_requests_post(*args, **kwargs):
@@ -78,6 +104,13 @@ class TestConfig(Config):
     IIIF_MAPPING = "tests/test_data/formulae/iiif"
     IIIF_SERVER = "http://127.0.0.1:5004"
     WORD_GRAPH_API_URL = 'http://localhost:7310'
+    CORPUS_CACHE_SIZE = 0
+    ALL_DOCS_CACHE_TIMEOUT = 0
+    RESULT_SET_CACHE_SIZE = 0
+    PREVIOUS_SEARCH_TIMEOUT = 0
+    PDF_CACHE_SIZE = 0
+    FUZZY_CACHE_SIZE = 0
+    INDEX_CHECK_INTERVAL = 0
 
 
 class NoESConfig(TestConfig):
@@ -201,6 +234,22 @@ class Formulae_Testing(TestCase):
                 return context[name]
         raise AttributeError('"{}" does not exist in this context'.format(name))
 
+    def fake_redis(self):
+        """ A minimal dictionary-based stand-in for the Redis client of the app"""
+        store = dict()
+        redis = Mock()
+        redis.get.side_effect = store.get
+        redis.setex.side_effect = lambda key, timeout, value: store.__setitem__(key, value)
+        redis.scan_iter.side_effect = lambda match: [k.encode() for k in list(store) if k.startswith(match.rstrip('*'))]
+        redis.delete.side_effect = lambda *keys: [store.pop(k.decode() if isinstance(k, bytes) else k, None) for k in keys]
+        redis.hset.side_effect = lambda key, mapping: store.setdefault(key, dict()).update(
+            {k.encode(): v.encode() for k, v in mapping.items()})
+        redis.hget.side_effect = lambda key, field: store.get(key, dict()).get(field.encode())
+        redis.hgetall.side_effect = lambda key: dict(store.get(key, dict()))
+        redis.set.side_effect = lambda key, value, nx=False, ex=None: \
+            None if nx and key in store else store.__setitem__(key, value) or True
+        return redis, store
+
 
 class TestNemoSetup(Formulae_Testing):
 
@@ -796,12 +845,22 @@ class TestIndividualRoutes(Formulae_Testing):
             self.assertIn('main::fulda_d1_desc.html', [x[0].name for x in self.templates])
             # Ensure that the PDF search results progress checker returns the correct value
             r = c.get('/search/pdf_progress/1000')
-            self.assertEqual(r.get_data(as_text=True), '0%',
-                             'If the key does not exist in Redis, it should return "0%"')
-            self.app.redis.setex('pdf_download_1000', 10, '10%')
+            self.assertEqual((r.get_json()['state'], r.get_json()['progress']), ('unknown', '0%'),
+                             'If the job does not exist in Redis, it should return "0%"')
+            with c.session_transaction() as sess:
+                sess['job_owner'] = 'session_1'
+            get_job_registry().create('pdf_download_1000', 'pdf_export', owner='session_2')
+            self.assertFalse(c.post('/search/cancel/1000').get_json()['cancelled'],
+                             'A job should not be cancelled by another session.')
+            get_job_registry().create('pdf_download_1000', 'pdf_export', owner='session_1')
+            get_job_registry().progress('pdf_download_1000', 'render', 10, 1, 10)
             r = c.get('/search/pdf_progress/1000')
-            self.assertEqual(r.get_data(as_text=True), '10%')
-            self.app.redis.delete('pdf_download_1000')
+            self.assertEqual((r.get_json()['state'], r.get_json()['progress']), ('running', '10%'))
+            self.assertNotIn('owner', r.get_json(), 'The owner token should not be sent to the client.')
+            r = c.post('/search/cancel/1000')
+            self.assertTrue(r.get_json()['cancelled'])
+            self.assertEqual(c.get('/search/pdf_progress/1000').get_json()['state'], 'cancelled')
+            self.app.redis.delete(get_job_registry().key('pdf_download_1000'))
             c.get('manuscript_desc/siglen', follow_redirects=True)
             self.assertIn('main::manuscript_siglen.html', [x[0].name for x in self.templates])
             c.get('accessibility_statement', follow_redirects=True)
@@ -820,7 +879,7 @@ class TestIndividualRoutes(Formulae_Testing):
             c.post('/auth/save_page', data=dict(name='St. Gallen 1', save_search_results=True),
                    follow_redirects=True, headers={'Referer': url_for('InstanceNemo.r_multipassage', objectIds='urn:cts:formulae:stgallen.wartmann0001.lat001', subreferences='all', _external=True)})
             self.assertIn('St. Gallen 1', [p.name for p in current_user.pages])
-            self.assertIn([{'id': 'urn:cts:formulae:stgallen.wartmann0001.lat001'}], [p.search_results for p in current_user.pages])
+            self.assertIn([['urn:cts:formulae:stgallen.wartmann0001.lat001', '', [], [], []]], [p.search_results for p in current_user.pages])
             c.post('/auth/save_page', data=dict(name='St. Gallen 1'),
                    follow_redirects=True, headers={'Referer': 'https://www.google.com'})
             self.assertIn(_('Diese URL ist nicht Teil der Werkstatt.'), [x[0] for x in self.flashed_messages])
@@ -829,7 +888,7 @@ class TestIndividualRoutes(Formulae_Testing):
             page_to_remove = [p for p in current_user.pages][0]
             self.assertEqual('<Name St. Gallen 1, URL /texts/urn:cts:formulae:stgallen.wartmann0001.lat001/passage/all?>', page_to_remove.__repr__())
             c.get('/auth/open_page/{}'.format(page_to_remove.id), follow_redirects=True)
-            self.assertEqual(session['previous_search'], [{'id': 'urn:cts:formulae:stgallen.wartmann0001.lat001'}])
+            self.assertEqual(session['previous_search'], [['urn:cts:formulae:stgallen.wartmann0001.lat001', '', [], [], []]])
             r = c.get('/auth/remove_page/{}'.format(page_to_remove.id), follow_redirects=True)
             self.assertEqual(r.request.path, '/auth/saved_pages')
             self.assertEqual([], [p for p in current_user.pages])
@@ -981,7 +1040,7 @@ class TestIndividualRoutes(Formulae_Testing):
             c.post('/auth/save_page', data=dict(name='St. Gallen 1', save_search_results='y'),
                    follow_redirects=True, headers={'Referer': url_for('InstanceNemo.r_multipassage', objectIds='urn:cts:formulae:stgallen.wartmann0001.lat001', subreferences='all', _external=True)})
             self.assertIn('St. Gallen 1', [p.name for p in current_user.pages])
-            self.assertIn([{'id': 'urn:cts:formulae:stgallen.wartmann0001.lat001'}], [p.search_results for p in current_user.pages])
+            self.assertIn([['urn:cts:formulae:stgallen.wartmann0001.lat001', '', [], [], []]], [p.search_results for p in current_user.pages])
             c.post('/auth/save_page', data=dict(name='St. Gallen 1'),
                    follow_redirects=True, headers={'Referer': 'https://www.google.com'})
             self.assertIn(_('Diese URL ist nicht Teil der Werkstatt.'), [x[0] for x in self.flashed_messages])
@@ -989,7 +1048,7 @@ class TestIndividualRoutes(Formulae_Testing):
             self.assertEqual(self.get_context_variable('pages'), [p for p in current_user.pages])
             page_id_to_remove = [p for p in current_user.pages][0].id
             c.get('/auth/open_page/{}'.format(page_id_to_remove), follow_redirects=True)
-            self.assertEqual(session['previous_search'], [{'id': 'urn:cts:formulae:stgallen.wartmann0001.lat001'}])
+            self.assertEqual(session['previous_search'], [['urn:cts:formulae:stgallen.wartmann0001.lat001', '', [], [], []]])
             r = c.get('/auth/remove_page/{}'.format(page_id_to_remove), follow_redirects=True)
             self.assertEqual(r.request.path, '/auth/saved_pages')
             self.assertEqual([], [p for p in current_user.pages])
@@ -1524,6 +1583,48 @@ class TestIndividualRoutes(Formulae_Testing):
             self.assertNotIn('id="header-urn-cts-formulae-elexicon-abbas-deu001"',
                              r.get_data(as_text=True), 'No note card should be rendered for elex.')
 
+    def test_corpus_cache_responses(self):
+        """ Make sure that the corpus pages are the same whether they come from the corpus cache or not"""
+        urls = ['/corpus/urn:cts:formulae:andecavensis', '/corpus/urn:cts:formulae:raetien',
+                '/corpus/urn:cts:formulae:salzburg', '/corpus/urn:cts:formulae:elexicon']
+
+        def responses():
+            # Every round starts with a new session
+            with self.app.test_client() as c:
+                pages = [c.get(url, follow_redirects=True).get_data() for url in urls]
+                c.post('/auth/login', data=dict(username='project.member', password="some_password"), follow_redirects=True)
+                pages += [c.get(url, follow_redirects=True).get_data() for url in urls]
+            return pages
+
+        uncached = responses()
+        redis, store = self.fake_redis()
+        self.nemo.corpus_cache = TwoTierCache(redis, 'formulae:r_corpus', max_items=128)
+        self.assertEqual(responses(), uncached, 'The pages that are added to the cache should not change.')
+        self.assertEqual(responses(), uncached, 'The pages from the local tier should not change.')
+        self.nemo.corpus_cache.local.clear()
+        self.assertEqual(responses(), uncached, 'The pages from Redis should not change.')
+        self.assertEqual(self.nemo.corpus_cache.counts, {'local_hits': 8, 'redis_hits': 8, 'misses': 8})
+
+    def test_pdf_cache_responses(self):
+        """ Make sure that the PDFs of texts are the same whether they come from the PDF cache or not"""
+        # An encrypted and an open PDF
+        urls = ['/pdf/urn:cts:formulae:andecavensis.form002.lat001', '/pdf/urn:cts:formulae:fulda_stengel.stengel0015.lat001']
+
+        def responses():
+            with self.app.test_client() as c:
+                return [c.get(url, follow_redirects=True).get_data() for url in urls]
+
+        # Without the invariant mode, ReportLab writes the time and a random id into every PDF
+        with patch.object(rl_config, 'invariant', 1), tempfile.TemporaryDirectory() as pdf_folder:
+            uncached = responses()
+            self.assertTrue(all(pdf.startswith(b'%PDF') for pdf in uncached))
+            self.nemo.pdf_cache = PdfCache(pdf_folder, 512 * 1024 * 1024)
+            self.assertEqual(responses(), uncached, 'The PDFs that are added to the cache should not change.')
+            self.assertEqual(len(os.listdir(pdf_folder)), 2)
+            with patch('formulae.services.pdf_service.write_pdf') as mock_write:
+                self.assertEqual(responses(), uncached, 'The PDFs from the cache should not change.')
+                mock_write.assert_not_called()
+
 
 class TestFunctions(Formulae_Testing):
     def test_NemoFormulae_get_first_passage(self):
@@ -1968,7 +2069,7 @@ class TestFunctions(Formulae_Testing):
     def test_make_collected_colls(self):
         """ Ensure that the json manuscript notes file is correctly loaded."""
         self.assertIn(['urn:cts:formulae:marculf.form000.lat001', 'Latein', ('lat', '001')],
-                      [x[1] for x in self.nemo.collected_colls['urn:cts:formulae:flavigny_paris']],
+                      [x.metadata for x in self.nemo.collected_colls['urn:cts:formulae:flavigny_paris']],
                       'Collected collections should have loaded correctly.')
         self.app.config['COLLECTED_COLLS'] = ["tests/test_data/formulae/inflected_to_lem_error.txt"]
         with patch.object(self.app.logger, 'warning') as mock:
@@ -2035,19 +2136,327 @@ class TestFunctions(Formulae_Testing):
 
     def test_ordered_corpora(self):
         """ Make sure that the corpora are correctly ordered"""
-        self.assertEqual([x[1][0] for x in self.nemo.all_texts['urn:cts:formulae:marculf'] if x[0] == '1_000b'],
+        self.assertEqual([x.id for x in self.nemo.all_texts['urn:cts:formulae:marculf'] if x.par == '1_000b'],
                          ['urn:cts:formulae:marculf.1_incipit.deu001', 'urn:cts:formulae:marculf.1_incipit.lat001',
                           'urn:cts:formulae:p16.4v.lat001', 'urn:cts:formulae:sg2.5660.lat001',
                           'urn:cts:formulae:sg2.6061.lat001'])
-        self.assertEqual([x[1][0] for x in self.nemo.all_texts['urn:cts:formulae:marculf'] if x[0] == '2_000a'],
+        self.assertEqual([x.id for x in self.nemo.all_texts['urn:cts:formulae:marculf'] if x.par == '2_000a'],
                          ['urn:cts:formulae:marculf.2_capitula.deu001', 'urn:cts:formulae:marculf.2_capitula.lat001',
                           'urn:cts:formulae:p16.1v2v.lat001'])
-        self.assertEqual([x[1][0] for x in self.nemo.all_texts['urn:cts:formulae:tours'] if x[0] == '000_a'],
+        self.assertEqual([x.id for x in self.nemo.all_texts['urn:cts:formulae:tours'] if x.par == '000_a'],
                          ['urn:cts:formulae:p10.135r.lat001',
                           'urn:cts:formulae:tours.0_capitula.deu001',
                           'urn:cts:formulae:tours.0_capitula.lat001',
                           'urn:cts:formulae:wa1.226r226v.lat001'])
 
+    def test_corpus_snapshot(self):
+        """ Make sure that the corpus snapshot restores the same corpus data and is invalidated by corpus changes"""
+        with tempfile.TemporaryDirectory() as snapshot_folder:
+            self.app.config['CORPUS_SNAPSHOT_FOLDER'] = snapshot_folder
+            all_texts = deepcopy(dict(self.nemo.all_texts))
+            open_texts = list(self.nemo.open_texts)
+            path = self.nemo.save_corpus_snapshot()
+            self.assertTrue(os.path.isfile(path))
+            self.nemo.all_texts, self.nemo.open_texts, self.nemo.sub_colls = {}, [], {}
+            self.assertTrue(self.nemo.load_corpus_snapshot())
+            self.assertEqual(self.nemo.all_texts, all_texts)
+            self.assertEqual(self.nemo.open_texts, open_texts)
+            self.assertIn('urn:cts:formulae:andecavensis', [x['id'] for v in self.nemo.sub_colls.values() for x in v])
+            self.nemo._corpus_key = 'some_other_corpus'
+            self.assertFalse(self.nemo.load_corpus_snapshot())
+            self.nemo._corpus_key = None
+            corpus_key = self.nemo.corpus_key
+            with patch.object(TextRecord, '__slots__', TextRecord.__slots__ + ('new_field',)):
+                self.nemo._corpus_key = None
+                self.assertNotEqual(self.nemo.corpus_key, corpus_key,
+                                    'A snapshot with other TextRecord fields should not be loaded.')
+            self.nemo._corpus_key = None
+            self.app.config['CORPUS_SNAPSHOT_FOLDER'] = ''
+            self.assertIsNone(self.nemo.save_corpus_snapshot())
+
+    def test_lazy_all_texts(self):
+        """ Make sure that the text lists of the collections are only built when they are accessed"""
+        all_texts, open_texts, half_open_texts = self.nemo.get_open_texts()
+        self.assertEqual(all_texts.loaded, 0)
+        self.assertEqual(sorted(all_texts.keys()), sorted(self.nemo.all_texts.keys()))
+        self.assertIn('urn:cts:formulae:andecavensis', all_texts)
+        self.assertEqual(all_texts['urn:cts:formulae:andecavensis'], self.nemo.all_texts['urn:cts:formulae:andecavensis'])
+        self.assertEqual(all_texts.loaded, 1)
+        all_texts.warm_up()
+        self.assertEqual(all_texts.loaded, len(all_texts))
+        expected_open = set()
+        for c, texts in all_texts.items():
+            parents = [p.id for p in self.nemo.resolver.getMetadata(c).ancestors.values() if 'urn:cts:formulae:' in p.id] + [c]
+            if set(self.nemo.OPEN_COLLECTIONS).intersection(parents):
+                expected_open.update(x.id for x in texts)
+        self.assertEqual(set(open_texts), expected_open, 'The open texts should be the same as those found from the sorted lists.')
+        with self.assertRaises(KeyError):
+            all_texts['urn:cts:formulae:not_a_collection']
+
+    def test_text_records(self):
+        """ Make sure that the text records contain the metadata that the corpus routes need"""
+        text = [x for x in self.nemo.all_texts['urn:cts:formulae:andecavensis'] if x.id == 'urn:cts:formulae:andecavensis.form001.lat001'][0]
+        m = self.nemo.resolver.getMetadata(text.id)
+        self.assertEqual(text.par, self.nemo.ordered_corpora(m, 'urn:cts:formulae:andecavensis')[0])
+        self.assertEqual(text.subtype, m.subtype)
+        self.assertEqual(text.parent_id, list(m.parent)[0])
+        self.assertIn('urn:cts:formulae:andecavensis', text.ancestor_ids)
+        self.assertEqual(text.parent_label, str(self.nemo.make_parents(m)[0]['label']))
+        self.assertEqual(text.regest, str(m.metadata.get_single(DC.description)))
+        self.assertEqual(text.dating, str(m.metadata.get_single(DCTERMS.temporal)))
+        self.assertEqual(text.is_version_of, tuple(str(x) for x in sorted(m.metadata.get(DCTERMS.isVersionOf))))
+        self.assertEqual(self.nemo.all_texts['urn:cts:formulae:andecavensis'],
+                         sorted(self.nemo.all_texts['urn:cts:formulae:andecavensis']))
+
+    def test_make_resolver(self):
+        """ Make sure that the resolver built by make_resolver is the same as the one built directly and that overlapping folders are not merged"""
+        resolver = make_resolver(self.app.config['CORPUS_FOLDERS'], processes=4)
+        self.assertEqual(sorted(resolver.id_to_coll.keys()), sorted(self.nemo.resolver.id_to_coll.keys()))
+        self.assertEqual(sorted(resolver.children['urn:cts:formulae:katalonien']),
+                         sorted(self.nemo.resolver.children['urn:cts:formulae:katalonien']))
+        with self.assertRaises(ResolverMergeError):
+            merge_resolvers([XmlCapitainsLocalResolver(self.app.config['CORPUS_FOLDERS']),
+                             XmlCapitainsLocalResolver(self.app.config['CORPUS_FOLDERS'])])
+
+    def test_make_resolver_two_folders(self):
+        """ Make sure that parsing two folders and the textgroups of each folder in parallel gives the same resolver as a serial parse"""
+        folders = self.app.config['CORPUS_FOLDERS'] + ['tests/test_data/second_formulae']
+        shards = corpus_shards(folders[0])
+        self.assertGreater(len(shards), 1)
+        self.assertEqual(sorted(x for shard in shards for x in shard), sorted(os.listdir('tests/test_data/formulae/data')))
+        self.assertIn(['raetien2'], corpus_shards(folders[1]))
+        serial = XmlCapitainsLocalResolver(folders)
+        resolver = make_resolver(folders, processes=4)
+        self.assertIsNot(resolver, serial)
+        self.assertEqual(list(resolver.id_to_coll), list(serial.id_to_coll))
+        self.assertEqual(list(resolver.children), list(serial.children))
+        for k, v in serial.children.items():
+            self.assertEqual(list(resolver.children[k]), list(v), k)
+        root = resolver.getMetadata()
+        self.assertEqual(list(root.children), list(serial.getMetadata().children))
+        for collection in root.children.values():
+            self.assertIs(resolver.id_to_coll[collection.id], collection)
+        ancestors = resolver.getMetadata('urn:cts:formulae:raetien2.erhart0001.lat001').ancestors
+        self.assertEqual(list(ancestors), list(serial.getMetadata('urn:cts:formulae:raetien2.erhart0001.lat001').ancestors))
+        for ancestor in ancestors.values():
+            self.assertIs(ancestor, root if ancestor.id == root.id else resolver.id_to_coll[ancestor.id])
+
+    def test_two_tier_cache(self):
+        """ Make sure that the two-tier cache serves values from both tiers and counts hits and misses"""
+        redis, store = self.fake_redis()
+        cache = TwoTierCache(redis, 'test_cache', max_items=1)
+        self.assertEqual(cache.get_or_set(('a', True), lambda: {'x': 1}), {'x': 1})
+        self.assertIn('test_cache:a:True', store)
+        self.assertEqual(cache.get_or_set(('a', True), lambda: {'x': 2}), {'x': 1})
+        cache.set('b', 2)
+        self.assertEqual(list(cache.local.keys()), ['b'], 'The local tier should evict the least recently used entry.')
+        self.assertEqual(cache.get(('a', True)), (True, {'x': 1}), 'Evicted entries should be served from Redis.')
+        self.assertEqual(cache.counts, {'local_hits': 1, 'redis_hits': 1, 'misses': 1})
+        cache.clear()
+        self.assertEqual(store, {})
+        self.assertEqual(cache.get('b'), (False, None))
+        redis.get.side_effect = RedisConnectionError
+        self.assertEqual(cache.get_or_set('c', lambda: 3), 3, 'The cache should work without Redis.')
+        self.assertEqual(cache.get('c'), (True, 3))
+        # Hits in the local tier are only counted in Redis with the next Redis request of the cache
+        redis, store = self.fake_redis()
+        cache = TwoTierCache(redis, 'test_cache', max_items=1)
+        cache.set('a', 1)
+        for i in range(3):
+            cache.get('a')
+        redis.get.assert_not_called()
+        redis.pipeline.assert_not_called()
+        cache.get('b')
+        self.assertEqual(sorted(c.args for c in redis.pipeline.return_value.hincrby.call_args_list),
+                         [('test_cache:stats', 'local_hits', 3), ('test_cache:stats', 'misses', 1)])
+        disabled = TwoTierCache(redis, 'test_cache', max_items=0)
+        self.assertEqual(disabled.get_or_set('d', lambda: 4), 4)
+        self.assertEqual(len(disabled.local), 0)
+
+    def test_r_corpus_cache(self):
+        """ Make sure that the readable texts of r_corpus are cached per project team status and locale"""
+        redis, store = self.fake_redis()
+        self.nemo.corpus_cache = TwoTierCache(redis, 'formulae:r_corpus', max_items=10)
+        with patch.object(self.nemo, 'make_corpus_readable', wraps=self.nemo.make_corpus_readable) as mock_readable:
+            with self.client as c:
+                c.get('/corpus/urn:cts:formulae:andecavensis', follow_redirects=True)
+                first = self.get_context_variable('collections')['readable']
+                c.get('/corpus/urn:cts:formulae:andecavensis', follow_redirects=True)
+                self.assertEqual(self.get_context_variable('collections')['readable'], first)
+                self.assertEqual(mock_readable.call_count, 1)
+                c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                       follow_redirects=True)
+                c.get('/corpus/urn:cts:formulae:andecavensis', follow_redirects=True)
+                self.assertEqual(mock_readable.call_count, 2, 'Project members should not get the cached public page.')
+        self.assertEqual(self.nemo.corpus_cache.counts['local_hits'], 1)
+
+    def test_previous_search_store(self):
+        """ Make sure that the results of the last search are kept in Redis and that the session only keeps their key"""
+        redis, store = self.fake_redis()
+        results = [{'id': 'urn:cts:formulae:andecavensis.form001.lat001', 'info': {'title': 'Angers 1', 'min_date': '0600'},
+                    'sents': [Markup('Ein <strong>Satz</strong>')], 'sentence_spans': [range(2, 7)],
+                    'regest_sents': [Markup('Ein Regest')], 'highlight': [Markup('Ein <strong>Satz</strong>')]}]
+        self.assertEqual(expand_results(compact_results(results)),
+                         [{'id': 'urn:cts:formulae:andecavensis.form001.lat001', 'info': {'title': 'Angers 1'},
+                           'title': 'Angers 1', 'sents': [Markup('Ein <strong>Satz</strong>')],
+                           'sentence_spans': [range(2, 7)], 'regest_sents': [Markup('Ein Regest')],
+                           'highlight': [Markup('Ein <strong>Satz</strong>')]}])
+        self.assertEqual(decode_results(encode_results(results)), compact_results(results))
+        with self.assertRaises(ValueError):
+            decode_results(b'\x00' + encode_results(results)[1:])
+        with patch.object(self.app, 'redis', redis), patch.dict(self.app.config, {'PREVIOUS_SEARCH_TIMEOUT': 3600}):
+            with self.app.test_request_context():
+                save_previous_search(results)
+                key = session[RESULT_STORE_SESSION_KEY]
+                self.assertNotIn('previous_search', session)
+                self.assertIn('{}:{}'.format(RESULT_STORE_NAMESPACE, key), store)
+                g.pop('stored_previous_search')
+                self.assertEqual(load_previous_search()[0]['id'], results[0]['id'])
+                self.assertEqual(redis.get.call_count, 1)
+                load_previous_search()
+                self.assertEqual(redis.get.call_count, 1, 'The results should only be loaded once per request.')
+                clear_previous_search()
+                self.assertEqual(store, {})
+                self.assertIsNone(load_previous_search())
+                redis.setex.side_effect = RedisConnectionError
+                save_previous_search(results)
+                self.assertEqual(session['previous_search'], compact_results(results))
+                self.assertEqual(load_previous_search()[0]['sents'], results[0]['sents'],
+                                 'The results should be kept in the session if Redis cannot be reached.')
+
+    def test_export_search_pdf(self):
+        """ Make sure that the background export writes the same PDF as the export in the request and reports its progress"""
+        redis, store = self.fake_redis()
+        results = [{'id': 'urn:cts:formulae:andecavensis.form00{}.lat001'.format(i), 'info': {'title': 'Angers {}'.format(i)},
+                    'sents': [Markup('</small><strong>Satz</strong><small> {}').format(i)], 'regest_sents': []}
+                   for i in range(1, 4)]
+        entries = export_entries(results, 'Aus dem Regest')
+        self.assertEqual(entries[0], {'title': 'Angers 1', 'sents': ['- <b>Satz</b> 1'], 'regest_sents': []})
+        pdf_buffer = BytesIO()
+        render_search_pdf(pdf_buffer, 'Suchergebnisse', ['Suchparameter', 'Suchergebnisse'], ['<b>Korpora</b>: Angers'], entries)
+        with tempfile.TemporaryDirectory() as export_folder, \
+                patch('formulae.search.export.Redis.from_url', return_value=redis), \
+                patch('formulae.search.export.PDF_EXPORT_CHUNK', 1):
+            JobRegistry(redis).create('pdf_download_1', 'pdf_export', state='queued')
+            redis.hset.reset_mock()
+            path = os.path.join(export_folder, 'search_1.pdf')
+            export_search_pdf(path, 'Suchergebnisse', ['Suchparameter', 'Suchergebnisse'], ['<b>Korpora</b>: Angers'],
+                              entries, 'redis://', 'pdf_download_1', 60)
+            self.assertEqual(os.listdir(export_folder), ['search_1.pdf'])
+            with open(path, mode='rb') as f:
+                exported = f.read()
+        self.assertEqual(re.search(b'>>\nstream\n.*?>endstream', pdf_buffer.getvalue()).group(0),
+                         re.search(b'>>\nstream\n.*?>endstream', exported).group(0))
+        self.assertEqual([c.kwargs['mapping']['percent'] for c in redis.hset.call_args_list if 'percent' in c.kwargs['mapping']],
+                         ['0', '33', '66', '99', '100'])
+
+    def test_job_registry(self):
+        """ Make sure that jobs report their progress and stop when they are cancelled"""
+        redis, store = self.fake_redis()
+        registry = JobRegistry(redis, timeout=60)
+        self.assertIsNone(registry.get('search_progress_1'))
+        self.assertFalse(registry.cancel('search_progress_1'))
+        registry.create('search_progress_1', 'search')
+        registry.progress('search_progress_1', 'highlight', 60, 200, 1000)
+        job = registry.get('search_progress_1')
+        self.assertEqual({k: job[k] for k in ('kind', 'state', 'phase', 'done', 'total', 'progress', 'cancelled')},
+                         {'kind': 'search', 'state': 'running', 'phase': 'highlight', 'done': 200, 'total': 1000,
+                          'progress': '60%', 'cancelled': False})
+        redis.expire.assert_called_with('formulae:jobs:search_progress_1', 60)
+        self.assertFalse(registry.cancel('search_progress_1', owner='session_2'),
+                         'Jobs without an owner can only be cancelled without an owner token.')
+        self.assertTrue(registry.cancel('search_progress_1'))
+        with self.assertRaises(JobCancelled):
+            registry.progress('search_progress_1', 'highlight', 70, 700, 1000)
+        self.assertEqual(registry.get('search_progress_1')['state'], 'cancelled')
+        registry.create('search_progress_1', 'search')
+        registry.finish('search_progress_1', result='file_1')
+        self.assertEqual((registry.get('search_progress_1')['progress'], registry.get('search_progress_1')['result']),
+                         ('100%', 'file_1'))
+        self.assertFalse(registry.cancel('search_progress_1'), 'Finished jobs cannot be cancelled.')
+        registry.create('search_progress_2', 'search', owner='session_1')
+        self.assertFalse(registry.cancel('search_progress_2'))
+        self.assertFalse(registry.cancel('search_progress_2', owner='session_2'), 'Only the owner can cancel a job.')
+        self.assertTrue(registry.cancel('search_progress_2', owner='session_1'))
+
+    def test_async_search(self):
+        """ Make sure that a background search is only started once and that its results are served when they are ready"""
+        redis, store = self.fake_redis()
+        executor = Mock()
+        results = ([{'id': 'urn:cts:formulae:andecavensis.form001.lat001'}], 1, {}, None)
+        search_args = dict(query_dict={'q_1': {'q': 'regnum'}}, corpus=['andecavensis'], search_id='1')
+        job_id = 'search_progress_async_' + async_search_key(search_args, False)
+        with self.app.test_request_context(), patch.object(self.app, 'redis', redis), \
+                patch.dict(self.app.extensions, {'job_registry': JobRegistry(redis, timeout=60),
+                                                 'async_search_executor': executor}), \
+                patch('formulae.search.async_search.advanced_query_index') as mock_search:
+            # The page polling for the results reloads when the job is done, so the job must not be done before they are stored
+            mock_search.side_effect = lambda **kwargs: self.assertNotEqual(get_job_registry().get(job_id)['state'], 'done') or results
+            self.assertEqual(async_search(search_args), (None, job_id))
+            self.assertEqual(get_job_registry().get(job_id)['state'], 'queued')
+            self.assertEqual(async_search(dict(search_args, search_id='2')), (None, job_id),
+                             'The same search in another tab should wait for the same job.')
+            self.assertEqual(executor.submit.call_count, 1)
+            run, key, args = executor.submit.call_args.args
+            run(key, args)
+            mock_search.assert_called_once_with(**dict(search_args, search_id=job_id.replace('search_progress_', '')),
+                                                manage_job=False)
+            self.assertEqual(get_job_registry().get(job_id)['state'], 'done')
+            self.assertNotIn('formulae:async_search:{}:lock'.format(key), store)
+            self.assertEqual(async_search(search_args), (results, job_id))
+            self.assertEqual(executor.submit.call_count, 1)
+        with self.app.app_context(), patch.dict(self.app.extensions), \
+                patch.dict(self.app.config, {'ASYNC_SEARCH_WORKERS': 1, 'SEARCH_THREADS': 0}):
+            background_executor = get_async_search_executor()
+            self.assertIsNone(get_search_executor(), 'The background searches should not enable concurrent sub-queries.')
+            self.app.config['SEARCH_THREADS'] = 2
+            sub_query_executor = get_search_executor()
+            self.assertIsNot(background_executor, sub_query_executor,
+                             'Background searches should not wait for their sub-queries in their own pool.')
+            background_executor.shutdown()
+            sub_query_executor.shutdown()
+
+    def test_pdf_cache(self):
+        """ Make sure that the PDF cache writes complete files and removes the least recently used ones when it is full"""
+        def writer(content):
+            def write(target):
+                with open(target, mode='wb') as f:
+                    f.write(content)
+            return write
+
+        with tempfile.TemporaryDirectory() as pdf_folder:
+            cache = PdfCache(pdf_folder, 10)
+            self.assertTrue(cache.enabled)
+            self.assertIsNone(cache.get(('a', 'open')))
+            path_a = cache.put(('a', 'open'), writer(b'%PDF-a'))
+            self.assertEqual(cache.get(('a', 'open')), path_a)
+            self.assertNotEqual(cache.path(('a', 'encrypted')), path_a)
+            with self.assertRaises(ValueError):
+                cache.put(('b', 'open'), Mock(side_effect=ValueError))
+            self.assertEqual(os.listdir(pdf_folder), [os.path.basename(path_a)], 'Failed PDFs should not be left behind.')
+            os.utime(path_a, (1, 1))
+            path_b = cache.put(('b', 'open'), writer(b'%PDF-b'))
+            self.assertIsNone(cache.get(('a', 'open')), 'The least recently used PDF should be removed.')
+            with open(path_b, mode='rb') as f:
+                self.assertEqual(f.read(), b'%PDF-b')
+            self.assertFalse(PdfCache(pdf_folder, 0).enabled)
+
+    def test_render_pdfs(self):
+        """ Make sure that the batch PDF build renders every text of a collection in the worker processes"""
+        object_ids = collection_texts(self.nemo, ['urn:cts:formulae:andecavensis'])
+        self.assertIn('urn:cts:formulae:andecavensis.form002.lat001', object_ids)
+        self.assertEqual(len(object_ids), len(set(object_ids)))
+        with tempfile.TemporaryDirectory() as pdf_folder:
+            rendered = list(render_pdfs(self.nemo, object_ids[:3], pdf_folder, 2, encrypt=True))
+            self.assertEqual(sorted(x[0] for x in rendered), sorted(object_ids[:3]))
+            self.assertEqual(sorted(os.listdir(pdf_folder)), sorted(x[1] for x in rendered))
+            for objectId, file_name, seconds, size in rendered:
+                with open(os.path.join(pdf_folder, file_name), mode='rb') as f:
+                    pdf_bytes = f.read()
+                self.assertTrue(pdf_bytes.startswith(b'%PDF'))
+                self.assertEqual(len(pdf_bytes), size)
+                self.assertIn(b'Encrypt', pdf_bytes, 'The texts of the formulae collection should be encrypted.')
+
     def test_load_user(self):
         """ Ensure that load_user function returns the correct user"""
         u = load_user(1)
@@ -2064,6 +2473,44 @@ class TestFunctions(Formulae_Testing):
         html_etree = etree.fromstring(html_input)
         self.assertEqual(xml.xpath('//tei:w/text()', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}), html_etree.xpath('//span[@class="w"]/text()'))
 
+    def test_xslt_cache(self):
+        """ Ensure that compiled stylesheets are reused within a thread and give the same results as Nemo.transform"""
+        obj_id = "urn:cts:formulae:andecavensis.form004.lat001"
+        xml = self.nemo.get_passage(objectId=obj_id, subreference='1')
+        self.assertIs(self.nemo.get_xslt('default'), self.nemo.get_xslt('default'))
+        other_thread = []
+        t = threading.Thread(target=lambda: other_thread.append(self.nemo.get_xslt('default')))
+        t.start()
+        t.join()
+        self.assertIsNot(other_thread[0], self.nemo.get_xslt('default'), 'Each thread should compile its own stylesheet.')
+        html = self.nemo.transform(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id)
+        self.assertEqual(html, Nemo.transform(self.nemo, xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id))
+        tree = self.nemo.transform_tree(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id)
+        self.assertEqual(self.nemo.extract_notes(tree), self.nemo.extract_notes(html))
+
+    def test_passage_store(self):
+        """ Make sure that pre-rendered passages are served from the passage store and that the store is ignored for other corpora"""
+        obj_id = "urn:cts:formulae:andecavensis.form004.lat001"
+        xml = self.nemo.get_passage(objectId=obj_id, subreference='1')
+        with tempfile.TemporaryDirectory() as store_folder, patch.dict(self.app.config), \
+                patch.object(self.nemo, '_passage_store', None), \
+                self.app.test_request_context('/texts/{}/passage/1'.format(obj_id)):
+            rendered = self.nemo.render_passage(xml, obj_id, '1')
+            self.app.config['PASSAGE_STORE_FOLDER'] = store_folder
+            writer = PassageStoreWriter(store_folder, self.nemo.passage_store_key)
+            writer.add((obj_id, '1', 'passage'), '<p>stored passage</p>')
+            writer.add((obj_id, '1', 'notes'), '')
+            writer.add((obj_id, '2', 'notes'), '')
+            self.assertEqual(writer.index[(obj_id, '1', 'notes')], writer.index[(obj_id, '2', 'notes')],
+                             'Identical HTML should only be stored once.')
+            writer.commit()
+            self.nemo._passage_store = None
+            self.assertEqual(len(self.nemo.passage_store), 3)
+            self.assertEqual(self.nemo.render_passage(xml, obj_id, '1'), ('<p>stored passage</p>', ''))
+            self.assertIsNone(self.nemo.passage_store.get((obj_id, '2', 'passage')))
+            self.nemo._passage_store = PassageStore(store_folder, 'some_other_corpus')
+            self.assertEqual(self.nemo.render_passage(xml, obj_id, '1'), rendered)
+
     # def test_load_term_vectors(self):
     #     """ Ensure that the json mapping file is correctly loaded."""
     #     self.assertEqual(self.nemo.term_vectors["urn:cts:formulae:buenden.meyer-marthaler0027.lat001"]["term_vectors"]["text"]["terms"]["a"]["term_freq"],
@@ -7801,6 +8248,14 @@ class TestES(Formulae_Testing):
         return next(self.search_response)
 
     def suggest_side_effect(self, **kwargs):
+        if 'suggest' in kwargs.keys() and 'fuzzy_suggest' not in kwargs['suggest']:
+            # The suggestions for all terms of a search are requested together with one named suggester per term
+            resp = {'suggest': {}}
+            for name, suggester in kwargs['suggest'].items():
+                single_resp = self.suggest_side_effect(suggest={'fuzzy_suggest': suggester})
+                if single_resp:
+                    resp['suggest'][name] = single_resp['suggest']['fuzzy_suggest']
+            return resp
         if 'suggest' in kwargs.keys():
             resp = {}
             if kwargs['suggest']['fuzzy_suggest']['term']['field'] == 'text':
@@ -7954,6 +8409,603 @@ class TestES(Formulae_Testing):
             mock_search.assert_any_call(index=test_args['corpus'], **b)
         self.assertEqual(ids, [{"id": x['id']} for x in actual])
 
+    @patch.object(Elasticsearch, "search")
+    def test_paged_search(self, mock_search):
+        """ Make sure that a paged search collects only the ids of all hits and fetches the documents of the current page"""
+        test_args = copy(self.TEST_ARGS['test_date_range_search_same_year'])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        all_hits = fake.load_response()[0]['hits']['hits']
+        aggs = fake.load_aggs()
+
+        def paged_side_effect(**kwargs):
+            page_ids = [x['ids']['values'] for x in kwargs['query']['bool']['must'] if 'ids' in x]
+            if page_ids:
+                self.assertEqual(kwargs['_source'], {'excludes': Search.PAGE_SOURCE_EXCLUDES})
+                self.assertNotIn('aggs', kwargs)
+                return {'hits': {'hits': [h for h in all_hits if h['_id'] in page_ids[0]]}}
+            self.assertEqual(kwargs['_source'], ['title'])
+            self.assertNotIn('highlight', kwargs)
+            # The facets of all hits are requested together with their ids
+            self.assertEqual(kwargs['aggs'], Search.AGGREGATIONS)
+            return {'hits': {'hits': [{'_id': h['_id'], '_index': h['_index'], '_source': {'title': h['_source']['title']},
+                                       'sort': h['sort']} for h in all_hits]},
+                    'aggregations': aggs['aggregations']}
+
+        mock_search.side_effect = paged_side_effect
+        test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+        test_args['query_dict'] = make_query_dict(test_args)
+        test_args.update(paged=True, per_page=2, page=2)
+        actual, total, actual_aggs, prev = advanced_query_index(**test_args)
+        self.assertEqual([x['id'] for x in actual], [h['_id'] for h in all_hits[2:4]])
+        self.assertEqual(total, len(all_hits))
+        self.assertEqual(actual_aggs, aggs['aggregations'])
+        self.assertEqual([x['id'] for x in prev], [h['_id'] for h in all_hits])
+        self.assertEqual(prev[0]['info'], {'title': all_hits[0]['_source']['title']})
+        self.assertEqual(prev[2]['info'], all_hits[2]['_source'])
+        self.assertEqual(mock_search.call_count, 2)
+
+    @patch.object(Elasticsearch, "search")
+    def test_search_all_hits_without_sort(self, mock_search):
+        """ Make sure that the hits of a search with an unknown sort order are collected in score order"""
+        hits = [{'_id': str(i), '_index': 'andecavensis', 'sort': [10 - i, 'urn:{}'.format(i)]} for i in range(3)]
+
+        def batch_side_effect(**kwargs):
+            start = [h['sort'] for h in hits].index(kwargs['search_after']) + 1 if 'search_after' in kwargs else 0
+            return {'hits': {'hits': hits[start:start + 2]}}
+
+        mock_search.side_effect = batch_side_effect
+        with patch.object(Search, 'SEARCH_AFTER_BATCH_SIZE', 2):
+            self.assertEqual(Search.search_all_hits(['andecavensis'], {'query': {'match_all': {}},
+                                                                       'sort': build_sort_list('foo')}), hits)
+        self.assertEqual(mock_search.call_count, 2)
+        self.assertEqual(mock_search.call_args.kwargs['sort'], ['_score', 'urn'])
+
+    @patch.object(Elasticsearch, "search")
+    @patch.object(Elasticsearch, "mtermvectors")
+    def test_concurrent_search(self, mock_vectors, mock_search):
+        """ Make sure that the sub-queries sent through the search thread pool return the same results as sent one after the other"""
+        test_args = copy(self.TEST_ARGS['test_bool_should'])
+        fake = FakeElasticsearch(self.build_file_name(copy(test_args)).replace('%2B', '+'), 'advanced_search')
+        body = fake.load_request()
+        responses = fake.load_response()
+        self.search_aggs = fake.load_aggs()
+        search_threads = set()
+
+        def concurrent_side_effect(**kwargs):
+            search_threads.add(threading.current_thread().name)
+            if 'suggest' in kwargs or 'ids' in kwargs['query']:
+                return self.search_side_effect(**kwargs)
+            # The first should clause of every sub-query holds its own search term
+            first_clauses = [b['query']['bool']['must'][0]['bool']['should'][0] for b in body]
+            return deepcopy(responses[first_clauses.index(kwargs['query']['bool']['must'][0]['bool']['should'][0])])
+
+        mock_search.side_effect = concurrent_side_effect
+        mock_vectors.side_effect = self.vector_side_effect
+        test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+        results = []
+        for threads in (0, 4):
+            self.app.config['SEARCH_THREADS'] = threads
+            search_args = copy(test_args)
+            search_args['query_dict'] = make_query_dict(search_args)
+            search_threads.clear()
+            results.append(advanced_query_index(**search_args))
+            self.assertCountEqual(g.search_timings, ['queries', 'highlight', 'aggregations'])
+            self.assertEqual(any(t.startswith('search') for t in search_threads), threads > 1)
+        self.app.config['SEARCH_THREADS'] = 0
+        self.app.extensions.pop('search_executor').shutdown()
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(fake.load_ids(), [{"id": x['id']} for x in results[1][0]])
+
+    @patch.object(Elasticsearch, "search")
+    @patch.object(Elasticsearch, "mtermvectors")
+    def test_combined_query(self, mock_vectors, mock_search):
+        """ Make sure that the combined bool query returns the same results as the separate queries combined in Python"""
+        for test_name, extra_response in (('test_regest_and_word_advanced_search', []),
+                                          ('test_bool_should', []),
+                                          ('test_bool_must_not', [{'hits': {'hits': []}}])):
+            test_args = copy(self.TEST_ARGS[test_name])
+            fake = FakeElasticsearch(self.build_file_name(copy(test_args)).replace('%2B', '+'), 'advanced_search')
+            body = fake.load_request()
+            responses = fake.load_response() + extra_response
+            self.search_aggs = fake.load_aggs()
+            first_clauses = [b['query']['bool']['must'][0]['bool']['should'][0] for b in body]
+            bool_operator = test_args.get('bool_operator', 'must')
+            combined_calls = []
+
+            def part_hits(query):
+                """ The saved hits of the query whose clause is the last one in a bool query"""
+                return deepcopy(responses[first_clauses.index(query['bool']['must'][-1]['bool']['should'][0])]['hits']['hits'])
+
+            def combined_side_effect(**kwargs):
+                if 'suggest' in kwargs or 'ids' in kwargs['query']:
+                    return self.search_side_effect(**kwargs)
+                last_clause = kwargs['query']['bool']['must'][-1]
+                if 'ids' in last_clause:
+                    kwargs['query']['bool']['must'].pop()
+                    return {'hits': {'hits': [h for h in part_hits(kwargs['query']) if h['_id'] in last_clause['ids']['values']]}}
+                combination = last_clause['bool']
+                if not any('_name' in c.get('bool', {}) for v in combination.values() if isinstance(v, list) for c in v):
+                    return {'hits': {'hits': part_hits(kwargs['query'])}}
+                combined_calls.append(kwargs)
+                hits = OrderedDict()
+                for key, clauses in combination.items():
+                    for clause in clauses if isinstance(clauses, list) else []:
+                        query = {'bool': {'must': [{'bool': {'should': clause['bool']['should']}}]}}
+                        for h in part_hits(query):
+                            if key == 'must_not':
+                                hits.pop(h['_id'], None)
+                                continue
+                            hit = hits.setdefault(h['_id'], dict(h, matched_queries=[], highlight={}))
+                            hit['matched_queries'].append(clause['bool']['_name'])
+                            hit['highlight'].update(h.get('highlight', {}))
+                if bool_operator == 'must':
+                    hits = {k: v for k, v in hits.items() if len(v['matched_queries']) == len(combination['must'])}
+                return {'hits': {'hits': list(hits.values())}}
+
+            mock_search.side_effect = combined_side_effect
+            mock_vectors.side_effect = self.vector_side_effect
+            test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+            results = []
+            for combined in (False, True):
+                self.app.config['SEARCH_COMBINED_QUERY'] = combined
+                search_args = copy(test_args)
+                search_args['query_dict'] = make_query_dict(search_args)
+                results.append(advanced_query_index(**search_args))
+            self.app.config['SEARCH_COMBINED_QUERY'] = False
+            self.assertEqual(len(combined_calls), 1, test_name)
+            self.assertEqual(results[0][:3], results[1][:3], test_name)
+            self.assertEqual(fake.load_ids(), [{"id": x['id']} for x in results[1][0]], test_name)
+            mock_search.reset_mock()
+
+    @patch.object(Elasticsearch, "search")
+    def test_fuzzy_expansions(self, mock_search):
+        """ Make sure that the suggestions for all fuzzy terms are requested together and then taken from the cache"""
+        mock_search.side_effect = self.suggest_side_effect
+        terms = [('qui', 'text', 1), ('nuncupatur', 'text', 2), ('qui', 'lemmas', 1), ('qui', 'text', 1)]
+        expected = {('qui', 'text', 1): ['quis', 'que', 'qua', 'quia', 'quo'],
+                    ('nuncupatur', 'text', 2): ['nuncupata'],
+                    ('qui', 'lemmas', 1): ['quia', 'qua', 'que']}
+        with self.app.app_context(), patch.dict(self.app.config, {'FUZZY_CACHE_SIZE': 4096}), \
+                patch.dict(self.app.extensions), \
+                patch('formulae.search.token_store.token_store_key', return_value='test_indices') as mock_key:
+            self.app.extensions.pop('fuzzy_expansion_cache', None)
+            self.app.extensions.pop('index_keys', None)
+            get_expansion_cache().clear()
+            self.assertEqual(fuzzy_expansions(['form_lit_chart'], terms), expected)
+            mock_search.assert_called_once()
+            suggesters = mock_search.call_args.kwargs['suggest']
+            self.assertEqual(sorted((x['text'], x['term']['field'], x['term']['max_edits']) for x in suggesters.values()),
+                             sorted(expected))
+            self.assertEqual(fuzzy_expansions(['form_lit_chart'], terms[:2]), {k: expected[k] for k in terms[:2]})
+            mock_search.assert_called_once()
+            # The corpus is part of the cache key
+            fuzzy_expansions(['form_lit_chart-andecavensis'], terms[:1])
+            self.assertEqual(mock_search.call_count, 2)
+            # After a reindexing, the expansions of the old indices are not used anymore
+            mock_key.return_value = 'new_indices'
+            fuzzy_expansions(['form_lit_chart'], terms[:1])
+            self.assertEqual(mock_search.call_count, 3)
+            get_expansion_cache().clear()
+            self.app.config['FUZZY_CACHE_SIZE'] = 0
+            self.app.extensions.pop('fuzzy_expansion_cache')
+            fuzzy_expansions(['form_lit_chart'], terms[:1])
+            fuzzy_expansions(['form_lit_chart'], terms[:1])
+            self.assertEqual(mock_search.call_count, 5)
+
+    @patch.object(Elasticsearch, "search")
+    def test_all_docs_cache(self, mock_search):
+        """ Make sure that the 'all_docs' aggregation is requested once per corpus and then added from the cache"""
+        test_args = copy(self.TEST_ARGS['test_date_range_search_same_year'])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        self.search_response = cycle(fake.load_response())
+        self.search_aggs = fake.load_aggs()
+        mock_search.side_effect = self.search_side_effect
+        test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+        self.app.config['ALL_DOCS_CACHE_TIMEOUT'] = 3600
+        self.app.extensions.pop('all_docs_cache', None)
+        aggs = []
+        with patch('formulae.search.token_store.token_store_key', return_value='test_indices') as mock_key:
+            for i in range(3):
+                if i == 2:
+                    # After a reindexing, the counts of the old indices are not used anymore
+                    mock_key.return_value = 'new_indices'
+                search_args = copy(test_args)
+                search_args['query_dict'] = make_query_dict(search_args)
+                aggs.append(advanced_query_index(**search_args)[2])
+        self.app.config['ALL_DOCS_CACHE_TIMEOUT'] = 0
+        self.app.extensions.pop('all_docs_cache')
+        self.app.extensions.pop('index_keys')
+        agg_calls = [c.kwargs['aggs'] for c in mock_search.call_args_list if 'aggs' in c.kwargs]
+        self.assertEqual(agg_calls, [Search.AGGREGATIONS, Search.FACET_AGGREGATIONS, Search.AGGREGATIONS])
+        self.assertEqual(aggs[0], self.search_aggs['aggregations'])
+        self.assertEqual(aggs[1], aggs[0])
+
+    def results_url(self, **changed_args):
+        """ The URL of the results page for the test_date_range_search_same_year search with changed_args"""
+        args = OrderedDict(self.TEST_ARGS['test_date_range_search_same_year'], **changed_args)
+        return '/search/results?' + '&'.join('{}={}'.format(k, v) for k, v in args.items())
+
+    def results_pages(self, *urls, facets=None):
+        """ The responses for urls, requested in a new session with the Elasticsearch responses of the
+        test_date_range_search_same_year search, whose facet aggregations can be replaced with facets"""
+        fake = FakeElasticsearch(self.build_file_name(self.TEST_ARGS['test_date_range_search_same_year']), 'advanced_search')
+        self.search_response = cycle(fake.load_response())
+        self.search_aggs = fake.load_aggs()
+        self.search_aggs['aggregations'].update(facets or dict())
+        # The pages contain a random id for the download of the results
+        with self.app.test_client() as c, patch('formulae.nemo.randint', return_value=1):
+            return [c.get(url).get_data() for url in urls]
+
+    @patch('formulae.search.token_store.token_store_key', return_value='test_indices')
+    @patch.object(Elasticsearch, "search")
+    def test_all_docs_cache_responses(self, mock_search, mock_key):
+        """ Make sure that the results pages are the same whether the 'all_docs' counts come from the cache or not"""
+        mock_search.side_effect = self.search_side_effect
+        urls = [self.results_url(), self.results_url(sort='min_date_desc')]
+        uncached = self.results_pages(*urls)
+        self.assertNotIn(Search.FACET_AGGREGATIONS, [c.kwargs.get('aggs') for c in mock_search.call_args_list])
+        redis, store = self.fake_redis()
+        with patch.object(self.app, 'redis', redis), patch.dict(self.app.config, {'ALL_DOCS_CACHE_TIMEOUT': 3600}), \
+                patch.dict(self.app.extensions):
+            self.app.extensions.pop('all_docs_cache', None)
+            self.assertEqual(self.results_pages(*urls), uncached)
+            self.assertIn(Search.FACET_AGGREGATIONS, [c.kwargs.get('aggs') for c in mock_search.call_args_list],
+                          'The second search should use the cached counts.')
+            Search.get_all_docs_cache().local.clear()
+            self.assertEqual(self.results_pages(*urls), uncached, 'The pages with the counts from Redis should not change.')
+            self.assertGreater(Search.get_all_docs_cache().counts['redis_hits'], 0)
+
+    @patch.object(Elasticsearch, "search")
+    def test_doc_attributes(self, mock_search):
+        """ Make sure that the document attribute table counts, sorts and filters like Elasticsearch"""
+        test_args = copy(self.TEST_ARGS['test_date_range_search_same_year'])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        hits = [h for r in fake.load_response() for h in r['hits']['hits']]
+        ids = [x['id'] for x in fake.load_ids()]
+        expected_aggs = fake.load_aggs()['aggregations']
+        table = DocAttributes.from_hits(hits)
+        local_aggs = table.aggregations(ids)
+        self.assertEqual([b['doc_count'] for b in local_aggs['range']['buckets']],
+                         [b['doc_count'] for b in expected_aggs['range']['buckets']])
+        self.assertEqual(local_aggs['no_date'], expected_aggs['no_date'])
+        self.assertEqual(local_aggs['forgeries'], expected_aggs['forgeries'])
+        self.assertEqual(sum(b['doc_count'] for b in local_aggs['corpus']['buckets'].values()), len(set(ids)))
+        with tempfile.TemporaryDirectory() as attribute_folder:
+            save_doc_attributes(attribute_folder, 'test_indices', table)
+            self.assertIsNone(load_doc_attributes(attribute_folder, 'other_indices'))
+            self.assertEqual(load_doc_attributes(attribute_folder, 'test_indices').aggregations(ids), local_aggs)
+        # The facets of a search are counted in the table once the 'all_docs' counts are cached
+        self.search_response = cycle(fake.load_response())
+        self.search_aggs = fake.load_aggs()
+        mock_search.side_effect = self.search_side_effect
+        test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+        self.app.config.update(ALL_DOCS_CACHE_TIMEOUT=3600)
+        self.app.extensions.pop('all_docs_cache', None)
+        aggs = []
+        with tempfile.TemporaryDirectory() as attribute_folder, \
+                patch.dict(self.app.config, {'DOC_ATTRIBUTE_FOLDER': attribute_folder}), \
+                patch('formulae.search.token_store.token_store_key', return_value='test_indices') as mock_key:
+            self.assertIsNone(get_doc_attributes())
+            # A table that is built while the worker runs is loaded on the next request
+            save_doc_attributes(attribute_folder, 'test_indices', table)
+            self.assertEqual(len(get_doc_attributes()), len(table))
+            for i in range(2):
+                search_args = copy(test_args)
+                search_args['query_dict'] = make_query_dict(search_args)
+                aggs.append(advanced_query_index(**search_args)[2])
+            # After a reindexing, the table of the old indices is not used anymore
+            mock_key.return_value = 'new_indices'
+            self.assertIsNone(get_doc_attributes())
+        self.app.config.update(ALL_DOCS_CACHE_TIMEOUT=0)
+        self.app.extensions.pop('all_docs_cache')
+        self.app.extensions.pop('doc_attributes')
+        self.app.extensions.pop('index_keys')
+        self.assertEqual([c.kwargs['aggs'] for c in mock_search.call_args_list if 'aggs' in c.kwargs], [Search.AGGREGATIONS])
+        self.assertEqual(aggs[1], dict(local_aggs, all_docs=expected_aggs['all_docs']))
+        # Sorting and filtering
+        docs = [('a', {'urn': 'urn:a', 'sort_prefix': 1, 'all_dates': ['0800-05-01', '0802'], 'min_date': '0800-05-01',
+                       'specific_date': [{'year': 800, 'month': 5, 'day': 1}], 'forgery': False,
+                       'collection': 'form_lit_chart-andecavensis'}),
+                ('b', {'urn': 'urn:b', 'sort_prefix': 1, 'all_dates': ['0801'], 'min_date': '0801', 'forgery': True,
+                       'specific_date': [{'year': 801}], 'collection': 'form_lit_chart-mondsee'}),
+                ('c', {'urn': 'urn:c', 'sort_prefix': 0, 'forgery': False, 'collection': 'form_lit_chart-mondsee',
+                       'specific_date': [{'year': 1, 'month': 1, 'day': 1}]}),
+                ('d', {'urn': 'urn:d', 'sort_prefix': 1, 'all_dates': ['0700-12-24'], 'min_date': '0700-12-24',
+                       'specific_date': [{'year': 700, 'month': 12, 'day': 24}], 'collection': 'form_lit_chart-lorsch'})]
+        table = DocAttributes.from_hits([{'_id': doc_id, '_source': source} for doc_id, source in docs])
+        for sort_str, expected in [('urn', ['c', 'a', 'b', 'd']), ('urn_desc', ['c', 'd', 'b', 'a']),
+                                   ('min_date_asc', ['d', 'a', 'b', 'c']), ('min_date_desc', ['b', 'a', 'd', 'c']),
+                                   ('max_date_asc', ['d', 'b', 'a', 'c']), ('max_date_desc', ['a', 'b', 'd', 'c'])]:
+            self.assertEqual(table.sort_ids('abcd', sort_str), expected, sort_str)
+        self.assertEqual(table.facet_filter('abcd', 'corpus', '<b>Mondsee</b>: Mondsee'), ['b', 'c'])
+        self.assertEqual(table.facet_filter('abcd', 'range', '800-899'), ['a', 'b'])
+        self.assertEqual(table.facet_filter('abcd', 'no_date'), ['c'])
+        self.assertEqual(table.facet_filter('abcd', 'forgeries'), ['b'])
+        self.assertEqual(table.filter_forgeries('abcd', 'exclude'), ['a', 'c'])
+        self.assertEqual(table.filter_specific_date_range('abcd', year_start=700, year_end=800), ['a', 'c', 'd'])
+        self.assertEqual(table.filter_specific_date_range('abcd', year_start=700, month_start=12, day_start=1,
+                                                          year_end=800, month_end=12, day_end=31), ['d'])
+
+    @patch('formulae.search.token_store.token_store_key', return_value='test_indices')
+    @patch.object(Elasticsearch, "search")
+    def test_result_sets(self, mock_search, mock_key):
+        """ Make sure that another sort order or a part of the corpus of an earlier search is answered without a new search"""
+        test_args = copy(self.TEST_ARGS['test_date_range_search_same_year'])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        self.search_response = cycle(fake.load_response())
+        self.search_aggs = fake.load_aggs()
+        sources = {h['_id']: {k: v for k, v in h['_source'].items() if k not in Search.PAGE_SOURCE_EXCLUDES}
+                   for r in fake.load_response() for h in r['hits']['hits']}
+        source_requests = []
+
+        def result_set_side_effect(**kwargs):
+            if kwargs.get('_source') == {'excludes': Search.PAGE_SOURCE_EXCLUDES} and 'ids' in kwargs['query']:
+                source_requests.append(kwargs['query']['ids']['values'])
+                return {'hits': {'hits': [{'_id': x, '_source': sources[x]} for x in kwargs['query']['ids']['values']]}}
+            return self.search_side_effect(**kwargs)
+
+        mock_search.side_effect = result_set_side_effect
+        test_args['corpus'] = self.set_corpus(test_args['corpus'].split('+'))
+        self.app.config.update(ALL_DOCS_CACHE_TIMEOUT=3600, RESULT_SET_CACHE_SIZE=4)
+        self.app.extensions.pop('all_docs_cache', None)
+        self.app.extensions.pop('result_set_cache', None)
+
+        def run_search(**changed_args):
+            search_args = copy(test_args)
+            search_args.update(changed_args)
+            search_args['query_dict'] = make_query_dict(search_args)
+            return advanced_query_index(**search_args)
+
+        ids, total, aggs, prev_search = run_search()
+        search_calls = mock_search.call_count
+        result_ids = [x['id'] for x in ids]
+        # Only the highlighting and the sortable attributes of the hits are stored
+        stored = list(get_result_set_cache().local.values())[0]['results']
+        self.assertTrue(all(set(x['info']) <= set(DOC_ATTRIBUTE_FIELDS) for x in stored))
+        self.assertEqual([x['sents'] for x in stored], [x['sents'] for x in ids])
+        table = DocAttributes.from_hits({'_id': x['id'], '_source': x['info']} for x in ids)
+        sorted_ids, sorted_total, sorted_aggs, sorted_prev_search = run_search(sort='min_date_desc')
+        self.assertEqual(mock_search.call_count, search_calls + 1, 'Only the _source of the hits should be requested.')
+        self.assertEqual(sorted(source_requests[-1]), sorted(result_ids))
+        self.assertEqual([x['id'] for x in sorted_ids], table.sort_ids(result_ids, 'min_date_desc'))
+        by_id = {x['id']: x for x in ids}
+        for x in sorted_ids:
+            self.assertEqual(x['info'], sources[x['id']])
+            self.assertEqual((x['sents'], x['regest_sents'], x['highlight']),
+                             (by_id[x['id']]['sents'], by_id[x['id']]['regest_sents'], by_id[x['id']]['highlight']))
+        self.assertEqual(sorted_ids, sorted_prev_search)
+        self.assertEqual(sorted_aggs['range'], aggs['range'])
+        self.assertEqual(sorted_aggs['all_docs'], aggs['all_docs'])
+        collection = ids[0]['info']['collection']
+        Search.get_all_docs_cache().set(Search.all_docs_key([collection.replace('form_lit_chart-', '')]), aggs['all_docs'])
+        restricted_ids, restricted_total, restricted_aggs, restricted_prev_search = run_search(
+            corpus=[collection.replace('form_lit_chart-', '')], old_search=True)
+        self.assertEqual(mock_search.call_count, search_calls + 2)
+        self.assertEqual([x['id'] for x in restricted_ids], [x['id'] for x in ids if x['info']['collection'] == collection])
+        self.assertEqual(restricted_total, len(restricted_ids))
+        self.assertIsNone(restricted_prev_search)
+        # A change of the search arguments is searched in Elasticsearch again
+        run_search(year_end=test_args['year_end'] + 1)
+        self.assertGreater(mock_search.call_count, search_calls)
+        self.assertEqual(len(get_result_set_cache().local), 2)
+        # Results that fill per_page may have been cut off, so they are neither stored nor re-sorted
+        run_search(year_end=test_args['year_end'] + 2, per_page=1)
+        self.assertEqual(len(get_result_set_cache().local), 2)
+        search_calls = mock_search.call_count
+        run_search(year_end=test_args['year_end'] + 2, per_page=1, sort='min_date_desc')
+        self.assertGreater(mock_search.call_count, search_calls)
+        self.app.config.update(ALL_DOCS_CACHE_TIMEOUT=0, RESULT_SET_CACHE_SIZE=0)
+        self.app.extensions.pop('all_docs_cache')
+        self.app.extensions.pop('result_set_cache')
+        self.app.extensions.pop('index_keys')
+
+    @patch('formulae.search.token_store.token_store_key', return_value='test_indices')
+    @patch.object(Elasticsearch, "search")
+    def test_result_set_cache_responses(self, mock_search, mock_key):
+        """ Make sure that the results pages are the same whether the results come from a stored result set or not"""
+        fake = FakeElasticsearch(self.build_file_name(self.TEST_ARGS['test_date_range_search_same_year']), 'advanced_search')
+        hits = [h for r in fake.load_response() for h in r['hits']['hits']]
+        sources = {h['_id']: h['_source'] for h in hits}
+        # The facet counts of the fixture do not match its hits, so they are replaced with those of the hits
+        facets = DocAttributes.from_hits(hits).aggregations([x['id'] for x in fake.load_ids()])
+        source_requests = []
+
+        def result_set_side_effect(**kwargs):
+            if kwargs.get('_source') == {'excludes': Search.PAGE_SOURCE_EXCLUDES} and 'ids' in kwargs['query']:
+                source_requests.append(kwargs['query']['ids']['values'])
+                return {'hits': {'hits': [{'_id': x, '_source': sources[x]} for x in kwargs['query']['ids']['values']]}}
+            return self.search_side_effect(**kwargs)
+
+        mock_search.side_effect = result_set_side_effect
+        # The same search is requested again, e.g., when the page is reloaded
+        urls = [self.results_url(), self.results_url()]
+        uncached = self.results_pages(*urls, facets=facets)
+        self.assertEqual(source_requests, [])
+        redis, store = self.fake_redis()
+        with patch.object(self.app, 'redis', redis), patch.dict(self.app.extensions), \
+                patch.dict(self.app.config, {'ALL_DOCS_CACHE_TIMEOUT': 3600, 'RESULT_SET_CACHE_SIZE': 4}):
+            self.app.extensions.pop('all_docs_cache', None)
+            self.app.extensions.pop('result_set_cache', None)
+            self.assertEqual(self.results_pages(*urls, facets=facets), uncached)
+            self.assertEqual(len(source_requests), 1, 'The second search should be answered from its result set.')
+            get_result_set_cache().local.clear()
+            self.assertEqual(self.results_pages(*urls, facets=facets), uncached,
+                             'The pages with the result set from Redis should not change.')
+            self.assertEqual(len(source_requests), 3)
+            self.assertEqual(get_result_set_cache().counts, {'local_hits': 2, 'redis_hits': 1, 'misses': 1})
+
+    @patch.object(Elasticsearch, "search")
+    def test_previous_search_store_responses(self, mock_search):
+        """ Make sure that the pages that use the results of the last search are the same whether these are kept in Redis or in the session"""
+        mock_search.side_effect = self.search_side_effect
+        urls = [self.results_url(), '/texts/urn:cts:formulae:andecavensis.form001.lat001/passage/1', '/search/download/1']
+        in_session = self.results_pages(*urls)
+        self.assertIn(b'id="prevSearchResults"', in_session[1])
+        redis, store = self.fake_redis()
+        with patch.object(self.app, 'redis', redis), patch.dict(self.app.config, {'PREVIOUS_SEARCH_TIMEOUT': 3600}):
+            in_redis = self.results_pages(*urls)
+        self.assertEqual(len([k for k in store if k.startswith(RESULT_STORE_NAMESPACE)]), 1)
+        self.assertEqual(in_redis[:2], in_session[:2])
+        self.assertEqual(re.search(b'>>\nstream\n.*?>endstream', in_redis[2]).group(0),
+                         re.search(b'>>\nstream\n.*?>endstream', in_session[2]).group(0))
+
+    @patch('formulae.search.token_store.token_store_key', return_value='test_indices')
+    @patch.object(Elasticsearch, "search")
+    def test_index_check_interval_responses(self, mock_search, mock_key):
+        """ Make sure that the results pages are the same whether the fingerprint of the indices is read for every
+        request or kept for INDEX_CHECK_INTERVAL seconds"""
+        mock_search.side_effect = self.search_side_effect
+        urls = [self.results_url(), self.results_url(sort='min_date_desc')]
+        pages = dict()
+        fingerprint_requests = dict()
+        for interval in (0, 60):
+            redis, store = self.fake_redis()
+            with patch.object(self.app, 'redis', redis), patch.dict(self.app.extensions), \
+                    patch.dict(self.app.config, {'INDEX_CHECK_INTERVAL': interval, 'ALL_DOCS_CACHE_TIMEOUT': 3600}):
+                self.app.extensions.pop('all_docs_cache', None)
+                self.app.extensions.pop('index_keys', None)
+                mock_key.reset_mock()
+                pages[interval] = self.results_pages(*urls)
+                fingerprint_requests[interval] = mock_key.call_count
+        self.assertEqual(pages[60], pages[0])
+        self.assertGreater(fingerprint_requests[0], 1)
+        self.assertEqual(fingerprint_requests[60], 1, 'The fingerprint should only be read once in INDEX_CHECK_INTERVAL.')
+
+    @patch.object(Elasticsearch, "mtermvectors")
+    def test_token_store(self, mock_vectors):
+        """ Make sure that the token tables match the term vectors and that they are loaded from the token store"""
+        for doc in self.term_vectors['docs']:
+            for field, vector in doc['term_vectors'].items():
+                tokens = FieldTokens.from_term_vector(vector)
+                offsets = dict()
+                for term, v in vector['terms'].items():
+                    self.assertEqual(tokens.positions_of(term), [t['position'] for t in v['tokens']])
+                    for t in v['tokens']:
+                        offsets[t['position']] = (t['start_offset'], t['end_offset'], term)
+                self.assertEqual(tokens.offsets(), offsets)
+        stored_doc, missing_doc = self.term_vectors['docs'][:2]
+        mock_vectors.return_value = {'docs': [missing_doc]}
+        with tempfile.TemporaryDirectory() as store_folder, \
+                patch('formulae.search.token_store.token_store_key', return_value='test_indices'):
+            writer = TokenStoreWriter(store_folder, 'test_indices')
+            writer.add(stored_doc['_id'], doc_tokens_from_term_vectors(stored_doc['term_vectors']))
+            writer.commit()
+            self.assertEqual(len(TokenStore(store_folder, 'other_indices')), 0)
+            self.app.config['TOKEN_STORE_FOLDER'] = store_folder
+            with self.app.app_context():
+                doc_tokens = load_doc_tokens([(stored_doc['_id'], stored_doc['_index']),
+                                              (missing_doc['_id'], missing_doc['_index'])])
+                # A store that is written while the worker runs is opened on the next request
+                writer = TokenStoreWriter(store_folder, 'test_indices')
+                writer.add(missing_doc['_id'], doc_tokens_from_term_vectors(missing_doc['term_vectors']))
+                writer.commit()
+                self.assertEqual(list(get_token_store().index), [missing_doc['_id']])
+                # After a reindexing, the store of the old indices is not used anymore
+                with patch('formulae.search.token_store.token_store_key', return_value='new_indices'):
+                    self.assertEqual(len(get_token_store()), 0)
+                self.app.extensions.pop('index_keys')
+                with patch.dict(self.app.config, {'INDEX_CHECK_INTERVAL': 60}), \
+                        patch('formulae.search.token_store.token_store_key', return_value='test_indices') as mock_key:
+                    self.assertEqual([current_index_key(), current_index_key()], ['test_indices', 'test_indices'])
+                    mock_key.assert_called_once_with(tuple(TOKEN_INDICES))
+                self.app.extensions.pop('index_keys')
+                self.app.extensions.pop('token_store', None)
+            self.app.config['TOKEN_STORE_FOLDER'] = ''
+        mock_vectors.assert_called_once_with(docs=[{'_index': missing_doc['_index'], '_id': missing_doc['_id'],
+                                                    'term_statistics': False, 'field_statistics': False}])
+        for doc in (stored_doc, missing_doc):
+            self.assertEqual(doc_tokens[doc['_id']]['text'].offsets(),
+                             FieldTokens.from_term_vector(doc['term_vectors']['text']).offsets())
+
+    @staticmethod
+    def product_spans(word_positions, slop, ordered_terms):
+        """ The spans that the Cartesian product of the word positions in lem_highlight_to_text used to produce"""
+        spans = []
+        n_words = len(word_positions)
+        search_range_start = -1 if ordered_terms else slop + n_words
+        for pos in word_positions[0]:
+            index_range = range(max(pos - search_range_start - 1, 0), pos + slop + n_words + 2)
+            matching_positions = [[pos]]
+            for positions in word_positions[1:]:
+                matching_positions.append(list(OrderedDict.fromkeys(p for p in positions if p in index_range)))
+            for span in product(*matching_positions):
+                ordered_span = sorted(set(span))
+                if len(ordered_span) == n_words and (ordered_span[-1] - ordered_span[0]) - (n_words - 1) <= slop:
+                    spans.append(ordered_span)
+        return spans
+
+    def span_test_cases(self):
+        """ Multi-word queries built from the most frequent terms of the term vector fixtures"""
+        for doc in self.term_vectors['docs']:
+            for field in ('text', 'lemmas'):
+                if field not in doc['term_vectors']:
+                    continue
+                tokens = FieldTokens.from_term_vector(doc['term_vectors'][field])
+                frequent = sorted(tokens.terms, key=lambda t: -len(tokens.positions_of(t)))[:6]
+                for words in list(combinations(frequent, 2)) + list(combinations(frequent, 3)) + [(frequent[0], frequent[0])]:
+                    yield [tokens.positions_of(w) for w in words]
+
+    def test_find_spans(self):
+        """ Make sure that find_spans returns exactly the spans of the former Cartesian product"""
+        cases = 0
+        for word_positions in self.span_test_cases():
+            for slop in (0, 1, 3, 10):
+                for ordered_terms in (True, False):
+                    self.assertEqual(find_spans(word_positions, slop, ordered_terms),
+                                     self.product_spans(word_positions, slop, ordered_terms))
+                    cases += 1
+        self.assertGreater(cases, 100)
+        unsorted = [[9, 2, 5], [6, 3, 6, 1], [4, 8]]
+        for ordered_terms in (True, False):
+            self.assertEqual(find_spans(unsorted, 2, ordered_terms), self.product_spans(unsorted, 2, ordered_terms))
+        self.assertEqual(find_spans([[1, 5], [2, 6]], 0, True, span_filter=lambda span: 5 in span), [[5, 6]])
+        self.assertEqual(find_spans([[1, 5], []], 3, False), [])
+
+    @staticmethod
+    def char_loop_snippet(text, start_index, end_index, start_offsets, end_offsets):
+        """ The snippet that the character loop in lem_highlight_to_text used to produce"""
+        sentence = ''
+        for i, x in enumerate(text[start_index:end_index]):
+            if i + start_index in start_offsets and i + start_index in end_offsets:
+                sentence += PRE_TAGS + x + POST_TAGS
+            elif i + start_index in start_offsets:
+                sentence += PRE_TAGS + x
+            elif i + start_index in end_offsets:
+                sentence += x + POST_TAGS
+            else:
+                sentence += x
+        return Markup(sentence)
+
+    def snippet_test_cases(self):
+        """ Snippets around the spans of the term vector fixtures as lem_highlight_to_text cuts them"""
+        for doc in self.term_vectors['docs']:
+            if 'text' not in doc['term_vectors']:
+                continue
+            tokens = FieldTokens.from_term_vector(doc['term_vectors']['text'])
+            offsets = tokens.offsets()
+            text = ' ' * (max(e for s, e, t in offsets.values()) + 1)
+            for start, end, term in offsets.values():
+                text = text[:start] + term[:end - start].ljust(end - start, '-') + text[end:]
+            positions = sorted(offsets)
+            for i, pos in enumerate(positions):
+                span = positions[i:i + 1 + i % 3]
+                start_index = offsets[positions[max(0, i - 10)]][0]
+                end_index = offsets[positions[min(len(positions) - 1, i + 10)]][1] + 1
+                yield (text, start_index, end_index, [offsets[x][0] for x in span], [offsets[x][1] - 1 for x in span])
+
+    def test_mark_snippet(self):
+        """ Make sure that mark_snippet returns exactly the snippets of the former character loop"""
+        cases = 0
+        for case in self.snippet_test_cases():
+            self.assertEqual(mark_snippet(*case), self.char_loop_snippet(*case))
+            cases += 1
+        self.assertGreater(cases, 100)
+        text = 'abc de fghij'
+        for case in [(text, 0, 12, [4], [4]), (text, 0, 12, [0, 7], [2, 11]), (text, 2, 9, [0, 4, 7], [2, 5, 11]),
+                     (text, 3, 30, [4, 4], [5, 5]), (text, 0, 12, [3], [2]), (text, 0, 3, [], [])]:
+            self.assertEqual(mark_snippet(*case), self.char_loop_snippet(*case))
+        self.assertEqual(mark_snippet(text, 0, 6, [4], [5]), Markup('abc ' + PRE_TAGS + 'de' + POST_TAGS))
+
     @patch.object(Elasticsearch, "search")
     def test_date_range_search_same_month(self, mock_search):
         test_args = copy(self.TEST_ARGS['test_date_range_search_same_month'])
@@ -8334,7 +9386,7 @@ class TestES(Formulae_Testing):
         self.assertCountEqual(body[0]['query']['bool']['must'][0]['bool']['should'],
                               mock_search.call_args_list[0][1]['query']['bool']['must'][0]['bool']['should'])
         self.assertEqual(ids, [{"id": x['id']} for x in actual])
-        self.assertEqual(self.app.redis.get('search_progress_1234').decode('utf-8'), '100%',
+        self.assertEqual(get_job_registry().get('search_progress_1234')['progress'], '100%',
                          "Redis should keep track of download progress")
 
     @patch.object(Elasticsearch, "search")
@@ -9375,7 +10427,9 @@ class TestES(Formulae_Testing):
         mock_search.side_effect = self.search_side_effect
         test_args['qSource'] = 'q_1'
         test_args['query_dict'] = make_query_dict(test_args)
-        results = suggest_word_search(**test_args)
+        with patch.object(Search, 'facet_aggregations') as mock_facets:
+            results = suggest_word_search(**test_args)
+        mock_facets.assert_not_called()
         self.assertEqual(results, expected, 'The true results should match the expected results.')
         # Make sure that a wildcard in the search term will not call ElasticSearch but, instead, return None
         test_args = copy(self.TEST_ARGS['test_suggest_elexicon_word_search_completion'])
@@ -9552,6 +10606,18 @@ class TestES(Formulae_Testing):
             c.get('/search/download/1', follow_redirects=True)
             self.assertIn(_('Keine Suchergebnisse zum Herunterladen.'), [x[0] for x in self.flashed_messages])
             self.assertIn('main::index.html', [x[0].name for x in self.templates])
+            with c.session_transaction() as sess:
+                sess['previous_search'] = [{'id': 'urn:cts:formulae:andecavensis.form001.lat001', 'info': {'title': 'Angers 1'},
+                                            'sents': [], 'regest_sents': [], 'highlight': []}]
+                sess['previous_search_args'] = {'corpus': 'andecavensis', 'q': 'regnum'}
+                sess['previous_search_paged'] = True
+            r = c.get('/search/download/1', follow_redirects=True)
+            self.assertIn(_('Suchergebnisse, die auf mehrere Seiten verteilt sind, können nicht heruntergeladen werden.'),
+                          [x[0] for x in self.flashed_messages])
+            self.assertNotIn(b'%PDF', r.get_data(), 'The results of a paged search should not be downloaded without their sentences.')
+            with c.session_transaction() as sess:
+                for k in ('previous_search', 'previous_search_args', 'previous_search_paged'):
+                    sess.pop(k)
         test_args = copy(self.TEST_ARGS['test_download_search_results'])
         fake = FakeElasticsearch(self.build_file_name(test_args).replace('%2B', '+'), 'advanced_search')
         resp = fake.load_response()